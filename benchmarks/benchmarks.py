@@ -0,0 +1,172 @@
+""" Benchmarks of the vertical integrals and the triplet pipeline on synthetic data (see synthetic.py).
+
+    The benchmarks follow the asv conventions (time_* and peakmem_* methods), so they can be run with
+    `asv run --python=same` (see asv.conf.json).  They can also be run without asv, from the top of the
+    repository, with `python -m benchmarks.benchmarks`; each benchmark is then run in a fresh process,
+    and its time and the peak RSS of the benchmark itself (not of its setup) are printed.
+
+    The shape of the synthetic fields is set by $ARTMIP_BENCHMARK_SHAPE (ntime,nlev,nlat,nlon).
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import itertools
+import multiprocessing
+
+# the modules being benchmarked are at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# calculate_artmip_vertical_integrals needs $SCRATCH when it is imported
+os.environ.setdefault('SCRATCH', tempfile.gettempdir())
+
+import vertical_integral
+import calculate_artmip_vertical_integrals as artmip
+import triplet_metrics
+from . import synthetic
+
+# the shape (ntime, nlev, nlat, nlon) of the synthetic fields
+benchmark_shape = tuple([ int(n) for n in os.environ.get('ARTMIP_BENCHMARK_SHAPE', '16,32,96,144').split(',') ])
+
+# the number of time steps per dask chunk
+benchmark_chunk_size = 8
+
+class IntegrateSuite:
+    """ The integrate stage: vertical_integral on in-memory data, for each model layout and integration method """
+    params = (synthetic.layout_models, vertical_integral.integration_methods)
+    param_names = ['model', 'method']
+    timeout = 600
+
+    def setup(self, model, method):
+        self.hus_xr, self.ua_xr, self.va_xr = [ ds.chunk({'time' : benchmark_chunk_size}) \
+                                                for ds in synthetic.make_triplet(model, *benchmark_shape) ]
+
+    def time_integrate_artmip(self, model, method):
+        vertical_integral.integrate_artmip(self.hus_xr, self.ua_xr, self.va_xr, method = method).compute()
+
+    def peakmem_integrate_artmip(self, model, method):
+        vertical_integral.integrate_artmip(self.hus_xr, self.ua_xr, self.va_xr, method = method).compute()
+
+    def time_integrate_prw(self, model, method):
+        vertical_integral.integrate(self.hus_xr, variables = ['hus'], method = method).compute()
+
+class WriteSuite:
+    """ The write stage: writing already-calculated output files with each output encoding profile """
+    params = (list(artmip.output_encoding_profiles),)
+    param_names = ['output_profile']
+    timeout = 600
+
+    def setup(self, output_profile):
+        self.artmip_xr = vertical_integral.integrate_artmip(*synthetic.make_triplet('BCC-CSM2-MR', *benchmark_shape)).load()
+        self.temp_dir = tempfile.mkdtemp(prefix = 'artmip_benchmark_')
+
+    def teardown(self, output_profile):
+        shutil.rmtree(self.temp_dir, ignore_errors = True)
+
+    def _write(self, output_profile):
+        """ Writes each output variable to its own file; returns the total size of the files """
+        total_bytes = 0
+        for variable in artmip.artmip_variables:
+            ds = self.artmip_xr.drop([ var for var in artmip.artmip_variables if var != variable ])
+            ds = artmip.apply_output_profile(ds, variable, output_profile)
+            output_file = os.path.join(self.temp_dir, variable + '.nc')
+            ds.to_netcdf(output_file, unlimited_dims = ['time'])
+            total_bytes += os.path.getsize(output_file)
+        return total_bytes
+
+    def time_write(self, output_profile):
+        self._write(output_profile)
+
+    def peakmem_write(self, output_profile):
+        self._write(output_profile)
+
+    def track_output_bytes(self, output_profile):
+        return self._write(output_profile)
+    track_output_bytes.unit = 'bytes'
+
+class PipelineSuite:
+    """ The whole triplet pipeline (open, integrate, and write) on synthetic netCDF files, for each model layout """
+    params = (synthetic.layout_models,)
+    param_names = ['model']
+    timeout = 600
+
+    def setup(self, model):
+        self.temp_dir = tempfile.mkdtemp(prefix = 'artmip_benchmark_')
+        self.original_base = os.path.join(self.temp_dir, 'CMIP6', '')
+        self.output_base = os.path.join(self.temp_dir, 'ARTMIP_CMIP6', '')
+        self.triplet_line = synthetic.write_triplet(self.original_base, model, *benchmark_shape)
+
+    def teardown(self, model):
+        shutil.rmtree(self.temp_dir, ignore_errors = True)
+
+    def _calculate(self):
+        artmip.calculate_artmip_vertical_integrals(self.triplet_line,
+                                                   original_base = self.original_base,
+                                                   output_base = self.output_base,
+                                                   do_clobber = True,
+                                                   be_verbose = False,
+                                                   default_chunk_size = benchmark_chunk_size,
+                                                   temp_dir = self.temp_dir)
+
+    def time_calculate_triplet(self, model):
+        self._calculate()
+
+    def peakmem_calculate_triplet(self, model):
+        self._calculate()
+
+benchmark_suites = [IntegrateSuite, WriteSuite, PipelineSuite]
+
+def _run_benchmark(suite_class, method_name, params, connection):
+    """ Runs one benchmark (in a child process), and sends its time and peak RSS through connection """
+    suite = suite_class()
+    suite.setup(*params)
+    # measure the peak RSS from here on, so that building the synthetic data in setup() isn't counted
+    triplet_metrics.reset_peak_rss()
+    start_time = time.perf_counter()
+    result = getattr(suite, method_name)(*params)
+    elapsed = time.perf_counter() - start_time
+    peak_rss = triplet_metrics.peak_rss()
+    if hasattr(suite, 'teardown'):
+        suite.teardown(*params)
+    connection.send((elapsed, peak_rss, result))
+    connection.close()
+
+def main():
+    """ Runs all the benchmarks without asv, each in its own process """
+    context = multiprocessing.get_context('fork')
+    print("Shape (ntime, nlev, nlat, nlon): {}".format(benchmark_shape))
+    for suite_class in benchmark_suites:
+        method_names = [ name for name in sorted(dir(suite_class)) if name.startswith(('time_', 'track_')) ]
+        for params in itertools.product(*suite_class.params):
+            for method_name in method_names:
+                reader, writer = context.Pipe(duplex = False)
+                process = context.Process(target = _run_benchmark, args = (suite_class, method_name, params, writer))
+                process.start()
+                # close our copy of the child's end, so that the pipe reaches EOF as soon as the child exits
+                writer.close()
+                try:
+                    # (returns early, with EOF, if the child crashes)
+                    if not reader.poll(suite_class.timeout):
+                        raise TimeoutError("timed out after {} s".format(suite_class.timeout))
+                    elapsed, peak_rss, result = reader.recv()
+                except (EOFError, TimeoutError) as error:
+                    process.terminate()
+                    process.join()
+                    reason = "exit code {}".format(process.exitcode) if isinstance(error, EOFError) else str(error)
+                    print("{}.{}({}): failed ({})".format(suite_class.__name__, method_name, ", ".join(params), reason), flush = True)
+                    continue
+                finally:
+                    reader.close()
+                process.join()
+
+                message = "{}.{}({}): {:.3f} s, peak RSS {:.1f} MiB".format(suite_class.__name__,
+                                                                          method_name,
+                                                                          ", ".join(params),
+                                                                          elapsed,
+                                                                          peak_rss/2**20)
+                if result is not None:
+                    message += ", {} {}".format(result, getattr(getattr(suite_class, method_name), 'unit', ''))
+                print(message, flush = True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+""" Synthetic CMIP6-like 6hrLev datasets for benchmarking.
+
+    The datasets have the hybrid-level coordinate conventions of each model supported by
+    vertical_integral (a_bnds/b_bnds/p0, ap_bnds/b_bnds, CESM2's `nbnd` dimension and upside-down
+    coefficients, CNRM's bad bounds, and IPSL's `klevp1`/`presnivs`), at any resolution.
+"""
+import os
+import numpy as np
+import xarray as xr
+
+# the hybrid coefficient layout of each model (see vertical_integral.hybrid_coefficient_calculator)
+model_layouts = {'BCC-CSM2-MR' : 'a_p0',
+                 'GISS-E2-1-G' : 'a_p0',
+                 'MRI-ESM2-0' : 'a_p0',
+                 'SAM0-UNICON' : 'a_p0',
+                 'CESM2' : 'CESM2',
+                 'CNRM-CM6-1' : 'CNRM',
+                 'CNRM-ESM2-1' : 'CNRM',
+                 'GFDL-CM4' : 'ap',
+                 'IPSL-CM6A-LR' : 'IPSL'}
+
+# one model with each layout
+layout_models = ['BCC-CSM2-MR', 'CESM2', 'CNRM-CM6-1', 'GFDL-CM4', 'IPSL-CM6A-LR']
+
+# the reference pressure [Pa]
+p0 = 100000.0
+
+def hybrid_interfaces(nlev):
+    """ Returns the hybrid coefficients a and b (p = a*p0 + b*ps) at nlev + 1 interfaces, from the surface to the model top """
+    eta = np.linspace(1, 0.002, nlev + 1)
+    b = np.clip((eta - 0.2)/0.8, 0, None)**1.5
+    a = eta - b
+    return a, b
+
+def make_dataset(model,
+                 variable = 'hus',
+                 ntime = 16,
+                 nlev = 32,
+                 nlat = 96,
+                 nlon = 144,
+                 seed = 0):
+    """ Returns a synthetic 6hrLev dataset, like those of a CMIP6 model
+
+        input:
+        ------
+
+            model    : the model whose coordinate conventions to use (see `model_layouts`)
+
+            variable : the field to include: hus, ua, or va
+
+            ntime, nlev, nlat, nlon : the shape of the field
+
+            seed     : the random seed
+
+        output:
+        -------
+
+            an xarray dataset with the field, ps, and the model's hybrid coefficient variables
+    """
+    layout = model_layouts[model]
+    level_dim = 'presnivs' if layout == 'IPSL' else 'lev'
+    rng = np.random.default_rng(seed)
+
+    a, b = hybrid_interfaces(nlev)
+    a_mid = (a[1:] + a[:-1])/2
+    b_mid = (b[1:] + b[:-1])/2
+
+    # 6-hourly times, left undecoded as in a file
+    time = xr.Variable(('time',), 0.25*np.arange(1, ntime + 1),
+                       dict(units = 'days since 1850-01-01', calendar = 'noleap'))
+    lat = np.linspace(-90, 90, nlat)
+    lon = np.arange(nlon)*360/nlon
+    level = (a_mid + b_mid)*p0 if layout == 'IPSL' else a_mid + b_mid
+    ds = xr.Dataset(coords = {'time' : time, level_dim : level, 'lat' : lat, 'lon' : lon},
+                    attrs = dict(source_id = model, table_id = '6hrLev', variable_id = variable))
+
+    shape = (ntime, nlev, nlat, nlon)
+    if variable == 'hus':
+        # humidity decreasing with height
+        field = 0.02*np.exp(-np.arange(nlev)/8)[:, np.newaxis, np.newaxis]*rng.random(shape)
+    else:
+        field = 10*rng.standard_normal(shape)
+    ds[variable] = (('time', level_dim, 'lat', 'lon'), field.astype(np.float32))
+    ds['ps'] = (('time', 'lat', 'lon'), (p0*(1 + 0.02*rng.standard_normal((ntime, nlat, nlon)))).astype(np.float32))
+
+    bounds = lambda c: np.stack([c[:-1], c[1:]], axis = 1)
+    if layout == 'a_p0':
+        ds['a_bnds'] = ((level_dim, 'bnds'), bounds(a))
+        ds['b_bnds'] = ((level_dim, 'bnds'), bounds(b))
+        ds['a'] = ((level_dim,), a_mid)
+        ds['b'] = ((level_dim,), b_mid)
+        ds['p0'] = p0
+    elif layout == 'CESM2':
+        # the coefficients are upside down relative to the data
+        ds['a_bnds'] = ((level_dim, 'nbnd'), bounds(a)[::-1])
+        ds['b_bnds'] = ((level_dim, 'nbnd'), bounds(b)[::-1])
+        ds['a'] = ((level_dim,), a_mid[::-1])
+        ds['b'] = ((level_dim,), b_mid[::-1])
+        ds['p0'] = p0
+    elif layout == 'ap':
+        ds['ap_bnds'] = ((level_dim, 'bnds'), bounds(a*p0))
+        ds['b_bnds'] = ((level_dim, 'bnds'), bounds(b))
+        ds['ap'] = ((level_dim,), a_mid*p0)
+        ds['b'] = ((level_dim,), b_mid)
+    elif layout == 'CNRM':
+        # the bounds in the CNRM files are bad; only the mid-level values are used
+        ds['ap_bnds'] = ((level_dim, 'bnds'), np.zeros((nlev, 2)))
+        ds['b_bnds'] = ((level_dim, 'bnds'), np.zeros((nlev, 2)))
+        ds['ap'] = ((level_dim,), a_mid*p0)
+        ds['b'] = ((level_dim,), b_mid)
+    elif layout == 'IPSL':
+        # the coefficients are on the nlev + 1 interfaces
+        ds['ap_bnds'] = (('klevp1', 'bnds'), np.stack([a*p0, a*p0], axis = 1))
+        ds['b_bnds'] = (('klevp1', 'bnds'), np.stack([b, b], axis = 1))
+        ds = ds.assign_coords(klevp1 = np.arange(nlev + 1))
+
+    return ds
+
+def make_triplet(model, ntime = 16, nlev = 32, nlat = 96, nlon = 144, seed = 0):
+    """ Returns synthetic hus, ua, and va datasets for a model (see `make_dataset()`) """
+    return [ make_dataset(model, variable, ntime, nlev, nlat, nlon, seed + i) for i, variable in enumerate(['hus', 'ua', 'va']) ]
+
+def write_triplet(original_base, model, ntime = 16, nlev = 32, nlat = 96, nlon = 144, seed = 0):
+    """ Writes synthetic hus, ua, and va files in a CMIP6-like directory tree
+
+        input:
+        ------
+
+            original_base : the base directory of the tree
+
+            model, ntime, nlev, nlat, nlon, seed : see `make_dataset()`
+
+        output:
+        -------
+
+            a triplet line for the files (see calculate_artmip_vertical_integrals())
+    """
+    input_files = []
+    for ds in make_triplet(model, ntime, nlev, nlat, nlon, seed):
+        variable = ds.attrs['variable_id']
+        input_file = os.path.join(original_base,
+                                  "CMIP/BENCHMARK/{model}/historical/r1i1p1f1/6hrLev/{variable}/gn/v20190101/"
+                                  "{variable}_6hrLev_{model}_historical_r1i1p1f1_gn_185001010600-185012311800.nc"
+                                  .format(model = model, variable = variable))
+        os.makedirs(os.path.dirname(input_file), exist_ok = True)
+
+        # chunk the fields one time step at a time, as in the CMIP6 files
+        encoding = { var : dict(_FillValue = None) for var in ds.variables }
+        encoding[variable] = dict(_FillValue = np.float32(1e20), chunksizes = (1,) + ds[variable].shape[1:])
+        encoding['ps'] = dict(_FillValue = np.float32(1e20))
+        ds.to_netcdf(input_file, encoding = encoding, unlimited_dims = ['time'])
+        input_files.append(input_file)
+
+    return ",".join(input_files)
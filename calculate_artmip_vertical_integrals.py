@@ -2,23 +2,1346 @@
 # coding: utf-8
 import xarray as xr
 import vertical_integral
+import output_inventory
+import triplet_metrics
 import numpy as np
 import os
 import datetime as dt
 import tempfile
 import shutil
+import json
+import hashlib
+import errno
+import traceback
+import dask
+import dask.array
+import dask.utils
 from dask.diagnostics import ProgressBar
 
+# the default base paths of the CMIP6 input and ARTMIP output directory trees
+default_original_base = "/global/cscratch1/sd/cmip6/CMIP6/"
+default_output_base = os.environ['SCRATCH'] + '/ARTMIP_CMIP6/'
+
+# the variables calculated from a triplet, in the order in which they appear in output file lists
+artmip_variables = ['prw', 'windhusavi', 'uhusavi', 'vhusavi']
+
+# the formats in which output can be written: a netCDF file per input file, or a Zarr store per
+# (model, simulation, ensemble, variable) into which each triplet writes its time region
+output_formats = ['netcdf', 'zarr']
+
+# netCDF4 encoding profiles for the output files (see apply_output_profile()):
+#   none       : uncompressed, with the netCDF library's default chunking
+#   zlib       : zlib/shuffle compression, with default chunking
+#   timeseries : compressed; chunks span a year of 6-hourly steps on 32x32 tiles, for reading long point/regional time series
+#   map        : compressed; one chunk per time step (full lat/lon), for reading maps (e.g., by AR trackers)
+#   packed     : as `map`, but also packed to int16 with the scale/offset in `packing_parameters`
+output_encoding_profiles = dict(none = dict(),
+                                zlib = dict(zlib = True, complevel = 4, shuffle = True),
+                                timeseries = dict(zlib = True, complevel = 4, shuffle = True,
+                                                  chunks = dict(time = 1460, lat = 32, lon = 32)),
+                                map = dict(zlib = True, complevel = 4, shuffle = True,
+                                           chunks = dict(time = 1)),
+                                packed = dict(zlib = True, complevel = 4, shuffle = True,
+                                              chunks = dict(time = 1), pack = True),
+                               )
+
+# the int16 (scale_factor, add_offset) of each output variable for the `packed` profile; the precision is half of
+# scale_factor (prw: +/-0.0025 kg/m2; IVT: +/-0.05 kg/m/s), and values outside the representable range
+# (prw: [-13.8, 313.8] kg/m2; windhusavi: [-276, 6276] kg/m/s; uhusavi/vhusavi: +/-3276 kg/m/s) are clipped
+packing_parameters = dict(prw = (0.005, 150.0),
+                          windhusavi = (0.1, 3000.0),
+                          uhusavi = (0.1, 0.0),
+                          vhusavi = (0.1, 0.0))
+packed_fill_value = np.int16(-32768)
+
+def get_output_profile(output_profile):
+    """ Returns the dict of an output encoding profile, given its name in output_encoding_profiles (or the dict itself) """
+    if not isinstance(output_profile, str):
+        return output_profile
+    try:
+        return output_encoding_profiles[output_profile]
+    except KeyError:
+        raise ValueError("Unknown output profile `{}`; expected one of {}".format(output_profile, list(output_encoding_profiles)))
+
+def get_packed_range(variable):
+    """ Returns the (min, max) values that can be represented when a variable is packed to int16 """
+    scale_factor, add_offset = packing_parameters[variable]
+    packed_max = np.iinfo(np.int16).max
+    return add_offset - packed_max*scale_factor, add_offset + packed_max*scale_factor
+
+def apply_output_profile(ds, variable, output_profile = 'none', dim_sizes = None):
+    """ Sets the netCDF4 encoding of a variable according to an output encoding profile.
+    
+        input:
+        ------
+        
+            ds             : the xarray dataset to be written (the variable's _FillValue should already be set)
+            
+            variable       : the name of the variable whose encoding to set
+            
+            output_profile : the name of a profile in output_encoding_profiles, or a dict with the same keys
+                             (zlib, complevel, shuffle, chunks, pack); `chunks` maps dimension names to chunk
+                             sizes, with missing dimensions (or None) taking the full dimension length
+                             
+            dim_sizes      : (optional) the dimension lengths to which chunk sizes are limited; defaults to
+                             those of ds (this is useful if ds is only a template of the final file)
+                             
+        output:
+        -------
+        
+            ds : the dataset, with the encoding set (and the variable clipped to the packed range if packing)
+    """
+    profile = get_output_profile(output_profile)
+    if dim_sizes is None:
+        dim_sizes = ds.sizes
+        
+    encoding = dict(ds[variable].encoding)
+        
+    # pack the variable into int16
+    if profile.get('pack', False):
+        if variable not in packing_parameters:
+            raise ValueError("No packing parameters for `{}`".format(variable))
+        scale_factor, add_offset = packing_parameters[variable]
+        # clip so that values outside the representable range don't wrap around
+        attrs = ds[variable].attrs
+        ds[variable] = ds[variable].clip(*get_packed_range(variable))
+        ds[variable].attrs = attrs
+        encoding.update(dtype = 'int16',
+                        scale_factor = scale_factor,
+                        add_offset = add_offset,
+                        _FillValue = packed_fill_value)
+        
+    # compress the variable
+    for key in ['zlib', 'complevel', 'shuffle']:
+        if key in profile:
+            encoding[key] = profile[key]
+    
+    # set the chunk shape
+    if 'chunks' in profile:
+        chunksizes = []
+        for dim in ds[variable].dims:
+            size = profile['chunks'].get(dim, None)
+            if size is None or size > dim_sizes[dim]:
+                size = dim_sizes[dim]
+            chunksizes.append(max(int(size), 1))
+        encoding['chunksizes'] = tuple(chunksizes)
+        
+    ds[variable].encoding = encoding
+    return ds
+
+def configure_threads(threads_per_rank = None):
+    """ Sets dask to use a pool of `threads_per_rank` threads for all computations in this process (i.e., MPI rank).
+    
+        input:
+        ------
+        
+            threads_per_rank : the number of threads; defaults to $SLURM_CPUS_PER_TASK (the `srun -c` value), or 1
+            
+        output:
+        -------
+        
+            threads_per_rank : the number of threads used
+            
+        Reads of netCDF4 files are serialized within a process by xarray's HDF5 lock, so the extra threads
+        mainly run the integrals and the writes' compression.  Numpy's own threading (OMP_NUM_THREADS) should
+        be left at 1, so that the threads don't oversubscribe the cores.
+    """
+    if threads_per_rank is None:
+        threads_per_rank = int(os.environ.get('SLURM_CPUS_PER_TASK', 1))
+    dask.config.set(scheduler = 'threads', num_workers = threads_per_rank)
+    return threads_per_rank
+
+def parse_triplet_line(triplet_line):
+    """ Splits a triplet line into its file paths and (optional) time slice.
+    
+        input:
+        ------
+        
+            triplet_line : a comma-separated string containing hus_file, ua_file, va_file, and optionally
+                           the start and stop indices of a slice along the time dimension
+                           
+        output:
+        -------
+        
+            hus_file, ua_file, va_file, time_slice : time_slice is a (start, stop) tuple, or None if the
+                                                     line doesn't have a time slice
+    """
+    fields = triplet_line.rstrip().split(',')
+    hus_file, ua_file, va_file = fields[:3]
+    
+    time_slice = None
+    if len(fields) >= 5:
+        time_slice = (int(fields[3]), int(fields[4]))
+        
+    return hus_file, ua_file, va_file, time_slice
+
+def get_native_chunks(input_xr, variable):
+    """ Returns a dict of the on-disk (HDF5) chunk size of each dimension of a variable; empty if it isn't chunked """
+    chunksizes = input_xr[variable].encoding.get('chunksizes', None)
+    if chunksizes is None or input_xr[variable].encoding.get('contiguous', False):
+        return {}
+    return dict(zip(input_xr[variable].dims, chunksizes))
+
+# the approximate number of full-size (time x lev x lat x lon) arrays alive at once in a dask task: two per input
+# field in its own dtype (the decoded field and the copy made when its level dimension is moved last), one more
+# float64 copy per field with 'einsum' if the field is narrower (einsum casts float32 fields to the float64
+# coefficients' type), plus the float64 ones used by each integration method ('einsum' forms hus*dp, and
+# 'multiply' forms dp and hus*dp)
+live_arrays_per_field = 2
+upcast_arrays_per_field = dict(einsum = 1, multiply = 0)
+extra_live_arrays = dict(einsum = 1, multiply = 2)
+
+def get_memory_chunk_size(input_xr,
+                          variable,
+                          memory_per_rank,
+                          num_fields = 3,
+                          integration_method = 'einsum',
+                          num_threads = None):
+    """ Returns the largest number of time steps per dask chunk that fits in a rank's memory budget.
+    
+        input:
+        ------
+        
+            input_xr           : the (lazily opened) input dataset
+            
+            variable           : the name of the input field in input_xr (e.g., hus)
+            
+            memory_per_rank    : the memory budget of the whole rank (all its dask threads), in bytes or as a
+                                 string (e.g., '12GB')
+                                 
+            num_fields         : the number of input fields that are integrated together (3 for hus, ua, va)
+            
+            integration_method : the integration method (see vertical_integral.integrate_artmip())
+            
+            num_threads        : the number of tasks run at once; defaults to the number of dask threads (see
+                                 configure_threads())
+            
+        output:
+        -------
+        
+            chunk_size : the number of time steps (at least 1)
+            
+        Each of the num_threads tasks gets memory_per_rank/num_threads.  The memory needed per time step is
+        nlev*nlat*nlon bytes times the itemsize of each of the arrays alive at once (see live_arrays_per_field,
+        upcast_arrays_per_field, and extra_live_arrays).
+    """
+    if isinstance(memory_per_rank, str):
+        memory_per_rank = dask.utils.parse_bytes(memory_per_rank)
+    if num_threads is None:
+        num_threads = dask.config.get('num_workers', None) or os.cpu_count()
+    memory_per_task = memory_per_rank/num_threads
+        
+    field = input_xr[variable]
+    step_size = int(np.prod([ field.sizes[dim] for dim in field.dims if dim != 'time' ]))
+    itemsize = max(field.dtype.itemsize, 4)
+    field_bytes = live_arrays_per_field*itemsize
+    if itemsize < 8:
+        field_bytes += upcast_arrays_per_field.get(integration_method, 0)*8
+    step_bytes = step_size*(field_bytes*num_fields + extra_live_arrays.get(integration_method, 0)*8)
+    
+    return max(1, int(memory_per_task // step_bytes))
+
+def open_input_file(input_file,
+                    chunk_size = 32,
+                    time_slice = None,
+                    time = None,
+                    memory_per_rank = None,
+                    num_fields = 3,
+                    integration_method = 'einsum',
+                    input_xr = None):
+    """ Lazily opens a CMIP6 input file as a dask-backed dataset, with chunks aligned to the file's native chunking.
+    
+        input:
+        ------
+        
+            input_file : the path of the file; its name starts with the name of its variable (e.g., hus_6hrLev_...)
+            
+            chunk_size : the approximate number of time steps per dask chunk; this is rounded down to a multiple of
+                         the native time chunk size, so that each dask task reads whole HDF5 chunks.  Other dimensions
+                         aren't chunked, since the integrals need all levels at once.
+                         
+            time_slice : (optional) a (start, stop) slice along the time dimension to select
+            
+            time       : (optional) an already decoded time coordinate (e.g., from the hus file of the same triplet);
+                         if given, the file's times aren't decoded and this coordinate is used instead
+                         
+            memory_per_rank, num_fields, integration_method : (optional) if memory_per_rank is given, chunk_size is
+                         ignored, and the largest chunk size that fits in memory_per_rank is used instead
+                         (see get_memory_chunk_size()).  If that is less than the native time chunk size, it
+                         isn't rounded up; each task then reads part of a native chunk.
+                         
+            input_xr   : (optional) the file, already opened with xr.open_dataset() (with decode_times = False if
+                         `time` is given)
+                         
+        output:
+        -------
+        
+            input_xr, chunk_size : the dataset, and the time chunk size that was used
+    """
+    # open the file lazily; nothing but the metadata (and the time coordinate, if decoded) is read here
+    if input_xr is None:
+        input_xr = xr.open_dataset(input_file, decode_times = time is None)
+    
+    # select only the requested time slice
+    if time_slice is not None:
+        input_xr = input_xr.isel(time = slice(*time_slice))
+        
+    # use a multiple of the native time chunk size (rounding down, so the budget isn't exceeded; chunks smaller
+    # than a native chunk are left as they are), but no more than the length of the file
+    variable = os.path.basename(input_file).split('_')[0]
+    native_time_chunk = 1
+    if variable in input_xr.variables:
+        native_time_chunk = get_native_chunks(input_xr, variable).get('time', 1)
+        if memory_per_rank is not None:
+            chunk_size = get_memory_chunk_size(input_xr, variable, memory_per_rank, num_fields, integration_method)
+    if chunk_size >= native_time_chunk:
+        chunk_size = (chunk_size // native_time_chunk)*native_time_chunk
+    chunk_size = max(1, min(chunk_size, len(input_xr['time'])))
+    
+    # share the decoded time coordinate
+    if time is not None:
+        if len(time) != len(input_xr['time']):
+            raise ValueError("{} has {} time steps; expected {}".format(input_file, len(input_xr['time']), len(time)))
+        input_xr = input_xr.assign_coords(time = time)
+        
+    return input_xr.chunk({'time' : chunk_size}), chunk_size
+
+def open_triplet(triplet_line,
+                 chunk_size = 32,
+                 memory_per_rank = None,
+                 integration_method = 'einsum'):
+    """ Lazily opens the hus, ua, and va files of a triplet (see open_input_file()).
+    
+        input:
+        ------
+        
+            triplet_line : a triplet line (see calculate_artmip_vertical_integrals())
+            
+            chunk_size, memory_per_rank, integration_method : see open_input_file(); ua and va use the same
+                                                              chunks as hus
+                                                              
+        output:
+        -------
+        
+            hus_xr, ua_xr, va_xr, chunk_size : the datasets (ua_xr and va_xr are None if their files aren't given),
+                                               and the time chunk size
+                                               
+        Only metadata and coordinates are read, so this can be done ahead of time (e.g., in another thread
+        while the previous triplet is being calculated) and the result passed to calculate_artmip_vertical_integrals().
+    """
+    hus_file, ua_file, va_file, time_slice = parse_triplet_line(triplet_line)
+    
+    num_fields = 3 if ua_file != "" and va_file != "" else 1
+    hus_xr, chunk_size = open_input_file(hus_file,
+                                         chunk_size,
+                                         time_slice,
+                                         memory_per_rank = memory_per_rank,
+                                         num_fields = num_fields,
+                                         integration_method = integration_method)
+    
+    # ua and va use the same chunks and times as hus
+    ua_xr = None
+    va_xr = None
+    if ua_file != "":
+        ua_xr, _ = open_input_file(ua_file, chunk_size, time_slice, time = hus_xr['time'])
+    if va_file != "":
+        va_xr, _ = open_input_file(va_file, chunk_size, time_slice, time = hus_xr['time'])
+        
+    return hus_xr, ua_xr, va_xr, chunk_size
+
+def get_time_length(input_file):
+    """ Returns the length of the time dimension of a file (only the file header is read) """
+    with xr.open_dataset(input_file, decode_coords = False, decode_times = False) as input_xr:
+        return len(input_xr['time'])
+
+def split_triplet_line(triplet_line, max_time_steps):
+    """ Splits a triplet line into lines that each cover at most `max_time_steps` time steps.
+    
+        input:
+        ------
+        
+            triplet_line   : a triplet line (see calculate_artmip_vertical_integrals())
+            
+            max_time_steps : the maximum number of time steps per line
+            
+        output:
+        -------
+        
+            a list of triplet lines with time slices; the original line is returned (in a list)
+            if it is short enough or already has a time slice
+    """
+    hus_file, ua_file, va_file, time_slice = parse_triplet_line(triplet_line)
+    
+    if time_slice is not None:
+        return [triplet_line.rstrip()]
+    
+    ntime = get_time_length(hus_file)
+    if ntime <= max_time_steps:
+        return [triplet_line.rstrip()]
+    
+    return [ ",".join([hus_file, ua_file, va_file, str(start), str(min(start + max_time_steps, ntime))]) \
+             for start in range(0, ntime, max_time_steps) ]
+
+def move_into_place(temp_file, output_file):
+    """ Moves a finished temporary file to its final path, such that a partial file never appears at output_file.
+    
+        If the temporary file is on the same filesystem as output_file, it is simply renamed.  Otherwise (e.g., if
+        it was staged on node-local storage), it is copied next to output_file, as output_file + '.partial', and
+        then renamed; a '.partial' file left by an interrupted copy is overwritten when the file is next written.
+    """
+    try:
+        os.replace(temp_file, output_file)
+        return
+    except OSError as error:
+        if error.errno != errno.EXDEV:
+            raise
+        
+    partial_file = get_partial_file_name(output_file)
+    try:
+        shutil.copyfile(temp_file, partial_file)
+        os.replace(partial_file, output_file)
+    except BaseException:
+        if os.path.exists(partial_file):
+            os.remove(partial_file)
+        raise
+    os.remove(temp_file)
+
+def get_partial_file_name(output_file):
+    """ Returns the name under which move_into_place() copies a file next to output_file before renaming it """
+    return output_file + '.partial'
+
+def get_output_file_names(triplet_line,
+                          original_base = default_original_base,
+                          output_base = default_output_base):
+    """ Returns the list of output files for a triplet line (see calculate_artmip_vertical_integrals()).
+    
+        The list contains the prw file, followed by the windhusavi, uhusavi, and vhusavi files if
+        both ua_file and va_file are given.  Time slices are ignored.
+    """
+    hus_file, ua_file, va_file, _ = parse_triplet_line(triplet_line)
+    
+    # parse the hus file path
+    output_file_template = hus_file.replace(original_base, output_base)
+    output_file_template = output_file_template.replace('hus', '{variable}')
+    
+    variables = artmip_variables[:1]
+    if ua_file != "" and va_file != "":
+        variables = artmip_variables
+        
+    return [ os.path.abspath(output_file_template.format(variable = variable)) for variable in variables ]
+
+def get_part_file_name(output_file, time_slice):
+    """ Returns the name of the file holding a time slice of `output_file` """
+    return "{}.part{:08d}-{:08d}".format(output_file, *time_slice)
+
+def get_partial_file_names(triplet_line,
+                           original_base = default_original_base,
+                           output_base = default_output_base):
+    """ Returns the '.partial' files that an interrupted move_into_place() of a triplet line's (netCDF) output files could leave """
+    _, _, _, time_slice = parse_triplet_line(triplet_line)
+    output_files = get_output_file_names(triplet_line, original_base, output_base)
+    if time_slice is not None:
+        output_files = [ get_part_file_name(output_file, time_slice) for output_file in output_files ]
+    return [ get_partial_file_name(output_file) for output_file in output_files ]
+
+def get_merge_tasks(triplet_lines,
+                    original_base = default_original_base,
+                    output_base = default_output_base):
+    """ Returns the merges needed to combine time slice output files into whole output files.
+    
+        input:
+        ------
+        
+            triplet_lines : a list of triplet lines, some of which have time slices (e.g. from split_triplet_line())
+            
+            original_base, output_base : see calculate_artmip_vertical_integrals()
+            
+        output:
+        -------
+        
+            a list of (output_file, part_files) tuples, one for each output file that was split
+            (see merge_time_slices())
+    """
+    # gather the time slices of each triplet
+    time_slices = {}
+    for triplet_line in triplet_lines:
+        hus_file, ua_file, va_file, time_slice = parse_triplet_line(triplet_line)
+        if time_slice is not None:
+            time_slices.setdefault(",".join([hus_file, ua_file, va_file]), []).append(time_slice)
+            
+    merge_tasks = []
+    for base_line, slices in time_slices.items():
+        for output_file in get_output_file_names(base_line, original_base, output_base):
+            part_files = [ get_part_file_name(output_file, time_slice) for time_slice in sorted(slices) ]
+            merge_tasks.append((output_file, part_files))
+            
+    return merge_tasks
+
+def merge_time_slices(output_file,
+                      part_files,
+                      temp_dir = None,
+                      temp_file_prefix = "tmp",
+                      remove_part_files = True,
+                      be_verbose = True,
+                      inventory_file = None):
+    """ Concatenates time slice files in time, without recalculating anything.
+    
+        input:
+        ------
+        
+            output_file      : the file to write
+            
+            part_files       : the time slice files (e.g. from get_merge_tasks()), in time order
+            
+            temp_dir         : the directory to which output_file is written before being moved into place.
+                               Defaults to $SCRATCH/tmp/
+                               
+            temp_file_prefix : the prefix of the temporary file name
+            
+            remove_part_files : flags whether to remove the part files once output_file is in place
+            
+            be_verbose       : flags whether to print updates along the way
+            
+            inventory_file   : (optional) an SQLite file in which to record output_file and its summary statistics
+                               (see output_inventory.record_output_file())
+            
+        output:
+        -------
+        
+            True if output_file was written, False if any of the part files are missing.
+    """
+    if not all([ os.path.exists(part_file) for part_file in part_files ]):
+        if be_verbose:
+            print("Not merging {}: not all of its time slices are present".format(output_file))
+        return False
+    
+    if temp_dir is None:
+        temp_dir = os.environ['SCRATCH'] + '/tmp/'
+    
+    if be_verbose:
+        print("Merging {} time slices into {}".format(len(part_files), output_file))
+        
+    merged_xr = xr.open_mfdataset(part_files,
+                                  combine = 'nested',
+                                  concat_dim = 'time',
+                                  data_vars = 'minimal',
+                                  coords = 'minimal',
+                                  compat = 'override')
+    # keep the fill value settings of the part files
+    for var in merged_xr.variables:
+        if '_FillValue' not in merged_xr[var].encoding:
+            merged_xr[var].encoding['_FillValue'] = None
+    merged_xr.attrs.pop('artmip_cmip6_time_slice', None)
+    
+    temp_file = tempfile.NamedTemporaryFile(dir = temp_dir,
+                                            prefix = temp_file_prefix,
+                                            suffix = '.nc',
+                                            delete = False)
+    delayed_obj = merged_xr.to_netcdf(temp_file.name, unlimited_dims = ["time"], compute = False)
+    
+    # calculate the summary statistics while the data are being copied
+    statistics = {}
+    if inventory_file is not None:
+        variable = output_inventory.parse_output_file_name(output_file)['variable']
+        statistics = _summary_statistics(merged_xr, variable)
+    results = dask.compute(delayed_obj, *statistics.values())
+    statistics = dict(zip(statistics.keys(), results[1:]))
+    merged_xr.close()
+    
+    move_into_place(temp_file.name, output_file)
+    
+    if inventory_file is not None:
+        _record_in_inventory(inventory_file, output_file, merged_xr, statistics)
+    
+    if remove_part_files:
+        for part_file in part_files:
+            os.remove(part_file)
+            
+    return True
+
+def get_zarr_store_name(output_file):
+    """ Returns the Zarr store that holds the data of a (netCDF) output file.
+    
+        There is one store per (model, simulation, ensemble, variable):
+        
+        {output_base}/{center}/{model}/{simulation}/{ensemble}/6hrLev/{variable}/gn/{variable}_6hrLev_{model}_{simulation}_{ensemble}_gn.zarr
+    """
+    store_dir = os.path.dirname(os.path.dirname(output_file))
+    # drop the file_id (the date range) from the file name
+    base_name = os.path.basename(output_file).split('.nc')[0]
+    return os.path.join(store_dir, "_".join(base_name.split('_')[:-1]) + ".zarr")
+
+def get_zarr_store_names(triplet_line,
+                         original_base = default_original_base,
+                         output_base = default_output_base):
+    """ Returns the Zarr stores of a triplet line, in the same order as get_output_file_names() """
+    return [ get_zarr_store_name(output_file) for output_file in get_output_file_names(triplet_line, original_base, output_base) ]
+
+# the number of time steps in each chunk of the Zarr stores (30 days of 6-hourly data)
+zarr_time_chunk = 120
+
+def _zarr_regions_dir(store):
+    """ Returns the directory in which the regions written into a Zarr store are recorded """
+    return store + '.regions'
+
+def _zarr_synchronizer_dir(store):
+    """ Returns the directory of the locks that serialize writes to the chunks that regions of a Zarr store share """
+    return store + '.sync'
+
+def _zarr_region_key(triplet_line):
+    """ Returns a short, stable key for the region written by a triplet line """
+    return hashlib.sha1(triplet_line.strip().encode()).hexdigest()[:16]
+
+def zarr_region_written(store, triplet_line):
+    """ Returns whether the region of a triplet line has been written into a Zarr store (see write_zarr_regions()) """
+    return os.path.exists(os.path.join(_zarr_regions_dir(store), _zarr_region_key(triplet_line) + '.json'))
+
+def _record_zarr_region(store, triplet_line, start, stop):
+    """ Records that the region [start, stop) of a Zarr store was written by a triplet line """
+    regions_dir = _zarr_regions_dir(store)
+    os.makedirs(regions_dir, exist_ok = True)
+    with tempfile.NamedTemporaryFile('w', dir = regions_dir, suffix = '.tmp', delete = False) as fout:
+        json.dump(dict(triplet = triplet_line.strip(), start = start, stop = stop), fout)
+    os.replace(fout.name, os.path.join(regions_dir, _zarr_region_key(triplet_line) + '.json'))
+
+def read_time_axis(input_file):
+    """ Returns the raw (undecoded) time values, units, and calendar of a file; only the header and time variable are read """
+    with xr.open_dataset(input_file, decode_coords = False, decode_times = False) as input_xr:
+        time_var = input_xr['time']
+        return time_var.values, time_var.attrs.get('units'), time_var.attrs.get('calendar', 'standard')
+
+def _combine_time_axes(time_axes):
+    """ Concatenates (values, units, calendar) time axes from read_time_axis(), in the units and calendar of the first """
+    _, units, calendar = time_axes[0]
+    values = []
+    for file_values, file_units, file_calendar in time_axes:
+        if (file_units, file_calendar) != (units, calendar):
+            dates = xr.coding.times.decode_cf_datetime(file_values, file_units, file_calendar)
+            file_values, _, _ = xr.coding.times.encode_cf_datetime(dates, units, calendar)
+        values.append(np.asarray(file_values))
+    return np.concatenate(values), units, calendar
+
+def _zarr_template(artmip_xr, variable, time, time_units, time_calendar, time_chunk):
+    """ Returns a lazy dataset with the structure of the Zarr store for one variable, spanning the raw time values `time` """
+    ds = artmip_xr.drop([ var for var in artmip_variables if var != variable and var in artmip_xr ])
+    
+    template = xr.Dataset(attrs = ds.attrs)
+    # the source files and time slices differ among the regions of the store
+    template.attrs.pop('artmip_cmip6_source_files', None)
+    template.attrs.pop('artmip_cmip6_time_slice', None)
+    
+    # the time values are stored as they are in the files, and decoded when the store is opened
+    template['time'] = xr.Variable(('time',), time, dict(ds['time'].attrs, units = time_units, calendar = time_calendar))
+    
+    for name, var in ds.variables.items():
+        if name == 'time':
+            continue
+        if 'time' in var.dims:
+            # time-dependent, non-numeric variables (e.g., time_bnds) are left out of the store
+            if var.dtype.kind not in 'biuf':
+                continue
+            # placeholder data; only the metadata are written when the store is initialized
+            shape = [ len(time) if dim == 'time' else ds.sizes[dim] for dim in var.dims ]
+            chunks = [ time_chunk if dim == 'time' else ds.sizes[dim] for dim in var.dims ]
+            template[name] = xr.Variable(var.dims, dask.array.zeros(shape, chunks = chunks, dtype = var.dtype), var.attrs)
+            template[name].encoding['_FillValue'] = 1e20 if name == variable else None
+        else:
+            template[name] = xr.Variable(var.dims, var.values, var.attrs)
+            template[name].encoding['_FillValue'] = None
+            
+    return template.set_coords([ name for name in ds.coords if name in template.variables ])
+
+def get_zarr_store_plan(triplet_lines,
+                        original_base = default_original_base,
+                        output_base = default_output_base):
+    """ Returns the Zarr stores written by a set of triplets, with the whole-file triplets that write into each.
+    
+        input:
+        ------
+        
+            triplet_lines : a list of triplet lines; time slices are ignored
+            
+            original_base, output_base : see calculate_artmip_vertical_integrals()
+            
+        output:
+        -------
+        
+            a list of (store, variable, base_lines) tuples, sorted by store, where base_lines are the sorted
+            whole-file triplet lines that write into the store (see initialize_zarr_store()).  A prw store
+            gets the triplets with and without winds.
+    """
+    store_lines = {}
+    store_variables = {}
+    for triplet_line in triplet_lines:
+        if triplet_line.strip() == "":
+            continue
+        hus_file, ua_file, va_file, _ = parse_triplet_line(triplet_line)
+        base_line = ",".join([hus_file, ua_file, va_file])
+        for variable, store in zip(artmip_variables, get_zarr_store_names(base_line, original_base, output_base)):
+            base_lines = store_lines.setdefault(store, [])
+            if base_line not in base_lines:
+                base_lines.append(base_line)
+            store_variables[store] = variable
+            
+    return [ (store, store_variables[store], sorted(store_lines[store])) for store in sorted(store_lines) ]
+
+def initialize_zarr_store(store,
+                          variable,
+                          base_lines,
+                          original_base = default_original_base,
+                          output_base = default_output_base,
+                          time_chunk = zarr_time_chunk,
+                          do_clobber = False,
+                          be_verbose = True,
+                          **kwargs):
+    """ Creates the Zarr store of one variable, so that triplets can then write their time regions into it concurrently.
+    
+        input:
+        ------
+        
+            store, variable, base_lines : an entry of get_zarr_store_plan(); the files of base_lines must be
+                                          contiguous and non-overlapping in time
+                             
+            original_base, output_base : see calculate_artmip_vertical_integrals()
+            
+            time_chunk     : the number of time steps per chunk of the store
+                             
+            do_clobber     : flags whether to recreate the store if it already exists (its record of written
+                             regions is removed as well)
+            
+            be_verbose     : flags whether to print updates along the way
+            
+            kwargs         : further arguments to calculate_artmip_vertical_integrals() (e.g., coefficient_file),
+                             which is used (lazily, without calculating anything) to get the structure of the output
+                             
+        output:
+        -------
+        
+            store
+            
+        The store spans the time coordinates of all its files, which are read from the file headers.  Regions
+        written by different triplets may share a chunk at their ends; write_zarr_regions() serializes the
+        writes to those chunks.  Only metadata and time-independent variables are written here.
+    """
+    if os.path.exists(store) and not do_clobber:
+        return store
+    
+    # get the time coordinates of all the files, in order
+    time, time_units, time_calendar = _combine_time_axes([ read_time_axis(parse_triplet_line(base_line)[0]) \
+                                                           for base_line in base_lines ])
+    if np.any(np.diff(time) <= 0):
+        raise ValueError("The files of {} overlap in time or are out of order".format(store))
+    
+    # get the structure of the output from the first file
+    _, artmip_xr = calculate_artmip_vertical_integrals(base_lines[0],
+                                                       write_output_files = False,
+                                                       no_return_xarray = False,
+                                                       be_verbose = False,
+                                                       original_base = original_base,
+                                                       output_base = output_base,
+                                                       **kwargs)
+    
+    if be_verbose:
+        print("Initializing {} ({} time steps in chunks of {})".format(store, len(time), time_chunk))
+    for stale_dir in [_zarr_regions_dir(store), _zarr_synchronizer_dir(store)]:
+        shutil.rmtree(stale_dir, ignore_errors = True)
+    os.makedirs(os.path.dirname(store), exist_ok = True)
+    template = _zarr_template(artmip_xr, variable, time, time_units, time_calendar, time_chunk)
+    template.to_zarr(store, mode = 'w', compute = False, consolidated = True)
+    
+    artmip_xr.close()
+    return store
+
+def initialize_zarr_stores(triplet_lines,
+                           original_base = default_original_base,
+                           output_base = default_output_base,
+                           do_clobber = False,
+                           be_verbose = True,
+                           **kwargs):
+    """ Creates the Zarr stores for a set of triplets, one after another (see get_zarr_store_plan() and initialize_zarr_store())
+    
+        Returns a list of the stores of all the triplets (including existing ones).  To spread the work across
+        MPI ranks, map initialize_zarr_store() over the entries of get_zarr_store_plan() instead.
+    """
+    return [ initialize_zarr_store(store, variable, base_lines,
+                                   original_base = original_base,
+                                   output_base = output_base,
+                                   do_clobber = do_clobber,
+                                   be_verbose = be_verbose,
+                                   **kwargs) \
+             for store, variable, base_lines in get_zarr_store_plan(triplet_lines, original_base, output_base) ]
+
+def write_zarr_regions(artmip_xr,
+                       stores,
+                       chunk_size = 32,
+                       do_write_progress_bar = False,
+                       be_verbose = True,
+                       triplet_line = None):
+    """ Writes the time region covered by artmip_xr into Zarr stores created by initialize_zarr_store().
+    
+        input:
+        ------
+        
+            artmip_xr  : the output of vertical_integral.integrate_artmip()
+            
+            stores     : the stores of prw, windhusavi, uhusavi, and vhusavi (in that order;
+                         see get_zarr_store_names())
+                         
+            chunk_size : the approximate number of time steps written per dask task
+            
+            do_write_progress_bar : flags whether to write a dask progress bar during writing
+            
+            be_verbose : flags whether to print updates along the way
+            
+            triplet_line : (optional) the triplet line of artmip_xr; if given, the region is recorded in each
+                           store once it is written (see zarr_region_written())
+            
+        All stores are written with a single dask computation.  The chunks at the ends of the region may be
+        shared with the regions of other triplets, so they are written under a per-chunk lock (a
+        zarr.ProcessSynchronizer); the chunks in between are written without locking.  Metadata are not
+        consolidated here, since many ranks may be writing to the same store (see consolidate_zarr_stores()).
+    """
+    import zarr
+    
+    delayed_objs = []
+    regions = []
+    for variable, store in zip(artmip_variables, stores):
+        store_xr = xr.open_zarr(store, consolidated = True)
+        
+        # find the region of the store covered by this dataset
+        start = store_xr.indexes['time'].get_loc(artmip_xr.indexes['time'][0])
+        stop = start + len(artmip_xr['time'])
+        if stop > len(store_xr['time']):
+            raise ValueError("The time coordinate of {} doesn't cover {}".format(store, artmip_xr.attrs.get('artmip_cmip6_source_files')))
+        regions.append((store, start, stop))
+            
+        # write only the time-dependent variables that are in the store, without their coordinates
+        region_xr = xr.Dataset({ name : artmip_xr[name].variable for name in store_xr.variables \
+                                 if name != 'time' and 'time' in store_xr[name].dims })
+        time_chunk = store_xr[variable].encoding['chunks'][store_xr[variable].dims.index('time')]
+        store_xr.close()
+        
+        # split the region into the (possibly shared) partial chunks at its ends and the whole chunks in between
+        inner_start = min(stop, -(-start // time_chunk)*time_chunk)
+        inner_stop = max(inner_start, (stop // time_chunk)*time_chunk)
+        
+        if be_verbose:
+            print("Writing time steps {}-{} of {}".format(start, stop, store))
+        for piece_start, piece_stop, is_shared in [(start, inner_start, True),
+                                                   (inner_start, inner_stop, False),
+                                                   (inner_stop, stop, True)]:
+            if piece_stop <= piece_start:
+                continue
+            piece_xr = region_xr.isel(time = slice(piece_start - start, piece_stop - start))
+            synchronizer = None
+            if is_shared:
+                # one dask chunk, written while holding the lock of its store chunk
+                piece_xr = piece_xr.chunk({'time' : piece_stop - piece_start})
+                synchronizer = zarr.ProcessSynchronizer(_zarr_synchronizer_dir(store))
+            else:
+                # align the dask chunks with the store's chunks
+                piece_xr = piece_xr.chunk({'time' : time_chunk*max(1, chunk_size // time_chunk)})
+            delayed_objs.append(piece_xr.to_zarr(store,
+                                                 region = {'time' : slice(piece_start, piece_stop)},
+                                                 compute = False,
+                                                 consolidated = False,
+                                                 synchronizer = synchronizer))
+        
+    if do_write_progress_bar:
+        with ProgressBar():
+            dask.compute(*delayed_objs)
+    else:
+        dask.compute(*delayed_objs)
+        
+    if triplet_line is not None:
+        for store, start, stop in regions:
+            _record_zarr_region(store, triplet_line, start, stop)
+
+def consolidate_zarr_stores(stores):
+    """ Consolidates the metadata of Zarr stores (e.g., once all regions have been written) """
+    import zarr
+    for store in sorted(set(stores)):
+        if os.path.exists(store):
+            zarr.consolidate_metadata(store)
+
+# the fill value of the ARTMIP variables in the output files; fill values are turned off for other variables
+output_fill_value = 1e20
+
+def fix_fill_values(ds, variable):
+    """ Fix fill values in xarray output"""
+    for var in ds.variables:
+        if var == variable:
+            ds[var].encoding['_FillValue'] = output_fill_value
+        else:
+            ds[var].encoding['_FillValue'] = None 
+
+def fix_bcc_coordinates(hus_xr, ua_xr, va_xr):
+    """ Replaces possibly corrupt coordinates in BCC-CSM2-MR datasets with those in bcc_ref_coords.nc
+    
+        input:
+        ------
+        
+            hus_xr, ua_xr, va_xr : the input datasets (ua_xr and va_xr may be None)
+            
+        output:
+        -------
+        
+            hus_xr, ua_xr, va_xr : the datasets, with lat, lon, lev, a_bnds, and b_bnds replaced if the
+                                   datasets are from BCC-CSM2-MR and their coordinates are corrupt
+    """
+    _, model = vertical_integral.get_level_variable_name(hus_xr)
+    if model != 'BCC-CSM2-MR':
+        return hus_xr, ua_xr, va_xr
+    
+    # check if we are dealing with corrupted BCC files
+    if float(hus_xr['lev'].isel(lev = 0).values) == 0.0 or \
+       float(ua_xr['lev'].isel(lev = 0).values) == 0.0 or \
+       float(va_xr['lev'].isel(lev = 0).values) == 0.0:
+        # attempt to open a file containing the BCC coordinates
+        bcc_coord_file = f"{os.path.dirname(os.path.abspath(__file__))}/bcc_ref_coords.nc"
+        if os.path.exists(bcc_coord_file):
+            bcc_coords_xr = xr.open_dataset(bcc_coord_file)
+            lev = bcc_coords_xr['lev']
+            lat = bcc_coords_xr['lat']
+            lon = bcc_coords_xr['lon']
+            # overwrite coordinates in the datasets being multiplied
+            hus_xr = hus_xr.assign_coords(lat = lat, lon = lon, lev = lev)
+            ua_xr = ua_xr.assign_coords(lat = lat, lon = lon, lev = lev)
+            va_xr = va_xr.assign_coords(lat = lat, lon = lon, lev = lev)
+            # overwrite the a/b coordinates
+            hus_xr['a_bnds'] = bcc_coords_xr['a_bnds']
+            ua_xr['a_bnds'] = bcc_coords_xr['a_bnds']
+            va_xr['a_bnds'] = bcc_coords_xr['a_bnds']
+            hus_xr['b_bnds'] = bcc_coords_xr['b_bnds']
+            ua_xr['b_bnds'] = bcc_coords_xr['b_bnds']
+            va_xr['b_bnds'] = bcc_coords_xr['b_bnds']
+            
+    return hus_xr, ua_xr, va_xr
+
+def set_artmip_attributes(artmip_xr, hus_file, ua_file, va_file, time_slice = None):
+    """ Sets the metadata of the ARTMIP variables and the provenance attributes of an output dataset (in place) """
+    # set metadata for the vertical integral of hus
+    artmip_xr['prw'].attrs['long_name'] = "Integrated Water Vapor"
+    artmip_xr['prw'].attrs['units'] = "kg/m2"
+
+    if 'windhusavi' in artmip_xr:
+        # set metadata
+        artmip_xr['windhusavi'].attrs['long_Name'] = "Integrated Vapor Transport"
+        artmip_xr['windhusavi'].attrs['units'] = "kg/m/s"
+    
+        artmip_xr['uhusavi'].attrs['long_Name'] = "Northward Integrated Vapor Transport"
+        artmip_xr['uhusavi'].attrs['units'] = "kg/m/s"
+    
+        artmip_xr['vhusavi'].attrs['long_Name'] = "Eastward Integrated Vapor Transport"
+        artmip_xr['vhusavi'].attrs['units'] = "kg/m/s"
+    
+    
+    # add metadata about the git repository
+    artmip_xr.attrs['artmip_cmip6_source_files'] = ",".join([hus_file, ua_file, va_file])
+    if time_slice is not None:
+        artmip_xr.attrs['artmip_cmip6_time_slice'] = "{},{}".format(*time_slice)
+    artmip_xr.attrs['artmip_cmip6_integral_script'] = os.path.abspath(__file__)
+    artmip_xr.attrs['artmip_cmip6_integral_calculation_date'] = str(dt.datetime.today())
+    try:
+        import git
+        _repo = git.Repo(search_parent_directories=True)
+        _git_sha = _repo.head.object.hexsha
+        _git_short_sha = _repo.git.rev_parse(_git_sha, short=7)
+        _git_branch = _repo.active_branch
+        artmip_xr.attrs['artmip_script_repo'] = "https://bitbucket.org/lbl-cascade/cmip6_artmip_integrals.git"
+        artmip_xr.attrs['artmip_script_branch'] = "{}".format(_git_branch)
+        artmip_xr.attrs['artmip_script_rev'] = "{}".format(_git_short_sha)
+    except:
+        pass
+
+def _summary_statistics(ds, variable):
+    """ Returns a dict of (lazy, if ds is dask-backed) summary statistics of a variable, for the output inventory """
+    field = ds[variable]
+    return dict(value_min = field.min().data,
+                value_max = field.max().data,
+                value_mean = field.mean().data,
+                nan_count = field.isnull().sum().data)
+
+def _coordinate_extents(ds):
+    """ Returns a dict of the time, lat, and lon extents of a dataset, for the output inventory """
+    extents = {}
+    if 'time' in ds.variables:
+        times = np.atleast_1d(ds['time'].values)
+        extents.update(ntime = len(times), start_time = str(times[0]), end_time = str(times[-1]))
+    for coordinate in ['lat', 'lon']:
+        if coordinate in ds.variables:
+            extents[coordinate + '_min'] = float(ds[coordinate].min())
+            extents[coordinate + '_max'] = float(ds[coordinate].max())
+    return extents
+
+def _record_in_inventory(inventory_file, output_file, ds, statistics, source_files = None):
+    """ Adds an output file to the inventory, with its computed summary statistics and the coordinate extents of ds """
+    record = _coordinate_extents(ds)
+    record['value_min'] = float(statistics['value_min'])
+    record['value_max'] = float(statistics['value_max'])
+    record['value_mean'] = float(statistics['value_mean'])
+    record['nan_count'] = int(statistics['nan_count'])
+    if source_files is None:
+        source_files = ds.attrs.get('artmip_cmip6_source_files')
+    record['source_files'] = source_files
+    output_inventory.record_output_file(inventory_file, output_file, record)
+
+# the ways in which the integrals of a triplet can be calculated (see calculate_artmip_vertical_integrals())
+engines = ['dask', 'numpy']
+
+class _BlockStatistics:
+    """ Accumulates the summary statistics of an output variable (see _summary_statistics()) one block at a time """
+    def __init__(self):
+        self.value_min = np.inf
+        self.value_max = -np.inf
+        self.value_sum = 0.0
+        self.num_values = 0
+        self.nan_count = 0
+        
+    def update(self, values):
+        """ Adds a block of values """
+        num_nan = int(np.count_nonzero(np.isnan(values)))
+        self.nan_count += num_nan
+        if num_nan == values.size:
+            return
+        self.value_min = min(self.value_min, float(np.nanmin(values)))
+        self.value_max = max(self.value_max, float(np.nanmax(values)))
+        self.value_sum += float(np.nansum(values))
+        self.num_values += values.size - num_nan
+        
+    def statistics(self):
+        """ Returns the statistics as a dict """
+        if self.num_values == 0:
+            return dict(value_min = np.nan, value_max = np.nan, value_mean = np.nan, nan_count = self.nan_count)
+        return dict(value_min = self.value_min,
+                    value_max = self.value_max,
+                    value_mean = self.value_sum/self.num_values,
+                    nan_count = self.nan_count)
+
+def _read_block(nc_variable, start, stop, mask = None):
+    """ Reads time steps [start, stop) of a netCDF4 variable, with its _FillValue and missing_value values set to NaN
+        (as xarray decodes them), using mask as scratch space """
+    values = nc_variable[start:stop]
+    if values.dtype.kind != 'f':
+        return values
+    
+    # missing_value may be a list of values; compare in the variable's type (e.g., float32(1e20) != 1e20)
+    missing_values = set()
+    for attribute in ['_FillValue', 'missing_value']:
+        if attribute in nc_variable.ncattrs():
+            missing_values.update([ values.dtype.type(value) for value in np.ravel(nc_variable.getncattr(attribute)) ])
+    for missing_value in missing_values:
+        if mask is None:
+            mask = np.empty(values.shape, dtype = bool)
+        np.equal(values, missing_value, out = mask)
+        values[mask] = np.nan
+    return values
+
+def calculate_triplet_numpy(hus_file,
+                            ua_file,
+                            va_file,
+                            output_files,
+                            time_slice = None,
+                            chunk_size = 32,
+                            memory_per_rank = None,
+                            coefficient_file = None,
+                            temp_dir = None,
+                            temp_file_prefix = "tmp",
+                            inventory_file = None,
+                            output_profile = 'none',
+                            do_clobber = False,
+                            be_verbose = True,
+                            metrics = None,
+                            background_executor = None,
+                            on_finished = None):
+    """ Calculates prw, windhusavi, uhusavi, and vhusavi for a triplet without dask, streaming through the files.
+    
+        input:
+        ------
+        
+            hus_file, ua_file, va_file : the input files; ua_file and va_file may be ""
+            
+            output_files     : the output files of prw, windhusavi, uhusavi, and vhusavi (in that order;
+                               see get_output_file_names())
+                               
+            time_slice       : (optional) a (start, stop) slice along the time dimension to calculate
+            
+            chunk_size       : the number of time steps read, calculated, and written at once
+            
+            memory_per_rank  : (optional) a memory budget from which to set chunk_size instead
+                               (see get_memory_chunk_size())
+                               
+            coefficient_file, temp_dir, temp_file_prefix, inventory_file, output_profile, do_clobber, be_verbose,
+            metrics, background_executor, on_finished :
+                               see calculate_artmip_vertical_integrals(); unless do_clobber is set, output files that
+                               already exist aren't rewritten.  The read, integrate, and write_{variable}
+                               stages are added up over the blocks.  Moving the files into place (and recording
+                               them in the inventory) is handed off to background_executor, if given.
+                               
+        output:
+        -------
+        
+            output_files : the files written
+            
+        Blocks of time steps of hus, ua, va, and ps are read with netCDF4 hyperslabs, integrated into
+        preallocated buffers (see vertical_integral._hybrid_weighted_field()), and appended to all the output
+        files before the next block is read.  Memory use is bounded by the block size, the level dimension
+        is contracted where it lies (no transposed copies), and no task graph is built.  The output files
+        have the same contents as those written by the dask engine.
+    """
+    import netCDF4
+    
+    def vprint(msg):
+        """ Print a message only if be_verbose is True"""
+        if be_verbose:
+            print(msg)
+            
+    if temp_dir is None:
+        temp_dir = os.environ['SCRATCH'] + '/tmp/'
+    if metrics is None:
+        metrics = triplet_metrics.TripletMetrics(",".join([hus_file, ua_file, va_file]))
+            
+    hus_xr = None
+    ua_xr = None
+    va_xr = None
+    temp_files = []
+    try:
+        # open the files lazily, for their metadata and coordinates
+        vprint("Opening " + hus_file)
+        with metrics.stage('open'):
+            hus_xr = xr.open_dataset(hus_file)
+            if ua_file != "":
+                ua_xr = xr.open_dataset(ua_file, decode_times = False)
+            if va_file != "":
+                va_xr = xr.open_dataset(va_file, decode_times = False)
+        with metrics.stage('fix_bcc'):
+            hus_xr, ua_xr, va_xr = fix_bcc_coordinates(hus_xr, ua_xr, va_xr)
+        do_ivt = ua_xr is not None and va_xr is not None
+        variables = artmip_variables if do_ivt else artmip_variables[:1]
+        field_names = ['hus', 'ua', 'va'] if do_ivt else ['hus']
+        # only write the files that don't exist yet, unless clobbering (as the dask engine does)
+        write_variables = [ variable for variable, output_file in zip(variables, output_files) \
+                            if not os.path.exists(output_file) or do_clobber ]
+        write_files = [ output_file for variable, output_file in zip(variables, output_files) if variable in write_variables ]
+    
+        level_dim, model = vertical_integral.get_level_variable_name(hus_xr)
+        dap, db = vertical_integral.hybrid_coefficients(hus_xr, model, coefficient_file)
+    
+        # the integrals have the dimensions of ps
+        ps_dims = hus_xr['ps'].dims
+        field_dims = hus_xr['hus'].dims
+        level_axis = field_dims.index(level_dim)
+        if ps_dims[0] != 'time' or tuple([ dim for dim in field_dims if dim != level_dim ]) != ps_dims:
+            raise ValueError("The dimensions of hus {} and ps {} in {} aren't supported by the numpy engine".format(field_dims, ps_dims, hus_file))
+    
+        start, stop = (0, len(hus_xr['time'])) if time_slice is None else time_slice
+        if memory_per_rank is not None:
+            # the numpy engine works on one block at a time
+            chunk_size = get_memory_chunk_size(hus_xr, 'hus', memory_per_rank, len(field_names), 'einsum', num_threads = 1)
+        chunk_size = max(1, min(chunk_size, stop - start))
+        vprint("Using blocks of {} time steps".format(chunk_size))
+        metrics.set(ntime = stop - start, chunk_size = chunk_size)
+    
+        # create the output files, with all their metadata but no time steps
+        template_xr = hus_xr.drop(['hus']).isel(time = slice(start, start))
+        integral_shape = [chunk_size] + [ hus_xr.sizes[dim] for dim in ps_dims[1:] ]
+        for variable in variables:
+            template_xr[variable] = (ps_dims, np.empty([0] + integral_shape[1:]))
+        set_artmip_attributes(template_xr, hus_file, ua_file, va_file, time_slice)
+        dim_sizes = dict(template_xr.sizes, time = stop - start)
+    
+        for variable, output_file in zip(write_variables, write_files):
+            vprint("Writing " + output_file)
+            ds = template_xr.drop([ var for var in variables if var != variable ])
+            fix_fill_values(ds, variable)
+            ds = apply_output_profile(ds, variable, output_profile, dim_sizes)
+            os.makedirs(os.path.dirname(output_file), exist_ok = True)
+            temp_file = tempfile.NamedTemporaryFile(dir = temp_dir,
+                                                    prefix = temp_file_prefix,
+                                                    suffix = '.nc',
+                                                    delete = False)
+            temp_files.append(temp_file.name)
+            with metrics.stage('write_' + variable):
+                ds.to_netcdf(temp_file.name, unlimited_dims = ["time"])
+        
+        # the other time-dependent variables (e.g., time, time_bnds, ps) are copied from hus as they are stored
+        copy_names = [ var for var in template_xr.variables if 'time' in template_xr[var].dims and var not in variables ]
+    
+        with metrics.stage('open'):
+            input_ncs = [ netCDF4.Dataset(input_file) for input_file in [hus_file, ua_file, va_file][:len(field_names)] ]
+            output_ncs = [ netCDF4.Dataset(temp_file, 'a') for temp_file in temp_files ]
+        for nc in input_ncs:
+            nc.set_auto_mask(False)
+        for name in copy_names:
+            input_ncs[0][name].set_auto_maskandscale(False)
+            for output_nc in output_ncs:
+                output_nc[name].set_auto_maskandscale(False)
+    
+        # preallocate the buffers
+        fields_shape = [chunk_size] + [ hus_xr.sizes[dim] for dim in field_dims[1:] ]
+        mask_buffer = np.empty(fields_shape, dtype = bool)
+        hus_dp_buffer = np.empty(fields_shape)
+        integral_buffers = { variable : np.empty(integral_shape) for variable in variables }
+        block_statistics = { variable : _BlockStatistics() for variable in variables }
+        packed_ranges = {}
+        if get_output_profile(output_profile).get('pack', False):
+            packed_ranges = { variable : get_packed_range(variable) for variable in variables }
+    
+        try:
+            for block_start in range(start, stop, chunk_size):
+                block_stop = min(block_start + chunk_size, stop)
+                nblock = block_stop - block_start
+            
+                # read the block
+                with metrics.stage('read'):
+                    ps = _read_block(input_ncs[0]['ps'], block_start, block_stop)
+                    fields = [ _read_block(nc[name], block_start, block_stop, mask_buffer[:nblock]) \
+                               for nc, name in zip(input_ncs, field_names) ]
+                    copy_values = { name : input_ncs[0][name][block_start:block_stop] for name in copy_names }
+                integrals = { variable : integral_buffers[variable][:nblock] for variable in variables }
+            
+                # calculate the integrals
+                with metrics.stage('integrate'):
+                    # weight hus by the layer mass once, and contract it with each wind component
+                    hus_dp = vertical_integral._hybrid_weighted_field(ps, fields[0], dap = dap, db = db, level_axis = level_axis,
+                                                                      out = hus_dp_buffer[:nblock])
+                    np.sum(hus_dp, axis = level_axis, out = integrals['prw'])
+                    if do_ivt:
+                        vertical_integral._level_contraction(hus_dp, fields[1], level_axis = level_axis, out = integrals['uhusavi'])
+                        vertical_integral._level_contraction(hus_dp, fields[2], level_axis = level_axis, out = integrals['vhusavi'])
+                        np.hypot(integrals['uhusavi'], integrals['vhusavi'], out = integrals['windhusavi'])
+                
+                # append the block to the output files
+                for variable, output_nc in zip(write_variables, output_ncs):
+                    with metrics.stage('write_' + variable):
+                        values = integrals[variable]
+                        if variable in packed_ranges:
+                            np.clip(values, *packed_ranges[variable], out = values)
+                        if inventory_file is not None:
+                            block_statistics[variable].update(values)
+                        output_nc[variable][block_start - start:block_stop - start] = np.ma.masked_invalid(values, copy = False)
+                        for name in copy_names:
+                            output_nc[name][block_start - start:block_stop - start] = copy_values[name]
+        finally:
+            for nc in input_ncs + output_ncs:
+                nc.close()
+    except Exception:
+        # don't leave partly written files (or open input files) behind
+        for temp_file in temp_files:
+            try:
+                os.remove(temp_file)
+            except OSError:
+                pass
+        for input_xr in [hus_xr, ua_xr, va_xr]:
+            if input_xr is not None:
+                input_xr.close()
+        raise
+            
+    def finish_moves():
+        """ Move the files into place, and record them in the inventory"""
+        try:
+            for variable, temp_file, output_file in zip(write_variables, temp_files, write_files):
+                metrics.add('bytes_written', os.path.getsize(temp_file))
+                with metrics.stage('move_' + variable):
+                    move_into_place(temp_file, output_file)
+                if inventory_file is not None and time_slice is None:
+                    with metrics.stage('inventory'):
+                        _record_in_inventory(inventory_file, output_file, hus_xr, block_statistics[variable].statistics(),
+                                             source_files = template_xr.attrs['artmip_cmip6_source_files'])
+        finally:
+            for input_xr in [hus_xr, ua_xr, va_xr]:
+                if input_xr is not None:
+                    input_xr.close()
+                    
+    def finish_moves_in_background():
+        """ Run finish_moves(), reporting its outcome (including any error, since there is no caller to raise it to) to on_finished"""
+        error = None
+        try:
+            finish_moves()
+        except Exception as move_error:
+            traceback.print_exc()
+            error = move_error
+        if on_finished is not None:
+            on_finished(list(output_files), error)
+            
+    if background_executor is None:
+        finish_moves()
+        metrics.end_foreground()
+        if on_finished is not None:
+            on_finished(list(output_files), None)
+    else:
+        metrics.end_foreground()
+        background_executor.submit(finish_moves_in_background)
+            
+    return list(output_files)
+
+def _get_time_slice_fraction(triplet_line):
+    """ Returns the fraction of the time steps in a triplet line's files that are covered by its time slice """
+    hus_file, _, _, time_slice = parse_triplet_line(triplet_line)
+    if time_slice is None:
+        return 1.0
+    return (time_slice[1] - time_slice[0])/get_time_length(hus_file)
+
+def get_triplet_file_size(triplet_line):
+    """ Returns the total size [bytes] of the files in a triplet line (see calculate_artmip_vertical_integrals()).
+    
+        Missing files are counted as having zero size.  If the line has a time slice, only the
+        size of the slice is counted.
+    """
+    hus_file, ua_file, va_file, _ = parse_triplet_line(triplet_line)
+    total_size = 0
+    for input_file in [hus_file, ua_file, va_file]:
+        if input_file != "" and os.path.exists(input_file):
+            total_size += os.path.getsize(input_file)
+    if total_size > 0:
+        total_size = int(total_size*_get_time_slice_fraction(triplet_line))
+    return total_size
+
+def get_triplet_element_count(triplet_line):
+    """ Returns the total number of values (ntime x nlev x nlat x nlon) of hus, ua, and va in a triplet line.
+    
+        Only the file headers are read.  Missing files are counted as having no values.  If the line
+        has a time slice, only the values in the slice are counted.
+    """
+    hus_file, ua_file, va_file, time_slice = parse_triplet_line(triplet_line)
+    total_count = 0
+    for input_file, variable in zip([hus_file, ua_file, va_file], ['hus', 'ua', 'va']):
+        if input_file != "" and os.path.exists(input_file):
+            with xr.open_dataset(input_file, decode_coords = False, decode_times = False) as input_xr:
+                if time_slice is not None:
+                    input_xr = input_xr.isel(time = slice(*time_slice))
+                total_count += input_xr[variable].size
+    return total_count
+
+# functions for estimating the relative cost of processing a triplet line
+triplet_cost_functions = dict(bytes = get_triplet_file_size,
+                              elements = get_triplet_element_count)
+
 def calculate_artmip_vertical_integrals(triplet_line,
                                         one_timestep_test = False,
                                         write_output_files = True,
-                                        original_base = "/global/cscratch1/sd/cmip6/CMIP6/",
-                                        output_base = os.environ['SCRATCH'] + '/ARTMIP_CMIP6/',
+                                        original_base = default_original_base,
+                                        output_base = default_output_base,
                                         do_clobber = False,
                                         be_verbose = True,
                                         no_return_xarray = True,
                                         default_chunk_size = 32,
                                         do_write_progress_bar = False,
+                                        write_all_at_once = True,
+                                        coefficient_file = None,
+                                        integration_method = 'einsum',
+                                        temp_dir = None,
+                                        temp_file_prefix = "tmp",
+                                        inventory_file = None,
+                                        output_profile = 'none',
+                                        output_format = 'netcdf',
+                                        memory_per_rank = None,
+                                        num_threads = None,
+                                        engine = 'dask',
+                                        input_datasets = None,
+                                        background_executor = None,
+                                        on_finished = None,
+                                        metrics = None,
                                        ):
     """ Calculates prw, windhusavi, uhusavi, and vhusavi on CMIP6 output.
     
@@ -30,6 +1353,11 @@ def calculate_artmip_vertical_integrals(triplet_line,
                                and wind variables.  hus_file must be present, but ua_file and va_file need not be.
                                If either wind field is missing, *husavi will not be calculated.
                                
+                               Two further fields, the start and stop indices of a time slice, may be given
+                               (see split_triplet_line()).  In this case, only the time slice is calculated, and
+                               it is written to part files (see get_part_file_name()) that can later be combined
+                               with merge_time_slices().
+                               
             one_timestep_test : flags whether to run on only one timestep of input; useful for testing.
                                
             write_output_files : flags whether to write output files to disk.  The following options are ignored
@@ -45,10 +1373,77 @@ def calculate_artmip_vertical_integrals(triplet_line,
             
             no_return_xarray : flags whether to return artmip_xr
 
-            default_chunk_size : the default chunk size to pass to xarray for dask
+            default_chunk_size : the default number of time steps per dask chunk (rounded to a multiple of the
+                                 files' native time chunk size; see open_input_file())
 
             do_write_progress_bar : flags whether to write a dask progress bar during writing
+
+            write_all_at_once : flags whether to write all output files with a single dask computation;
+                                this avoids recalculating (and rereading the input for) the integrals for
+                                each output file
+
+            coefficient_file : (optional) a .npz file in which to cache the hybrid coefficients of each model
+                               between runs (see vertical_integral.hybrid_coefficients())
+
+            integration_method : the method used to calculate the integrals: 'einsum' or 'multiply'
+                                 (see vertical_integral.integrate_artmip())
+
+            temp_dir         : the directory to which output files are written before being moved into place.
+                               Defaults to $SCRATCH/tmp/
+
+            temp_file_prefix : the prefix of the temporary file names (see task_ledger.temp_file_prefix())
+
+            inventory_file   : (optional) an SQLite file in which to record each output file, along with its size,
+                               coordinate extents, and min/max/mean/NaN count (see output_inventory).  The statistics
+                               are calculated in the same dask computation as the writes.  Time slice part files
+                               are not recorded.
+
+            output_profile   : the netCDF4 encoding (compression, chunk shape, int16 packing) of the output files;
+                               the name of a profile in output_encoding_profiles or a custom profile dict
+                               (see apply_output_profile())
+
+            output_format    : 'netcdf' to write a file per variable, or 'zarr' to write this triplet's time region
+                               into a Zarr store per variable (see get_zarr_store_name()); the stores must already
+                               exist (see initialize_zarr_store()).  output_profile and inventory_file don't apply
+                               to Zarr output, and time slices are written directly into their region of the store
+                               (no merge is needed).  Unless do_clobber is set, triplets whose region is already
+                               recorded as written in every store are skipped (see zarr_region_written()).
+
+            memory_per_rank  : (optional) the memory budget of the rank (shared by its dask threads), in bytes or as a
+                               string (e.g., '12GB'); if given, default_chunk_size is ignored, and the time chunk size
+                               is the largest that fits in the budget for this model's resolution and the number of
+                               dask threads (see get_memory_chunk_size())
+
+            num_threads      : (optional) the number of dask threads to use (see configure_threads()); note that this
+                               sets the dask configuration of the whole process.  If None, the current dask
+                               configuration is used.
+
+            engine           : 'dask' to calculate with xarray and dask, or 'numpy' to stream through the files in
+                               blocks of default_chunk_size time steps without dask (see calculate_triplet_numpy()).
+                               The numpy engine only writes netCDF files, and ignores one_timestep_test,
+                               write_all_at_once, and do_write_progress_bar.
+
+            input_datasets   : (optional) the output of open_triplet() for triplet_line, e.g., from opening the files
+                               ahead of time; the files are opened here if this is None
+                               
+            background_executor : (optional) a concurrent.futures executor (e.g., a ThreadPoolExecutor with one
+                               thread) to which moving the netCDF output files into place (and recording them in
+                               the inventory) is handed off, so that this function can return once the files are
+                               written.  The caller must wait for the executor before relying on the files.
                                
+            on_finished      : (optional) a function, on_finished(output_file_list, error), called once the output
+                               files are in place (error is None), or with the exception if moving them failed in
+                               background_executor
+                               
+            metrics          : (optional) a triplet_metrics.TripletMetrics in which to record the time spent in each
+                               stage (open, fix_bcc, integrate, write, move_{variable}, ...), the bytes read and
+                               written, the number of time steps, and the number of dask tasks.  With the dask engine,
+                               the integrate stage only builds the task graph; the integrals are calculated (and the
+                               input is read) in the write stage.  Stages done in background_executor are recorded
+                               before on_finished is called, and the foreground part of the work (including the peak RSS) is
+                               measured before the moves are handed off (or, without background_executor, before
+                               on_finished is called).  The model, simulation, ensemble, engine, and bytes read are
+                               only recorded if metrics is given, and not for skipped triplets.
             
         output:
         -------
@@ -75,76 +1470,108 @@ def calculate_artmip_vertical_integrals(triplet_line,
         if be_verbose:
             print(msg)
     
+    if num_threads is not None:
+        configure_threads(num_threads)
+        
+    if engine not in engines:
+        raise ValueError("Unknown engine `{}`; expected one of {}".format(engine, engines))
+    if engine == 'numpy' and (not write_output_files or output_format != 'netcdf'):
+        raise ValueError("The numpy engine can only write netCDF output files")
+    
     # extract the file paths from the triplet line
-    hus_file, ua_file, va_file = triplet_line.rstrip().split(',')
+    hus_file, ua_file, va_file, time_slice = parse_triplet_line(triplet_line)
+    
+    # (the triplet is only described in its metrics record if a record is kept)
+    record_metrics = metrics is not None
+    if metrics is None:
+        metrics = triplet_metrics.TripletMetrics(triplet_line)
+    metrics.add('bytes_written', 0)
     
     # set output file names
     output_file_list = []
     if write_output_files:
         
-        # parse the hus file path
-        output_file_template = hus_file.replace(original_base, output_base)
-        output_file_template = output_file_template.replace('hus', '{variable}')
+        if output_format not in output_formats:
+            raise ValueError("Unknown output format `{}`; expected one of {}".format(output_format, output_formats))
         
-        # set the expected prw file name
-        prw_output_file = os.path.abspath(output_file_template.format(variable = 'prw'))
-        output_file_list.append(prw_output_file)
-        
-        # set the expected *husavi file names, if we are calculating these variables
+        # set the expected file names; *husavi files are only included if we are calculating these variables
+        final_file_list = get_output_file_names(triplet_line, original_base, output_base)
+        if output_format == 'zarr':
+            final_file_list = [ get_zarr_store_name(ofile) for ofile in final_file_list ]
+            output_file_list = list(final_file_list)
+        elif time_slice is not None:
+            output_file_list = [ get_part_file_name(ofile, time_slice) for ofile in final_file_list ]
+        else:
+            output_file_list = list(final_file_list)
+            
+        prw_output_file = output_file_list[0]
         windhusavi_output_file = None
         uhusavi_output_file = None
         vhusavi_output_file = None
-        if ua_file != "" and va_file != "":
-            windhusavi_output_file = os.path.abspath(output_file_template.format(variable = 'windhusavi'))
-            uhusavi_output_file = os.path.abspath(output_file_template.format(variable = 'uhusavi'))
-            vhusavi_output_file = os.path.abspath(output_file_template.format(variable = 'vhusavi'))
-            
-            # append the file names to the output file list
-            output_file_list.append(windhusavi_output_file)
-            output_file_list.append(uhusavi_output_file)
-            output_file_list.append(vhusavi_output_file)
+        if len(output_file_list) > 1:
+            windhusavi_output_file, uhusavi_output_file, vhusavi_output_file = output_file_list[1:]
             
         # if we aren't overwriting files and the expected files already exist, simply return
-        if all([ os.path.exists(ofile) for ofile in output_file_list]) and not do_clobber:
+        # (Zarr stores exist before any of their regions are written, so their record of written regions is checked)
+        if output_format == 'zarr':
+            already_written = all([ zarr_region_written(store, triplet_line) for store in output_file_list ])
+        else:
+            already_written = all([ os.path.exists(ofile) for ofile in output_file_list]) or \
+                              all([ os.path.exists(ofile) for ofile in final_file_list])
+        if already_written and not do_clobber:
+            if input_datasets is not None:
+                for input_xr in input_datasets[:3]:
+                    if input_xr is not None:
+                        input_xr.close()
+            metrics.set(skipped = True)
+            metrics.end_foreground()
+            if on_finished is not None:
+                on_finished(output_file_list, None)
             if no_return_xarray:
                 return output_file_list
             else:
                 return output_file_list, None
             
-    vprint("Opening " + hus_file)
-    # open the hus, ua, and va files (if ua and va are available)
-    hus_xr = xr.open_dataset(hus_file,
-                             decode_coords = False,
-                             decode_times = False,
-                            )
-    # check whether the current chunk size will cause the read to overflow
-    chunk_size = default_chunk_size
-    if chunk_size > len(hus_xr['time']):
-        chunk_size = len(hus_xr['time'])
-    # trigger dask usage by chunking in time
-    hus_xr = hus_xr.chunk({'time': chunk_size})
-    hus_xr = xr.decode_cf(hus_xr, decode_coords = True, decode_times = True)
+    # describe the triplet in its metrics record (after the skip check, since this stats each input file)
+    if record_metrics:
+        file_fields = output_inventory.parse_output_file_name(hus_file)
+        metrics.set(model = file_fields['model'],
+                    simulation = file_fields['simulation'],
+                    ensemble = file_fields['ensemble'],
+                    engine = engine,
+                    bytes_read = get_triplet_file_size(triplet_line))
+            
+    if engine == 'numpy':
+        calculate_triplet_numpy(hus_file, ua_file, va_file, output_file_list,
+                                time_slice = time_slice,
+                                chunk_size = default_chunk_size,
+                                memory_per_rank = memory_per_rank,
+                                coefficient_file = coefficient_file,
+                                temp_dir = temp_dir,
+                                temp_file_prefix = temp_file_prefix,
+                                inventory_file = inventory_file,
+                                output_profile = output_profile,
+                                do_clobber = do_clobber,
+                                be_verbose = be_verbose,
+                                metrics = metrics,
+                                background_executor = background_executor,
+                                on_finished = on_finished)
+        vprint("Done with {}".format(os.path.basename(hus_file)))
+        if no_return_xarray:
+            return output_file_list
+        else:
+            return output_file_list, None
     
-    ua_xr = None
-    va_xr = None
-    if ua_file != "":
-        vprint("Opening " + ua_file)
-        ua_xr = xr.open_dataset(ua_file,
-                                decode_coords = False,
-                                decode_times = False,
-                               )
-        # trigger dask usage by chunking in time
-        ua_xr = ua_xr.chunk({'time': chunk_size})
-        ua_xr = xr.decode_cf(ua_xr, decode_coords = True, decode_times = True)
-    if va_file != "":
-        vprint("Opening " + va_file)
-        va_xr = xr.open_dataset(va_file,
-                                decode_coords = False,
-                                decode_times = False,
-                               )
-        # trigger dask usage by chunking in time
-        va_xr = va_xr.chunk({'time': chunk_size})
-        va_xr = xr.decode_cf(va_xr, decode_coords = True, decode_times = True)
+    # open the hus, ua, and va files (if ua and va are available); times are only decoded for hus
+    if input_datasets is None:
+        vprint("Opening " + hus_file)
+        with metrics.stage('open'):
+            input_datasets = open_triplet(triplet_line,
+                                          default_chunk_size,
+                                          memory_per_rank = memory_per_rank,
+                                          integration_method = integration_method)
+    hus_xr, ua_xr, va_xr, chunk_size = input_datasets
+    vprint("Using chunks of {} time steps".format(chunk_size))
     
     if one_timestep_test:
         hus_xr = hus_xr.isel(time = 0).load()
@@ -152,126 +1579,135 @@ def calculate_artmip_vertical_integrals(triplet_line,
             ua_xr = ua_xr.isel(time = 0).load()
         if va_xr is not None:
             va_xr = va_xr.isel(time = 0).load()
+    metrics.set(ntime = int(hus_xr['time'].size), chunk_size = chunk_size)
 
     # deal with possibly corrupt coordinates in the BCC dataset
-    _, model = vertical_integral.get_level_variable_name(hus_xr)
-    if model == 'BCC-CSM2-MR':
-        # check if we are dealing with corrupted BCC files
-        if float(hus_xr['lev'].isel(lev = 0).values) == 0.0 or \
-           float(ua_xr['lev'].isel(lev = 0).values) == 0.0 or \
-           float(va_xr['lev'].isel(lev = 0).values) == 0.0:
-            # attempt to open a file containing the BCC coordinates
-            bcc_coord_file = f"{os.path.dirname(os.path.abspath(__file__))}/bcc_ref_coords.nc"
-            if os.path.exists(bcc_coord_file):
-                bcc_coords_xr = xr.open_dataset(bcc_coord_file)
-                lev = bcc_coords_xr['lev']
-                lat = bcc_coords_xr['lat']
-                lon = bcc_coords_xr['lon']
-                # overwrite coordinates in the datasets being multiplied
-                hus_xr = hus_xr.assign_coords(lat = lat, lon = lon, lev = lev)
-                ua_xr = ua_xr.assign_coords(lat = lat, lon = lon, lev = lev)
-                va_xr = va_xr.assign_coords(lat = lat, lon = lon, lev = lev)
-                # overwrite the a/b coordinates
-                hus_xr['a_bnds'] = bcc_coords_xr['a_bnds']
-                ua_xr['a_bnds'] = bcc_coords_xr['a_bnds']
-                va_xr['a_bnds'] = bcc_coords_xr['a_bnds']
-                hus_xr['b_bnds'] = bcc_coords_xr['b_bnds']
-                ua_xr['b_bnds'] = bcc_coords_xr['b_bnds']
-                va_xr['b_bnds'] = bcc_coords_xr['b_bnds']
-
-
-    
-    # calculate iwv
-    vprint("Calculating IWV on {}".format(os.path.basename(hus_file)))
-    artmip_xr = vertical_integral.integrate(hus_xr, variables = ['hus'])
+    with metrics.stage('fix_bcc'):
+        hus_xr, ua_xr, va_xr = fix_bcc_coordinates(hus_xr, ua_xr, va_xr)
     
-    # set metadata for the vertical integral of hus
-    artmip_xr = artmip_xr.rename(dict(hus = 'prw'))
-    artmip_xr['prw'].attrs['long_name'] = "Integrated Water Vapor"
-    artmip_xr['prw'].attrs['units'] = "kg/m2"
-
-    # attempt to calculate ivt
+    # calculate iwv and (if ua and va are available) ivt in a single pass through the data
     if ua_xr is not None and va_xr is not None:
-        vprint("Calculating IVT on {}".format(os.path.basename(hus_file)))
-        artmip_xr['uhusavi'] = vertical_integral.safe_multiply(ua_xr, hus_xr, 'ua', 'hus')
-        artmip_xr['vhusavi'] = vertical_integral.safe_multiply(va_xr, hus_xr, 'va', 'hus')
-        
-        # integrate the components of IVT
-        artmip_xr = vertical_integral.integrate(artmip_xr, variables = ['uhusavi', 'vhusavi'])
-        
-        # combine the components of IVT
-        artmip_xr['windhusavi'] = np.sqrt(artmip_xr['uhusavi']**2 + artmip_xr['vhusavi']**2)
-        
-        # set metadata
-        artmip_xr['windhusavi'].attrs['long_Name'] = "Integrated Vapor Transport"
-        artmip_xr['windhusavi'].attrs['units'] = "kg/m/s"
-        
-        artmip_xr['uhusavi'].attrs['long_Name'] = "Northward Integrated Vapor Transport"
-        artmip_xr['uhusavi'].attrs['units'] = "kg/m/s"
+        vprint("Calculating IWV and IVT on {}".format(os.path.basename(hus_file)))
+    else:
+        vprint("Calculating IWV on {}".format(os.path.basename(hus_file)))
+    with metrics.stage('integrate'):
+        artmip_xr = vertical_integral.integrate_artmip(hus_xr, ua_xr, va_xr,
+                                                       coefficient_file = coefficient_file,
+                                                       method = integration_method)
+    
+    # set metadata
+    set_artmip_attributes(artmip_xr, hus_file, ua_file, va_file, time_slice)
+    
+    if write_output_files and output_format == 'zarr':
+        with metrics.stage('write'):
+            write_zarr_regions(artmip_xr,
+                               output_file_list,
+                               chunk_size = chunk_size,
+                               do_write_progress_bar = do_write_progress_bar,
+                               be_verbose = be_verbose,
+                               triplet_line = triplet_line)
         
-        artmip_xr['vhusavi'].attrs['long_Name'] = "Eastward Integrated Vapor Transport"
-        artmip_xr['vhusavi'].attrs['units'] = "kg/m/s"
+        # close input files to avoid netCDF file handle limit issues
+        hus_xr.close()
+        if ua_xr is not None:
+            ua_xr.close()
+        if va_xr is not None:
+            va_xr.close()
+            
+    elif write_output_files:
         
+        if temp_dir is None:
+            temp_dir = os.environ['SCRATCH'] + '/tmp/'
         
-    # add metadata about the git repository
-    artmip_xr.attrs['artmip_cmip6_source_files'] = triplet_line.rstrip()
-    artmip_xr.attrs['artmip_cmip6_integral_script'] = os.path.abspath(__file__)
-    artmip_xr.attrs['artmip_cmip6_integral_calculation_date'] = str(dt.datetime.today())
-    try:
-        import git
-        _repo = git.Repo(search_parent_directories=True)
-        _git_sha = _repo.head.object.hexsha
-        _git_short_sha = _repo.git.rev_parse(_git_sha, short=7)
-        _git_branch = _repo.active_branch
-        artmip_xr.attrs['artmip_script_repo'] = "https://bitbucket.org/lbl-cascade/cmip6_artmip_integrals.git"
-        artmip_xr.attrs['artmip_script_branch'] = "{}".format(_git_branch)
-        artmip_xr.attrs['artmip_script_rev'] = "{}".format(_git_short_sha)
-    except:
-        pass
-    
-    if write_output_files:
-        
-        # turn off fill values
-        fill_value = 1e20
         unlimited_dims = ["time"]
         
-        def fix_fill_values(ds, variable):
-            """ Fix fill values in xarray output"""
-            for var in ds.variables:
-                if var == variable:
-                    ds[var].encoding['_FillValue'] = fill_value
-                else:
-                    ds[var].encoding['_FillValue'] = None 
-        
         def ensure_output_dir_exists(output_file):
             """ Make sure that the given output directory exists"""
             output_dir = os.path.dirname(output_file)
             os.makedirs(output_dir, exist_ok = True)
             
-        def safe_write_netcdf(ds, output_file):
-            """ Write an xarray dataset to netCDF; final file won't be in place until writing is complete."""
+        # datasets whose writes are deferred until write_pending_netcdf() is called
+        pending_writes = []
+        # files that have been written, but still need to be moved into place by finish_writes()
+        written_files = []
+        
+        def compute_writes(delayed_objs, stage):
+            """ Compute a list of delayed writes in a single dask computation (using a progress bar or not), timed as the given stage"""
+            metrics.add('dask_tasks', len(dask.base.collections_to_dsk(delayed_objs, optimize_graph = False)))
+            with metrics.stage(stage):
+                if do_write_progress_bar:
+                    with ProgressBar():
+                        results = dask.compute(*delayed_objs)
+                else:
+                    results = dask.compute(*delayed_objs)
+            return results
+            
+        def finish_write(ds, temp_file_name, output_file, variable, statistics):
+            """ Close the dataset, move the temporary file into place, and record the file in the inventory"""
+            # close the file
+            ds.close()
+            metrics.add('bytes_written', os.path.getsize(temp_file_name))
+            
+            # move the temporary file
+            with metrics.stage('move_' + variable):
+                move_into_place(temp_file_name, output_file)
+            
+            if inventory_file is not None and time_slice is None:
+                with metrics.stage('inventory'):
+                    _record_in_inventory(inventory_file, output_file, ds, statistics)
+            
+        def safe_write_netcdf(ds, output_file, variable):
+            """ Write an xarray dataset to netCDF; final file won't be in place until writing is complete.
+            
+                If write_all_at_once is True, the write is only set up here and is done by write_pending_netcdf()
+            """
             vprint("Writing " + output_file)
             # create a temporary file to which to write
-            temp_file = tempfile.NamedTemporaryFile(dir = os.environ['SCRATCH'] + '/tmp/',
+            temp_file = tempfile.NamedTemporaryFile(dir = temp_dir,
+                                                    prefix = temp_file_prefix,
                                                     suffix = '.nc',
                                                     delete = False)
             # write the file to disk
             delayed_obj = ds.to_netcdf(temp_file.name,
                                        compute = False,
                                        unlimited_dims = unlimited_dims)
+            
+            # set up the summary statistics for the inventory, so they are calculated along with the write
+            statistics = {}
+            if inventory_file is not None and time_slice is None:
+                statistics = _summary_statistics(ds, variable)
+            
+            if write_all_at_once:
+                pending_writes.append((ds, temp_file.name, output_file, variable, delayed_obj, statistics))
+                return
 
-            # do the writing (using a progress bar or not)
-            if do_write_progress_bar:
-                with ProgressBar():
-                    results = delayed_obj.compute()
-            else:
-                results = delayed_obj.compute()
+            # do the writing
+            results = compute_writes([delayed_obj] + list(statistics.values()), 'write_' + variable)
+            statistics = dict(zip(statistics.keys(), results[1:]))
 
-            # close the file
-            ds.close()
+            written_files.append((ds, temp_file.name, output_file, variable, statistics))
             
-            # move the temporary file
-            shutil.move(temp_file.name, output_file)
+        def write_pending_netcdf():
+            """ Do all deferred writes with one dask computation, so that intermediates shared among the files are only calculated once."""
+            if len(pending_writes) == 0:
+                return
+            
+            # do the writing (and calculate the summary statistics)
+            delayed_objs = []
+            for _, _, _, _, delayed_obj, statistics in pending_writes:
+                delayed_objs += [delayed_obj] + list(statistics.values())
+            # (the variables share one computation, so they are timed together)
+            results = list(compute_writes(delayed_objs, 'write'))
+            
+            for ds, temp_file_name, output_file, variable, _, statistics in pending_writes:
+                # get this file's results
+                file_results = results[:1 + len(statistics)]
+                del results[:1 + len(statistics)]
+                statistics = dict(zip(statistics.keys(), file_results[1:]))
+                
+                written_files.append((ds, temp_file_name, output_file, variable, statistics))
+                
+            del pending_writes[:]
         
         # write the prw file
         if not os.path.exists(prw_output_file) or do_clobber:
@@ -284,8 +1720,9 @@ def calculate_artmip_vertical_integrals(triplet_line,
             ensure_output_dir_exists(prw_output_file)
             # deal with fill values
             fix_fill_values(prw_xr, "prw")
+            prw_xr = apply_output_profile(prw_xr, "prw", output_profile)
             # write the prw file
-            safe_write_netcdf(prw_xr, prw_output_file)
+            safe_write_netcdf(prw_xr, prw_output_file, "prw")
            
             
         # write the windhusavi file
@@ -298,8 +1735,9 @@ def calculate_artmip_vertical_integrals(triplet_line,
                 # write the windhusavi file
                 # deal with fill values
                 fix_fill_values(windhusavi_xr, "windhusavi")
+                windhusavi_xr = apply_output_profile(windhusavi_xr, "windhusavi", output_profile)
                 # write the windhusavi file
-                safe_write_netcdf(windhusavi_xr, windhusavi_output_file)
+                safe_write_netcdf(windhusavi_xr, windhusavi_output_file, "windhusavi")
                 
                 
         # write the uhusavi file
@@ -311,8 +1749,9 @@ def calculate_artmip_vertical_integrals(triplet_line,
                 ensure_output_dir_exists(uhusavi_output_file)
                 # deal with fill values
                 fix_fill_values(uhusavi_xr, "uhusavi")
+                uhusavi_xr = apply_output_profile(uhusavi_xr, "uhusavi", output_profile)
                 # write the uhusavi file
-                safe_write_netcdf(uhusavi_xr, uhusavi_output_file)
+                safe_write_netcdf(uhusavi_xr, uhusavi_output_file, "uhusavi")
                 
                 
         # write the vhusavi file
@@ -324,9 +1763,12 @@ def calculate_artmip_vertical_integrals(triplet_line,
                 ensure_output_dir_exists(vhusavi_output_file)
                 # deal with fill values
                 fix_fill_values(vhusavi_xr, "vhusavi")
+                vhusavi_xr = apply_output_profile(vhusavi_xr, "vhusavi", output_profile)
                 # write the vhusavi file
-                safe_write_netcdf(vhusavi_xr, vhusavi_output_file)
+                safe_write_netcdf(vhusavi_xr, vhusavi_output_file, "vhusavi")
                 
+        # do any writes that were deferred
+        write_pending_netcdf()
                 
         # close input files to avoid netCDF file handle limit issues
         hus_xr.close()
@@ -334,7 +1776,39 @@ def calculate_artmip_vertical_integrals(triplet_line,
             ua_xr.close()
         if va_xr is not None:
             va_xr.close()
+            
+        def finish_writes():
+            """ Move the written files into place"""
+            for written_file in written_files:
+                finish_write(*written_file)
+                
+        def finish_writes_in_background():
+            """ Run finish_writes(), reporting its outcome (including any error, since there is no caller to raise it to) to on_finished"""
+            error = None
+            try:
+                finish_writes()
+            except Exception as write_error:
+                traceback.print_exc()
+                error = write_error
+            # (called outside the try, so that an error in on_finished itself isn't reported as a failed write)
+            if on_finished is not None:
+                on_finished(output_file_list, error)
+                
+        if background_executor is None:
+            finish_writes()
+            metrics.end_foreground()
+            if on_finished is not None:
+                on_finished(output_file_list, None)
+        else:
+            metrics.end_foreground()
+            background_executor.submit(finish_writes_in_background)
    
+    # (netCDF output reports to on_finished once its files are in place)
+    if not (write_output_files and output_format == 'netcdf'):
+        metrics.end_foreground()
+        if on_finished is not None:
+            on_finished(output_file_list, None)
+        
     vprint("Done with {}".format(os.path.basename(hus_file)))
     
     if no_return_xarray:
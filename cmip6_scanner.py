@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# coding: utf-8
+""" Incrementally scans a CMIP6 directory tree (or the ARTMIP_CMIP6 output tree) for data files.
+
+    The tree is walked level-by-level with os.scandir in parallel threads, and directories are
+    pruned by their data reference syntax (DRS) level (e.g., only 6hrLev/{hus,ua,va}).  The
+    modification time and listing of every visited directory is kept in a state file; since a
+    directory's mtime changes whenever entries are added to or removed from it, only directories
+    whose mtime has changed are listed again on later scans.
+"""
+import os
+import json
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import database
+
+# the levels of the CMIP6 data reference syntax below the CMIP6 root directory; data files are in the last level
+drs_levels = ["activity", "center", "model", "simulation", "ensemble", "group", "variable", "gn", "version"]
+
+def load_state(state_file):
+    """ Loads the directory state saved by `save_state()`; returns an empty state if the file doesn't exist """
+    if state_file is None or not os.path.exists(state_file):
+        return {}
+    with open(state_file) as fin:
+        return json.load(fin)
+
+def save_state(state, state_file):
+    """ Saves the directory state from `scan()`; the file is replaced atomically """
+    state_dir = os.path.dirname(os.path.abspath(state_file))
+    with tempfile.NamedTemporaryFile('w', dir = state_dir, suffix = '.json', delete = False) as fout:
+        json.dump(state, fout)
+    os.replace(fout.name, state_file)
+
+def _list_directory(path, cached_entry, suffix):
+    """ Lists the subdirectories and files (ending with `suffix`) in a directory.
+
+        input:
+        ------
+
+            path         : the directory to list
+
+            cached_entry : the [mtime, subdirectories, files] entry from a previous listing, or None
+
+            suffix       : only files ending with this are listed
+
+        output:
+        -------
+
+            entry, was_listed : the [mtime, subdirectories, files] entry for the directory (None if
+                                the directory no longer exists), and whether the directory was
+                                actually listed (False if the cached entry was still valid)
+    """
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None, False
+
+    if cached_entry is not None and cached_entry[0] == mtime:
+        return cached_entry, False
+
+    subdirs = []
+    files = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                subdirs.append(entry.name)
+            elif entry.name.endswith(suffix):
+                files.append(entry.name)
+
+    return [mtime, sorted(subdirs), sorted(files)], True
+
+def scan(root,
+         filters = None,
+         state = None,
+         max_workers = 16,
+         suffix = '.nc'):
+    """ Finds all data files in a CMIP6 directory tree.
+
+        input:
+        ------
+
+            root        : the CMIP6 root directory (the one containing the activity directories)
+
+            filters     : (optional) a dict mapping DRS level names (see `drs_levels`) to collections
+                          of allowed directory names; other directories at that level are skipped.
+                          e.g., dict(activity = ['CMIP', 'ScenarioMIP'], group = ['6hrLev'], variable = ['hus', 'ua', 'va'])
+
+            state       : (optional) the state returned by a previous scan (or `load_state()`);
+                          directories whose mtime hasn't changed aren't listed again
+
+            max_workers : the number of threads used to list directories
+
+            suffix      : only files ending with this are found
+
+        output:
+        -------
+
+            paths, new_state, num_listed : a sorted list of the absolute paths of the data files,
+                                           the new state, and the number of directories that were listed
+    """
+    if filters is None:
+        filters = {}
+    for level in filters:
+        if level not in drs_levels:
+            raise ValueError("Unknown DRS level `{}`; expected one of {}".format(level, drs_levels))
+    if state is None:
+        state = {}
+
+    root = os.path.join(os.path.abspath(root), '')
+
+    new_state = {}
+    num_listed = 0
+    paths = []
+
+    # walk the tree one level at a time, listing the directories at each level in parallel
+    directories = [""]
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        for depth in range(len(drs_levels) + 1):
+            entries = executor.map(lambda directory: _list_directory(root + directory, state.get(directory), suffix),
+                                   directories)
+
+            next_directories = []
+            for directory, (entry, was_listed) in zip(directories, entries):
+                if entry is None:
+                    continue
+                new_state[directory] = entry
+                num_listed += int(was_listed)
+
+                _, subdirs, files = entry
+                if depth == len(drs_levels):
+                    # this is a version directory; it holds the data files
+                    paths += [ root + os.path.join(directory, filename) for filename in files ]
+                else:
+                    allowed = filters.get(drs_levels[depth])
+                    next_directories += [ os.path.join(directory, subdir) for subdir in subdirs \
+                                          if allowed is None or subdir in allowed ]
+            directories = next_directories
+
+    return sorted(paths), new_state, num_listed
+
+def inventory(root,
+              listing_file,
+              state_file = None,
+              cache_file = None,
+              filters = None,
+              max_workers = 16):
+    """ Updates a file listing (and optionally a database cache) from a scan of a CMIP6 directory tree.
+
+        input:
+        ------
+
+            root         : the CMIP6 root directory (see `scan()`)
+
+            listing_file : the file listing to write, with one path per line (see `database.load()`)
+
+            state_file   : (optional) the file in which to keep the directory state between scans
+
+            cache_file   : (optional) a database cache to update incrementally (see `database.update_cache()`)
+
+            filters      : (optional) see `scan()`
+
+            max_workers  : the number of threads used to list directories
+
+        output:
+        -------
+
+            paths : the list of data files found
+    """
+    # get the previous listing, to find out what has changed
+    old_paths = set()
+    if os.path.exists(listing_file):
+        with open(listing_file) as fin:
+            old_paths = set([ line.rstrip('\n') for line in fin ])
+
+    paths, new_state, num_listed = scan(root, filters, load_state(state_file), max_workers)
+    print("Listed {} of {} directories; found {} files".format(num_listed, len(new_state), len(paths)))
+
+    # write the listing
+    listing_dir = os.path.dirname(os.path.abspath(listing_file))
+    with tempfile.NamedTemporaryFile('w', dir = listing_dir, suffix = '.txt', delete = False) as fout:
+        fout.write("".join([ path + "\n" for path in paths ]))
+    os.replace(fout.name, listing_file)
+
+    if state_file is not None:
+        save_state(new_state, state_file)
+
+    if cache_file is not None:
+        new_paths = set(paths)
+        added_paths = sorted(new_paths - old_paths)
+        removed_paths = sorted(old_paths - new_paths)
+        print("Updating {}: {} files added, {} files removed".format(cache_file, len(added_paths), len(removed_paths)))
+        database.update_cache(cache_file, listing_file, added_paths, removed_paths)
+
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("root", help = "the CMIP6 root directory (containing the activity directories)")
+    parser.add_argument("listing_file", help = "the file listing to write")
+    parser.add_argument("--state-file", default = None, help = "the file in which to keep directory mtimes between scans")
+    parser.add_argument("--cache-file", default = None, help = "a database cache to update incrementally")
+    parser.add_argument("--filter",
+                        action = "append",
+                        default = [],
+                        metavar = "LEVEL=NAME[,NAME...]",
+                        help = "only descend into the named directories at a DRS level ({}); may be repeated".format(", ".join(drs_levels)))
+    parser.add_argument("--workers", type = int, default = 16, help = "the number of threads used to list directories")
+    args = parser.parse_args()
+
+    filters = {}
+    for filter_string in args.filter:
+        level, names = filter_string.split('=', 1)
+        filters[level] = set(names.split(','))
+
+    inventory(args.root,
+              args.listing_file,
+              state_file = args.state_file,
+              cache_file = args.cache_file,
+              filters = filters,
+              max_workers = args.workers)
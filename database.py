@@ -1,11 +1,22 @@
 import pandas as pd
+import numpy as np
 import os
+import weakref
+import json
+import hashlib
+import tempfile
 import datetime as dt
 
 
+# the fields of the paths in a CMIP6 file listing
+listing_columns = ["dum", "d1", "d2", "d3", "d4", "d5", "d6", "center", "model", "simulation", "ensemble", "group", "variable", "gn", "version", "filename"]
+
 def load(
          input_file_list = "/project/projectdirs/m1517/cascade/taobrien/artmip/tier2/cmip6_data_and_inventory/cmip6_list_20190905.txt",
-         cache_file = 'cmip6_list_20190905.pk',
+         cache_file = 'cmip6_list_20190905.parquet',
+         use_categories = True,
+         columns = None,
+         filters = None,
         ):
     """ Loads the database of available CMIP6 data.
     
@@ -16,6 +27,21 @@ def load(
         
             cache_file : a file containing a cached version of the database, for fast loads
                          If this file exists, reading of input_file_list is skipped.
+                         
+                         The format is set by the extension: '.parquet' (Parquet), '.feather' or '.arrow'
+                         (Arrow IPC, which is memory-mapped), or '.pk' (pandas pickle).  Parquet and Arrow
+                         caches record the modification time, size, and a partial hash of input_file_list,
+                         and are rebuilt automatically when it changes; pickle caches are never rebuilt.
+                         
+            use_categories : flags whether to store columns with few unique values (see `categorical_columns`)
+                             as pandas categoricals, which makes the table several times smaller.  Note that
+                             groupby() on categorical columns should be called with observed = True.
+                             
+            columns    : (optional) a list of the columns to load
+            
+            filters    : (optional) a dict of {column : value} or {column : collection of values};
+                         only rows that match all of the filters are loaded.  For Parquet and Arrow
+                         caches, the filters are applied while reading.
             
             
         output:
@@ -25,6 +51,8 @@ def load(
             
             "center", "model", "simulation", "ensemble", "group", "variable", "gn", "version", "base_path" "filename"
             
+            along with "file_id", "startdate", "enddate", and "full_path" (the full path of the file)
+            
             
             If cache_file doesn't already exist, this function attempts to create it.
     
@@ -33,71 +61,425 @@ def load(
     
     # TODO: generalize this to different paths
 
-    if not os.path.exists(cache_file):
-        names = ["dum", "d1", "d2", "d3", "d4", "d5", "d6", "center", "model", "simulation", "ensemble", "group", "variable", "gn", "version", "filename"]
-
+    full_table = None
+    if cache_file is not None and os.path.exists(cache_file):
+        full_table = _read_cache(cache_file, input_file_list, columns, filters)
+        
+    if full_table is None:
         print(f"Reading from {input_file_list}")
         # read the list of files
-        full_table = pd.read_csv(input_file_list, sep = '/', names = names)
+        full_table = pd.read_csv(input_file_list, sep = '/', names = listing_columns, dtype = str)
         # remove the dummy column (the preceeding /)
         full_table = full_table.drop(columns = "dum")
         
-        # reconstruct the base path
-        full_table['base_path'] = full_table.iloc[:,:6].apply(lambda x: '/' + '/'.join(x) + '/', axis = 1)
-        
-        # extract the file ID
-        full_table['file_id'] = full_table.loc[:, "filename"].apply(lambda fn: fn.split('_')[-1].split('.')[0])
-        
-        # remove parts of the path that precede the CMIP6 dataset
-        full_table = full_table.drop(columns = [ 'd{}'.format(i) for i in range(1,7)])
-        
-        def reconstruct_date(x, start = True):
-            try:
-                if start:
-                    datestr = x.split('_')[-1].split('-')[0]
-                else:
-                    datestr = x.split('_')[-1].split('-')[1].split('.')[0]
-            except:
-                return pd.NaT
-
-            if len(datestr) == 4:
-                strptime_string = "%Y"
-            elif len(datestr) == 6:
-                strptime_string = "%Y%m"
-            elif len(datestr) == 8:
-                strptime_string = "%Y%m%d"
-            elif len(datestr) == 10:
-                strptime_string = "%Y%m%d%H"
-            elif len(datestr) == 12:
-                strptime_string = "%Y%m%d%H%M"
-            else:
-                #raise ValueError("Could not parse date: ", datestr)
-                date = pd.NaT
-
-            try:
-                date = dt.datetime.strptime(datestr, strptime_string)
-            except:
-                # if the date can't be parsed, return NaT
-                date = pd.NaT
-
-            return date
-
-        full_table['startdate'] = full_table['filename'].apply( reconstruct_date )
-        full_table['enddate'] = full_table['filename'].apply( lambda x: reconstruct_date(x, start = False) )
+        full_table = _add_derived_columns(full_table, use_categories = use_categories)
 
         # Attempt to save the cache file
         if cache_file is not None:
             try:
-                full_table.to_pickle(cache_file)
+                _save_cache(full_table, cache_file, input_file_list)
             except:
                 pass
+            
+        full_table = _apply_filters(full_table, filters)
+        if columns is not None:
+            full_table = full_table.loc[:, columns]
+
+    if use_categories:
+        full_table = full_table.astype({ column : 'category' for column in categorical_columns if column in full_table })
     else:
-        print(f"Reading from {cache_file}")
+        full_table = full_table.astype({ column : object for column in categorical_columns if column in full_table })
+
+    return full_table
+    
+
+# the file extensions of the supported cache formats
+cache_formats = {'.pk' : 'pickle',
+                 '.pkl' : 'pickle',
+                 '.parquet' : 'parquet',
+                 '.feather' : 'ipc',
+                 '.arrow' : 'ipc'}
+
+# the schema metadata key under which the identity of the file listing is stored in columnar caches
+_listing_key_name = b'cmip6_listing_key'
+
+def _get_cache_format(cache_file):
+    """ Returns the format of a cache file, based on its extension """
+    extension = os.path.splitext(cache_file)[1]
+    if extension not in cache_formats:
+        raise ValueError("Unknown cache file type `{}`; expected one of {}".format(extension, sorted(cache_formats)))
+    return cache_formats[extension]
+
+def _listing_key(input_file_list, hash_bytes = 2**20):
+    """ Returns a string identifying the current state of a file listing: its modification time,
+        size, and a hash of its first and last `hash_bytes` bytes """
+    stat = os.stat(input_file_list)
+    listing_hash = hashlib.sha1()
+    with open(input_file_list, 'rb') as fin:
+        listing_hash.update(fin.read(hash_bytes))
+        if stat.st_size > hash_bytes:
+            fin.seek(max(stat.st_size - hash_bytes, hash_bytes))
+            listing_hash.update(fin.read())
+    return json.dumps(dict(mtime = stat.st_mtime_ns, size = stat.st_size, sha1 = listing_hash.hexdigest()))
+
+def _apply_filters(full_table, filters):
+    """ Returns the rows of a table that match a dict of filters (see `load()`) """
+    if filters is None or len(filters) == 0:
+        return full_table
+    
+    iselect = pd.Series(True, index = full_table.index)
+    for key, item in filters.items():
+        if isinstance(item, (list, tuple, set, frozenset)):
+            iselect &= full_table[key].isin(list(item))
+        else:
+            iselect &= full_table[key] == item
+    return full_table[iselect]
+
+def _arrow_filter_expression(filters):
+    """ Converts a dict of filters (see `load()`) to a pyarrow dataset expression """
+    import pyarrow.dataset as pads
+    
+    expression = None
+    for key, item in filters.items():
+        if isinstance(item, (list, tuple, set, frozenset)):
+            term = pads.field(key).isin(list(item))
+        else:
+            term = pads.field(key) == item
+        expression = term if expression is None else expression & term
+    return expression
+
+def _read_cache(cache_file, input_file_list, columns = None, filters = None, check_listing = True):
+    """ Reads a cached database; returns None if the cache is out of date with respect to input_file_list
+        (this is only checked if check_listing is True) """
+    cache_format = _get_cache_format(cache_file)
+    
+    print(f"Reading from {cache_file}")
+    if cache_format == 'pickle':
         full_table = pd.read_pickle(cache_file)
+        full_table = _apply_filters(full_table, filters)
+        if columns is not None:
+            full_table = full_table.loc[:, columns]
+        return full_table
+    
+    import pyarrow
+    import pyarrow.dataset as pads
+    import pyarrow.fs as pafs
+    
+    dataset = pads.dataset(cache_file,
+                           format = cache_format,
+                           filesystem = pafs.LocalFileSystem(use_mmap = True))
+    
+    # check whether the cache was made from the current version of the file listing
+    if check_listing and os.path.exists(input_file_list):
+        if cache_format == 'parquet':
+            import pyarrow.parquet as pq
+            metadata = pq.read_schema(cache_file).metadata
+        else:
+            with pyarrow.ipc.open_file(pyarrow.memory_map(cache_file)) as reader:
+                metadata = reader.schema.metadata
+        stored_key = (metadata or {}).get(_listing_key_name, b'').decode()
+        if stored_key != _listing_key(input_file_list):
+            print(f"{cache_file} is out of date with respect to {input_file_list}")
+            return None
+        
+    filter_expression = None
+    if filters is not None and len(filters) > 0:
+        filter_expression = _arrow_filter_expression(filters)
+        
+    arrow_table = dataset.to_table(columns = columns, filter = filter_expression)
+    try:
+        return arrow_table.to_pandas()
+    except pyarrow.ArrowInvalid:
+        # dates after 2262 don't fit in datetime64[ns]; keep them as datetime objects (see `_parse_dates()`)
+        return arrow_table.to_pandas(timestamp_as_object = True)
+
+def _save_cache(full_table, cache_file, input_file_list):
+    """ Saves a database to a cache file, recording the state of input_file_list in columnar formats """
+    cache_format = _get_cache_format(cache_file)
+    
+    cache_dir = os.path.dirname(os.path.abspath(cache_file))
+    with tempfile.NamedTemporaryFile(dir = cache_dir, suffix = os.path.splitext(cache_file)[1], delete = False) as fout:
+        temp_file = fout.name
+        
+    if cache_format == 'pickle':
+        full_table.to_pickle(temp_file)
+    else:
+        import pyarrow
+        
+        # store plain strings; categoricals are restored on reading
+        arrow_table = pyarrow.Table.from_pandas(full_table.astype({ column : object for column in categorical_columns if column in full_table }),
+                                                preserve_index = False)
+        metadata = dict(arrow_table.schema.metadata or {})
+        metadata[_listing_key_name] = _listing_key(input_file_list).encode()
+        arrow_table = arrow_table.replace_schema_metadata(metadata)
+        
+        if cache_format == 'parquet':
+            import pyarrow.parquet as pq
+            pq.write_table(arrow_table, temp_file)
+        else:
+            import pyarrow.feather as feather
+            feather.write_feather(arrow_table, temp_file, compression = 'uncompressed')
+            
+    os.replace(temp_file, cache_file)
+    
 
+def table_from_paths(paths, use_categories = True):
+    """ Makes a database table (see `load()`) from a list of file paths
+    
+        input:
+        ------
+        
+            paths : a list of absolute paths to CMIP6 files, in the same form as the
+                    lines of the file listing read by `load()`
+                    
+            use_categories : see `load()`
+            
+        output:
+        -------
+        
+            full_table : a pandas dataframe with the same columns as returned by `load()`
+    """
+    full_table = pd.Series(list(paths), dtype = object).str.split('/', expand = True)
+    full_table = full_table.reindex(columns = range(len(listing_columns)))
+    full_table.columns = listing_columns
+    full_table = full_table.drop(columns = "dum")
+    
+    return _add_derived_columns(full_table, use_categories)
+
+def update(cmip6_table, added_paths = (), removed_paths = (), use_categories = True):
+    """ Adds and removes files from a database table, without reparsing the unchanged files
+    
+        input:
+        ------
+        
+            cmip6_table   : a pandas dataframe containing information
+                            about available CMIP6 files (e.g. returned
+                            from `load()`)
+                            
+            added_paths   : a list of paths of files to add
+            
+            removed_paths : a list of paths of files to remove
+            
+            use_categories : see `load()`
+            
+        output:
+        -------
+        
+            full_table : the updated table
+    """
+    full_table = cmip6_table
+    if len(removed_paths) > 0:
+        # put the removed paths in the same form as reconstruct_path()
+        removed_full_paths = reconstruct_path(table_from_paths(removed_paths, use_categories = False))
+        full_table = full_table[~reconstruct_path(full_table).isin(removed_full_paths)]
+        
+    if len(added_paths) > 0:
+        full_table = pd.concat([full_table.astype({ column : object for column in categorical_columns if column in full_table }),
+                                table_from_paths(added_paths, use_categories = False)],
+                               ignore_index = True)
+        
+    if use_categories:
+        full_table = full_table.astype({ column : 'category' for column in categorical_columns if column in full_table })
+        
+    return full_table.reset_index(drop = True)
 
+def update_cache(cache_file, input_file_list, added_paths = (), removed_paths = ()):
+    """ Incrementally updates a database cache after files were added to or removed from input_file_list
+    
+        input:
+        ------
+        
+            cache_file      : the cache file to update (see `load()`).  If it doesn't exist, it is
+                              built from input_file_list.
+            
+            input_file_list : the (already updated) list of all available CMIP6 files
+            
+            added_paths     : a list of paths of files that were added to input_file_list
+            
+            removed_paths   : a list of paths of files that were removed from input_file_list
+            
+        output:
+        -------
+        
+            full_table : the updated table
+    """
+    if not os.path.exists(cache_file):
+        return load(input_file_list, cache_file)
+    
+    full_table = _read_cache(cache_file, input_file_list, check_listing = False)
+    full_table = update(full_table, added_paths, removed_paths)
+    _save_cache(full_table, cache_file, input_file_list)
+    
     return full_table
     
+
+# columns with few unique values, which are stored as categoricals
+categorical_columns = ["base_path", "center", "model", "simulation", "ensemble", "group", "variable", "gn", "version", "file_id"]
+
+# strptime formats for the date strings in CMIP6 file names, by string length
+date_formats = {4 : "%Y",
+                6 : "%Y%m",
+                8 : "%Y%m%d",
+                10 : "%Y%m%d%H",
+                12 : "%Y%m%d%H%M"}
+
+def _parse_dates(datestr):
+    """ Converts a pandas.Series of CMIP6 file name date strings to datetimes; unparseable dates become NaT
+    
+        Dates are parsed to datetime64[ns] where possible.  If any date is outside its range (e.g., after
+        2262-04-11, as in ScenarioMIP extensions to 2300), the series falls back to object dtype, with
+        datetime objects for those dates.
+    """
+    dates = pd.Series(pd.NaT, index = datestr.index, dtype = "datetime64[ns]")
+    lengths = datestr.str.len()
+    for length, strptime_string in date_formats.items():
+        imatch = lengths == length
+        if imatch.any():
+            dates[imatch] = pd.to_datetime(datestr[imatch], format = strptime_string, errors = 'coerce')
+            
+    # parse the dates that failed one at a time, to tell out-of-range dates from unparseable ones
+    retry_positions = np.flatnonzero(dates.isnull().values & lengths.isin(list(date_formats)).values)
+    late_dates = {}
+    for position in retry_positions:
+        date_string = datestr.iloc[position]
+        try:
+            late_dates[position] = dt.datetime.strptime(date_string, date_formats[len(date_string)])
+        except ValueError:
+            pass
+    if len(late_dates) > 0:
+        date_values = dates.astype(object).values
+        for position, date in late_dates.items():
+            date_values[position] = date
+        dates = pd.Series(date_values, index = datestr.index, dtype = object)
+    return dates
+
+def _add_derived_columns(full_table, use_categories = True):
+    """ Adds the base_path, file_id, startdate, and enddate columns to a table of split CMIP6 paths.
+    
+        input:
+        ------
+        
+            full_table : a pandas dataframe with columns d1-d6 (the directories preceeding the CMIP6 dataset)
+                         and "center", "model", "simulation", "ensemble", "group", "variable", "gn", "version", "filename"
+                         
+            use_categories : flags whether to convert `categorical_columns` to categoricals
+                         
+        output:
+        -------
+        
+            full_table : the table, without the d1-d6 columns and with the derived columns 
+                         (including full_path; see `reconstruct_path()`) added
+    """
+    # reconstruct the base path
+    full_table['base_path'] = '/' + full_table['d1'].str.cat([ full_table['d{}'.format(i)] for i in range(2,7) ], sep = '/') + '/'
+    
+    # extract the file ID and the date range from the last field of the file name
+    last_field = full_table['filename'].str.rsplit('_', n = 1).str[-1]
+    full_table['file_id'] = last_field.str.split('.', n = 1).str[0]
+    
+    # remove parts of the path that precede the CMIP6 dataset
+    full_table = full_table.drop(columns = [ 'd{}'.format(i) for i in range(1,7)])
+    
+    # store the full path, so that it never needs to be rebuilt
+    full_table['full_path'] = reconstruct_path(full_table, use_cached = False)
+    
+    date_range = last_field.str.split('-', n = 1)
+    full_table['startdate'] = _parse_dates(date_range.str[0])
+    full_table['enddate'] = _parse_dates(date_range.str[1].str.split('.', n = 1).str[0])
+    
+    # store repetitive columns compactly
+    if use_categories:
+        for column in categorical_columns:
+            full_table[column] = full_table[column].astype('category')
+    
+    return full_table
+    
+    
+# the columns indexed by default by build_index()
+index_columns = ["model", "simulation", "ensemble", "group", "file_id", "variable"]
+
+# indices built by build_index(), keyed by the id() of the indexed table
+_table_indices = {}
+
+class TableIndex:
+    """ A hash index on columns of a CMIP6 data table, for fast equality lookups.
+    
+        Queries on all of the indexed columns are answered with a single dict lookup;
+        queries on a subset of the indexed columns intersect per-column lookups.
+    """
+    
+    def __init__(self, cmip6_table, columns = index_columns):
+        """ A hash index on columns of a CMIP6 data table, for fast equality lookups.
+        
+            input:
+            ------
+            
+                cmip6_table : a pandas dataframe containing information
+                              about available CMIP6 files (e.g. returned
+                              from `load()`)
+                              
+                columns     : the columns to index
+        """
+        self.columns = list(columns)
+        self.nrows = len(cmip6_table)
+        
+        # map each combination of values (and each individual value) to the row positions that have it
+        self.compound_index = cmip6_table.groupby(self.columns, observed = True, sort = False).indices
+        self.column_indices = { column : cmip6_table.groupby(column, observed = True, sort = False).indices \
+                                for column in self.columns }
+        
+    def lookup(self, **kwargs):
+        """ Returns the (sorted) row positions that match all search terms, or None if the index can't answer the query """
+        if len(kwargs) == 0 or not all([ key in self.column_indices for key in kwargs ]):
+            return None
+        
+        no_match = np.array([], dtype = np.int64)
+        
+        if len(kwargs) == len(self.columns):
+            key = tuple([ kwargs[column] for column in self.columns ])
+            return self.compound_index.get(key, no_match)
+        
+        # intersect the matches of each term, starting with the most selective
+        matches = sorted([ self.column_indices[key].get(item, no_match) for key, item in kwargs.items() ], key = len)
+        positions = matches[0]
+        for match in matches[1:]:
+            positions = np.intersect1d(positions, match, assume_unique = True)
+        return positions
+    
+def build_index(cmip6_table, columns = index_columns):
+    """ Builds an index on a CMIP6 data table; `select_by_dict()` uses it automatically for that table.
+    
+        input:
+        ------
+        
+            cmip6_table : a pandas dataframe containing information
+                          about available CMIP6 files (e.g. returned
+                          from `load()`)
+                          
+            columns     : the columns to index
+            
+        output:
+        -------
+        
+            index       : the TableIndex.  The index is dropped if the table is garbage collected,
+                          and ignored if the number of rows in the table changes.
+    """
+    index = TableIndex(cmip6_table, columns)
+    
+    # forget indices of tables that no longer exist
+    for key in [ key for key, (table_ref, _) in _table_indices.items() if table_ref() is None ]:
+        del _table_indices[key]
+        
+    _table_indices[id(cmip6_table)] = (weakref.ref(cmip6_table), index)
+    return index
+
+def get_index(cmip6_table):
+    """ Returns the index built for a table by `build_index()`, or None if there isn't a valid one """
+    table_ref, index = _table_indices.get(id(cmip6_table), (None, None))
+    if table_ref is None or table_ref() is not cmip6_table or index.nrows != len(cmip6_table):
+        return None
+    return index
+    
     
 def select_by_dict(cmip6_table, **kwargs):
     """ Search the CMIP6 data table using a dict for matching.
@@ -118,10 +500,20 @@ def select_by_dict(cmip6_table, **kwargs):
             cmip6_table_subset : a subset of the input cmip6_table, containing
                                  only files that match the search
                                  
+        If an index has been built for cmip6_table with `build_index()`, and all
+        search terms are on indexed columns, the index is used for the search.
+                                 
     """
     # get any keyward arguments
     search_dict = kwargs
     
+    # use the table's index, if it has one that can answer this search
+    index = get_index(cmip6_table)
+    if index is not None:
+        positions = index.lookup(**search_dict)
+        if positions is not None:
+            return cmip6_table.iloc[positions].dropna()
+    
     # find all rows that match each term
     criteria = [ cmip6_table[key] == item for key, item in search_dict.items() ]
     
@@ -135,7 +527,10 @@ def select_by_dict(cmip6_table, **kwargs):
     return cmip6_table_subset
 
 
-def reconstruct_path(cmip6_table):
+# the columns that are joined (with '/') to make the full path of a file
+path_columns = ["base_path", "center", "model", "simulation", "ensemble", "group", "variable", "gn", "version", "filename"]
+
+def reconstruct_path(cmip6_table, use_cached = True):
     """ Reconstruct the full path for all files in a cmip6 data table
     
         input:
@@ -144,6 +539,9 @@ def reconstruct_path(cmip6_table):
             cmip6_table : a pandas dataframe containing information
                           about available CMIP6 files (e.g. returned
                           from `load()`)
+                          
+            use_cached  : flags whether to use the table's `full_path` column
+                          (stored by `load()`), if it has one
             
         output:
         -------
@@ -151,5 +549,84 @@ def reconstruct_path(cmip6_table):
             file_series : a pandas.Series object containing a list of file paths
                                  
     """
-    return cmip6_table.loc[:,["base_path","center","model","simulation", "ensemble", "group", "variable", "gn", "version", "filename"]].apply(lambda x: '/'.join(x), axis = 1)
+    if use_cached and 'full_path' in cmip6_table:
+        return cmip6_table['full_path']
+    
+    columns = [ cmip6_table[column].astype(str) for column in path_columns ]
+    return columns[0].str.cat(columns[1:], sep = '/')
+
+
+
+# the columns that identify a file, apart from its variable and version
+triplet_key_columns = ["model", "simulation", "ensemble", "group", "file_id"]
+
+def latest_versions(cmip6_table, key_columns = triplet_key_columns + ["variable"]):
+    """ Selects only the latest version of each file in a cmip6 data table
+    
+        input:
+        ------
+        
+            cmip6_table : a pandas dataframe containing information
+                          about available CMIP6 files (e.g. returned
+                          from `load()`)
+                          
+            key_columns : the columns that identify a file
+            
+        output:
+        -------
+        
+            cmip6_table_subset : the rows of cmip6_table with the latest version of each file;
+                                 rows with missing values are dropped
+    """
+    cmip6_table_subset = cmip6_table.dropna().sort_values(by = "version", kind = "mergesort")
+    return cmip6_table_subset.drop_duplicates(subset = key_columns, keep = "last")
+
+def build_triplets(cmip6_table,
+                   simulations = ("historical", "ssp585"),
+                   group = "6hrLev"):
+    """ Matches each hus file with its corresponding ua and va files
+    
+        input:
+        ------
+        
+            cmip6_table : a pandas dataframe containing information
+                          about available CMIP6 files (e.g. returned
+                          from `load()`)
+                          
+            simulations : the simulations to include
+            
+            group       : the table (e.g., 6hrLev) to use
+            
+        output:
+        -------
+        
+            triplets    : a pandas dataframe with one row per hus file, with columns `hus_file`, `ua_file`,
+                          and `va_file` (along with `triplet_key_columns`). The latest version of each
+                          file is used, and ua_file and va_file are "" if there is no matching file.
+    """
+    # get the latest version of each hus, ua, and va file
+    cmip6_table_subset = _apply_filters(cmip6_table,
+                                        dict(simulation = list(simulations),
+                                             group = group,
+                                             variable = ["hus", "ua", "va"]))
+    cmip6_table_subset = latest_versions(cmip6_table_subset)
+    
+    paths = cmip6_table_subset.loc[:, triplet_key_columns].astype(object)
+    paths['path'] = reconstruct_path(cmip6_table_subset)
+    variables = cmip6_table_subset['variable'].astype(object)
+    
+    # join the ua and va files to the hus files
+    triplets = paths[variables == "hus"].rename(columns = dict(path = "hus_file"))
+    for variable in ["ua", "va"]:
+        variable_paths = paths[variables == variable].rename(columns = dict(path = f"{variable}_file"))
+        triplets = triplets.merge(variable_paths, on = triplet_key_columns, how = "left")
+        
+    triplets[["ua_file", "va_file"]] = triplets[["ua_file", "va_file"]].fillna("")
+    
+    return triplets.sort_values(by = triplet_key_columns).reset_index(drop = True)
 
+def write_triplets(triplets, output_file):
+    """ Writes triplets from `build_triplets()` to a csv file, where each row is a set of files (hus,ua,va) to process for IVT and IWV """
+    triplet_file_string = "\n".join(triplets["hus_file"] + "," + triplets["ua_file"] + "," + triplets["va_file"])
+    with open(output_file, 'w') as fout:
+        fout.write(triplet_file_string)
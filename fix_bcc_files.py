@@ -2,34 +2,132 @@
 # coding: utf-8
 """ This script uses MPI to parallize the calculation of IWV and IVT on all available CMIP6 data. """
 
-from calculate_artmip_vertical_integrals import calculate_artmip_vertical_integrals
+from calculate_artmip_vertical_integrals import calculate_artmip_vertical_integrals, triplet_cost_functions, configure_threads
 import simplempi.simpleMPI as simpleMPI
+import task_ledger
+import triplet_metrics
+import argparse
 import sys
+import os
+import time
 import datetime as dt
 import traceback
 
+parser = argparse.ArgumentParser(description = __doc__)
+parser.add_argument("cmip6_list_file",
+                    nargs = "?",
+                    default = "fix_bcc_list_20191007.csv",
+                    help = "the file containing the list of hus,ua,va triplets to run on")
+parser.add_argument("--schedule",
+                    choices = ["static", "cost", "dynamic"],
+                    default = "dynamic",
+                    help = "'static' divides the triplets among ranks up front in round-robin order; "
+                           "'cost' divides them up front so that the estimated cost on each rank is even; "
+                           "'dynamic' has rank 0 hand out triplets as ranks finish")
+parser.add_argument("--cost",
+                    choices = sorted(triplet_cost_functions),
+                    default = "bytes",
+                    help = "how to estimate the cost of a triplet: input file size or number of input values from the file headers")
+parser.add_argument("--no-largest-first",
+                    dest = "largest_first",
+                    action = "store_false",
+                    help = "with the dynamic schedule, hand out triplets in list order rather than largest-first")
+parser.add_argument("--predict-for-ranks",
+                    type = int,
+                    default = None,
+                    help = "print the predicted cost per rank for the 'cost' schedule with this many ranks, and exit without running")
+parser.add_argument("--ledger-dir",
+                    default = None,
+                    help = "a directory in which to keep a ledger of finished and failed triplets; "
+                           "triplets recorded as done are skipped on restart")
+parser.add_argument("--temp-dir",
+                    default = os.environ.get('SCRATCH', '.') + '/tmp/',
+                    help = "the directory in which output files are written before being moved into place")
+parser.add_argument("--threads-per-rank",
+                    type = int,
+                    default = None,
+                    help = "the number of dask threads in each rank; defaults to $SLURM_CPUS_PER_TASK (the srun -c value)")
+parser.add_argument("--metrics-dir",
+                    default = None,
+                    help = "a directory in which each rank writes a JSON record of each triplet's stage timings, bytes "
+                           "read and written, peak RSS, and dask task count (summarize with `python triplet_metrics.py`)")
+args = parser.parse_args()
+
 smpi = simpleMPI.simpleMPI()
 
+threads_per_rank = configure_threads(args.threads_per_rank)
 if smpi.rank == 0:
-    # get the file containing the list of files to run on
-    cmip6_list_file = "fix_bcc_list_20191007.csv"
-    if len(sys.argv) >= 2:
-        cmip6_list_file = sys.argv[1]
+    smpi.pprint("Using {} dask threads per rank on {} ranks".format(threads_per_rank, smpi.mpisize))
 
+if smpi.rank == 0:
     # read the list of files
-    with open(cmip6_list_file) as fin:
+    with open(args.cmip6_list_file) as fin:
         triplet_list = fin.readlines()
 else:
     triplet_list = None
 
-    
-my_triplet_list = smpi.scatterList(triplet_list)
+metrics_log = None
+if args.metrics_dir is not None:
+    metrics_log = triplet_metrics.MetricsLog(args.metrics_dir, rank = smpi.rank)
+
+ledger = None
+if args.ledger_dir is not None:
+    ledger = task_ledger.TaskLedger(args.ledger_dir, rank = smpi.rank)
+    if smpi.rank == 0:
+        # skip triplets that are already done and clean up after ones that were interrupted
+        ledger_states = ledger.read_states()
+        num_triplets = len(triplet_list)
+        triplet_list = ledger.pending(triplet_list, ledger_states)
+        removed_files = ledger.clean_stale_temp_files(args.temp_dir, ledger_states)
+        smpi.pprint("Ledger: skipping {} finished triplets; removed {} stale temporary files".format(
+            num_triplets - len(triplet_list), len(removed_files)))
 
-output_file_lists = []
-for triplet in my_triplet_list:
+def run_triplet(triplet):
+    """ Calculate the ARTMIP integrals for one triplet, skipping ahead on failure """
+    output_files = None
+    metrics = triplet_metrics.TripletMetrics(triplet)
+    metrics.start()
+    start_time = time.time()
+    if ledger is not None:
+        ledger.record(triplet, "running")
     try:
-        output_files = calculate_artmip_vertical_integrals(triplet, do_clobber = True)
+        output_files = calculate_artmip_vertical_integrals(triplet,
+                                                           do_clobber = True,
+                                                           temp_dir = args.temp_dir,
+                                                           temp_file_prefix = task_ledger.temp_file_prefix(triplet),
+                                                           # (only describe the triplet, which stats its files, if its record is kept)
+                                                           metrics = metrics if metrics_log is not None else None)
+        if ledger is not None:
+            ledger.record(triplet, "done", elapsed = time.time() - start_time)
+        if metrics_log is not None:
+            metrics_log.write(metrics, status = "done")
     except: 
         traceback.print_exc()
         smpi.pprint("Skipping ahead b/c calculation failed on `{}`".format(triplet))
-    output_file_lists.append(output_files)
+        if ledger is not None:
+            ledger.record(triplet, "failed", elapsed = time.time() - start_time)
+        if metrics_log is not None:
+            metrics.end_foreground()
+            metrics_log.write(metrics, status = "failed", error = repr(sys.exc_info()[1]))
+    return output_files
+
+# estimate the cost of each triplet
+costs = None
+if smpi.rank == 0:
+    if args.predict_for_ranks is not None or args.schedule == "cost" or \
+       (args.schedule == "dynamic" and args.largest_first):
+        costs = [ triplet_cost_functions[args.cost](triplet) for triplet in triplet_list ]
+
+if args.predict_for_ranks is not None:
+    if smpi.rank == 0:
+        smpi.reportLoads(smpi.predictLoads(costs, args.predict_for_ranks))
+    sys.exit(0)
+
+if args.schedule == "dynamic":
+    output_file_lists = smpi.dynamicMap(run_triplet, triplet_list, costs = costs)
+else:
+    my_triplet_list = smpi.scatterList(triplet_list, costs = costs)
+
+    output_file_lists = []
+    for triplet in my_triplet_list:
+        output_file_lists.append(run_triplet(triplet))
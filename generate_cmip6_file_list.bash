@@ -1,13 +1,23 @@
 #!/bin/bash
 # this script generates a list of all available CMIP6 files within a CMIP6 mirror directory
+# only directories that changed since the last run (recorded in CMIP6_SCAN_STATE) are listed again,
+# and the database cache of the listing is updated in place with the files that were added or removed
 
-CMIP6_BASE_DIR=/global/cscratch1/sd/cmip6/CMIP6/CMIP/
-CMIP6_FILE_LIST=cmip6_list_$(date +%Y%m%d).txt
+CMIP6_BASE_DIR=/global/cscratch1/sd/cmip6/CMIP6/
+# the listing and its cache keep stable names, so each scan can update them incrementally
+CMIP6_FILE_LIST=cmip6_list.txt
+CMIP6_DATABASE_CACHE=cmip6_list.parquet
+CMIP6_SCAN_STATE=cmip6_scan_state.json
+DATED_FILE_LIST=cmip6_list_$(date +%Y%m%d).txt
 echo "Generating $CMIP6_FILE_LIST"
 
-# search DECK files
-find $CMIP6_BASE_DIR -name \*.nc > $CMIP6_FILE_LIST
+# search DECK and SSP files
+python cmip6_scanner.py $CMIP6_BASE_DIR $CMIP6_FILE_LIST \
+    --state-file $CMIP6_SCAN_STATE \
+    --cache-file $CMIP6_DATABASE_CACHE \
+    --filter activity=CMIP,ScenarioMIP
 
-# search SSP files
-CMIP6_BASE_DIR=/global/cscratch1/sd/cmip6/CMIP6/ScenarioMIP/
-find $CMIP6_BASE_DIR -name \*.nc >> $CMIP6_FILE_LIST
+# keep a dated copy of the listing and its cache (-p keeps the mtime, so the cache stays valid for the copy)
+cp -p $CMIP6_FILE_LIST $DATED_FILE_LIST
+cp -p $CMIP6_DATABASE_CACHE ${DATED_FILE_LIST%.txt}.parquet
+echo "Copied the listing to $DATED_FILE_LIST"
@@ -1,16 +1,18 @@
 #!/bin/bash
 #BASE_DIR=/project/projectdirs/m1517/cascade/taobrien/artmip/tier2/ARTMIP_CMIP6/
 BASE_DIR=/global/cscratch1/sd/taobrien/ARTMIP_CMIP6
-INVENTORY_FILE=cmip6_artmip_inventory_$(date +%Y%m%d).txt
-find ${BASE_DIR} -name \*.nc \
-    | grep windhusavi \
-    > ${INVENTORY_FILE}
-find ${BASE_DIR} -name \*.nc \
-    | grep uhusavi \
-    >> ${INVENTORY_FILE}
-find ${BASE_DIR} -name \*.nc \
-    | grep vhusavi \
-    >> ${INVENTORY_FILE}
-find ${BASE_DIR} -name \*.nc \
-    | grep prw \
-    >> ${INVENTORY_FILE}
+# the listing and its cache keep stable names, so each scan can update them incrementally
+INVENTORY_FILE=cmip6_artmip_inventory.txt
+INVENTORY_CACHE=cmip6_artmip_inventory.pk
+INVENTORY_SCAN_STATE=cmip6_artmip_inventory_scan_state.json
+DATED_INVENTORY_FILE=cmip6_artmip_inventory_$(date +%Y%m%d).txt
+
+# scan the output tree once for all four variables
+python cmip6_scanner.py ${BASE_DIR} ${INVENTORY_FILE} \
+    --state-file ${INVENTORY_SCAN_STATE} \
+    --cache-file ${INVENTORY_CACHE} \
+    --filter variable=windhusavi,uhusavi,vhusavi,prw
+
+# keep a dated copy of the listing and its cache (-p keeps the mtime, so the cache stays valid for the copy)
+cp -p ${INVENTORY_FILE} ${DATED_INVENTORY_FILE}
+cp -p ${INVENTORY_CACHE} ${DATED_INVENTORY_FILE%.txt}.pk
@@ -0,0 +1,115 @@
+""" A persistent inventory of ARTMIP output files and their summary statistics.
+
+    Records are written by `calculate_artmip_vertical_integrals` as each output file is put in
+    place, so that summary tables can be made with a query instead of reopening every file.
+"""
+import os
+import glob
+import time
+import sqlite3
+import pandas as pd
+
+# the columns of the inventory table
+inventory_columns = ["path",
+                     "variable",
+                     "model",
+                     "simulation",
+                     "ensemble",
+                     "file_id",
+                     "size_bytes",
+                     "ntime",
+                     "start_time",
+                     "end_time",
+                     "lat_min",
+                     "lat_max",
+                     "lon_min",
+                     "lon_max",
+                     "value_min",
+                     "value_max",
+                     "value_mean",
+                     "nan_count",
+                     "source_files",
+                     "record_time"]
+
+def _connect(inventory_file):
+    """ Opens an inventory file, creating the inventory table if needed """
+    # wait on locks held by other ranks, rather than failing
+    connection = sqlite3.connect(inventory_file, timeout = 600)
+    connection.execute("CREATE TABLE IF NOT EXISTS inventory ({}, PRIMARY KEY (path))".format(", ".join(inventory_columns)))
+    return connection
+
+def parse_output_file_name(output_file):
+    """ Returns the variable, model, simulation, ensemble, and file_id of an ARTMIP output file
+
+        The file name is expected to have the form {variable}_6hrLev_{model}_{simulation}_{ensemble}_gn_{file_id}.nc
+    """
+    fields = os.path.basename(output_file).split('.nc')[0].split('_')
+    if len(fields) < 7:
+        return dict(variable = fields[0], model = None, simulation = None, ensemble = None, file_id = None)
+    return dict(variable = fields[0],
+                model = fields[2],
+                simulation = fields[3],
+                ensemble = fields[4],
+                file_id = fields[-1])
+
+def record_output_file(inventory_file, output_file, statistics):
+    """ Adds (or replaces) the record of an output file in the inventory
+
+        input:
+        ------
+
+            inventory_file : the SQLite inventory file
+
+            output_file    : the path of the output file (it must already be in place)
+
+            statistics     : a dict with any of the remaining `inventory_columns`
+                             (e.g., from calculate_artmip_vertical_integrals)
+    """
+    record = dict(path = os.path.abspath(output_file),
+                  size_bytes = os.path.getsize(output_file),
+                  record_time = time.time())
+    record.update(parse_output_file_name(output_file))
+    record.update(statistics)
+
+    values = [ record.get(column) for column in inventory_columns ]
+    with _connect(inventory_file) as connection:
+        connection.execute("INSERT OR REPLACE INTO inventory VALUES ({})".format(", ".join(["?"]*len(inventory_columns))),
+                           values)
+    connection.close()
+
+def load_inventory(inventory_files, query = None):
+    """ Loads the inventory of output files
+
+        input:
+        ------
+
+            inventory_files : an SQLite inventory file, a glob pattern matching several
+                              inventory files (e.g., one per rank), or a list of files
+
+            query           : (optional) an SQL query on the `inventory` table; defaults to
+                              selecting everything
+
+        output:
+        -------
+
+            inventory_table : a pandas dataframe with the inventory records
+    """
+    if isinstance(inventory_files, str):
+        inventory_files = sorted(glob.glob(inventory_files))
+    if query is None:
+        query = "SELECT * FROM inventory"
+
+    tables = []
+    for inventory_file in inventory_files:
+        with _connect(inventory_file) as connection:
+            tables.append(pd.read_sql_query(query, connection))
+        connection.close()
+
+    if len(tables) == 0:
+        return pd.DataFrame(columns = inventory_columns)
+    inventory_table = pd.concat(tables, ignore_index = True)
+
+    # keep only the latest record of files that appear in several inventory files
+    if 'path' in inventory_table and 'record_time' in inventory_table:
+        inventory_table = inventory_table.sort_values(by = 'record_time').drop_duplicates(subset = 'path', keep = 'last')
+    return inventory_table.reset_index(drop = True)
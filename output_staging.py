@@ -0,0 +1,112 @@
+""" Node-local staging of output files, with asynchronous copy-out to the shared filesystem.
+
+    Output files are written to a staging directory on node-local storage (e.g., /tmp, /dev/shm,
+    or a burst buffer), and a background thread copies each one to its final location (see
+    `calculate_artmip_vertical_integrals.move_into_place()`, which copies next to the destination
+    and renames it atomically).  The shared filesystem then only sees one large sequential write and
+    one rename per file, instead of the many small writes made while a file is being built.  The
+    bytes waiting in the staging directory are bounded by a quota.
+"""
+import os
+import shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import dask.utils
+
+
+class StagingArea:
+    """ A node-local staging directory, with a background thread that moves files out of it.
+
+        example usage:
+
+            staging = StagingArea("/dev/shm/artmip/rank00003", quota = "8GB")
+
+            for triplet in triplets:
+                # don't start writing until the staged files fit in the quota
+                staging.wait_for_space()
+                calculate_artmip_vertical_integrals(triplet,
+                                                    temp_dir = staging.staging_dir,
+                                                    background_executor = staging)
+
+            # wait for all files to be copied out
+            staging.shutdown()
+    """
+
+    def __init__(self, staging_dir, quota = None, max_workers = 1, clean = True):
+        """ A node-local staging directory, with a background thread that moves files out of it.
+
+            input:
+            ------
+
+                staging_dir : the staging directory; it should only be used by this process
+
+                quota       : (optional) the number of bytes (or a string like '8GB') allowed in the staging
+                              directory before `wait_for_space()` blocks
+
+                max_workers : the number of threads copying files out
+
+                clean       : flags whether to remove files left in the staging directory (e.g., by a job that
+                              was killed)
+        """
+        if isinstance(quota, str):
+            quota = dask.utils.parse_bytes(quota)
+        self.staging_dir = staging_dir
+        self.quota = quota
+
+        if clean and os.path.isdir(staging_dir):
+            shutil.rmtree(staging_dir, ignore_errors = True)
+        os.makedirs(staging_dir, exist_ok = True)
+
+        self._executor = ThreadPoolExecutor(max_workers = max_workers)
+        self._futures = deque()
+
+    def submit(self, function, *args, **kwargs):
+        """ Runs a function (e.g., one that moves staged files into place) in the background; returns its future """
+        # forget finished tasks, so that their futures (and results) aren't kept for the whole run
+        self._prune_futures()
+        future = self._executor.submit(function, *args, **kwargs)
+        self._futures.append(future)
+        return future
+
+    def _prune_futures(self):
+        """ Drops the finished tasks from the front of the queue of background tasks """
+        while len(self._futures) > 0 and self._futures[0].done():
+            self._futures.popleft()
+
+    def staged_bytes(self):
+        """ Returns the number of bytes in the staging directory """
+        total_bytes = 0
+        for dirpath, _, filenames in os.walk(self.staging_dir):
+            for filename in filenames:
+                try:
+                    total_bytes += os.path.getsize(os.path.join(dirpath, filename))
+                except FileNotFoundError:
+                    # the file was moved out while we were looking
+                    pass
+        return total_bytes
+
+    def wait_for_space(self, poll_interval = 1.0):
+        """ Blocks until the staging directory is below its quota (or nothing is left to move out) """
+        if self.quota is None:
+            return
+        while self.staged_bytes() >= self.quota:
+            # wait for the oldest background task to finish
+            self._prune_futures()
+            if len(self._futures) == 0:
+                return
+            try:
+                self._futures[0].result(timeout = poll_interval)
+            except Exception:
+                # errors are reported by the background task itself
+                pass
+
+    def shutdown(self, wait = True):
+        """ Stops accepting work; if wait is True, waits for all files to be moved out """
+        self._executor.shutdown(wait = wait)
+        self._futures.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown(wait = True)
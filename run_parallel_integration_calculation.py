@@ -2,34 +2,332 @@
 # coding: utf-8
 """ This script uses MPI to parallize the calculation of IWV and IVT on all available CMIP6 data. """
 
-from calculate_artmip_vertical_integrals import calculate_artmip_vertical_integrals
+from calculate_artmip_vertical_integrals import calculate_artmip_vertical_integrals, triplet_cost_functions, configure_threads, \
+                                               split_triplet_line, get_merge_tasks, merge_time_slices, output_encoding_profiles, \
+                                               output_formats, get_partial_file_names, get_zarr_store_plan, initialize_zarr_store, \
+                                               consolidate_zarr_stores, open_triplet
 import simplempi.simpleMPI as simpleMPI
+import task_ledger
+import triplet_metrics
+from output_staging import StagingArea
+import argparse
 import sys
+import os
+import time
 import datetime as dt
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+parser = argparse.ArgumentParser(description = __doc__)
+parser.add_argument("cmip6_list_file",
+                    nargs = "?",
+                    default = "cmip6_artmip_files_to_process_20190917.csv",
+                    help = "the file containing the list of hus,ua,va triplets to run on")
+parser.add_argument("--schedule",
+                    choices = ["static", "cost", "dynamic"],
+                    default = "dynamic",
+                    help = "'static' divides the triplets among ranks up front in round-robin order; "
+                           "'cost' divides them up front so that the estimated cost on each rank is even; "
+                           "'dynamic' has rank 0 hand out triplets as ranks finish")
+parser.add_argument("--cost",
+                    choices = sorted(triplet_cost_functions),
+                    default = "bytes",
+                    help = "how to estimate the cost of a triplet: input file size or number of input values from the file headers")
+parser.add_argument("--no-largest-first",
+                    dest = "largest_first",
+                    action = "store_false",
+                    help = "with the dynamic schedule, hand out triplets in list order rather than largest-first")
+parser.add_argument("--predict-for-ranks",
+                    type = int,
+                    default = None,
+                    help = "print the predicted cost per rank for the 'cost' schedule with this many ranks, and exit without running")
+parser.add_argument("--ledger-dir",
+                    default = None,
+                    help = "a directory in which to keep a ledger of finished and failed triplets; "
+                           "triplets recorded as done are skipped on restart")
+parser.add_argument("--temp-dir",
+                    default = os.environ.get('SCRATCH', '.') + '/tmp/',
+                    help = "the directory in which output files are written before being moved into place")
+parser.add_argument("--max-time-steps",
+                    type = int,
+                    default = None,
+                    help = "split triplets with more than this many time steps into time slices that are calculated "
+                           "separately and then merged, so that long files can be spread across ranks")
+parser.add_argument("--inventory-file",
+                    default = None,
+                    help = "an SQLite file in which to record each output file and its summary statistics; "
+                           "`{rank}` in the name is replaced with the MPI rank, to give each rank its own file "
+                           "(see output_inventory.load_inventory())")
+parser.add_argument("--output-profile",
+                    default = "none",
+                    choices = list(output_encoding_profiles),
+                    help = "the compression/chunking/packing profile of the output files "
+                           "(see calculate_artmip_vertical_integrals.output_encoding_profiles)")
+parser.add_argument("--complevel",
+                    type = int,
+                    default = None,
+                    help = "override the zlib compression level (1-9) of the output profile")
+parser.add_argument("--output-format",
+                    default = "netcdf",
+                    choices = output_formats,
+                    help = "write a netCDF file per input file, or write each triplet's time region into a Zarr store "
+                           "per (model, simulation, ensemble, variable)")
+parser.add_argument("--mem-per-rank",
+                    default = None,
+                    help = "the memory budget of each rank (e.g., 12GB), shared by its --threads-per-rank dask threads; "
+                           "the time chunk size of each triplet is the largest that fits, given the model's resolution.  "
+                           "Defaults to chunks of 32 time steps")
+parser.add_argument("--threads-per-rank",
+                    type = int,
+                    default = None,
+                    help = "the number of dask threads in each rank; defaults to $SLURM_CPUS_PER_TASK (the srun -c value)")
+parser.add_argument("--engine",
+                    default = "dask",
+                    choices = ["dask", "numpy"],
+                    help = "calculate with xarray and dask, or stream through the files in blocks with numpy and netCDF4")
+parser.add_argument("--pipeline",
+                    action = "store_true",
+                    help = "open each rank's next triplet while the current one is calculated, and move output files "
+                           "into place in the background (requires the 'static' or 'cost' schedule)")
+parser.add_argument("--staging-dir",
+                    default = None,
+                    help = "a node-local directory (e.g., /dev/shm, /tmp, or a burst buffer) in which output files are "
+                           "written, and then copied to the shared filesystem in the background; each rank uses its own "
+                           "subdirectory.  Overrides --temp-dir for the output files")
+parser.add_argument("--staging-quota",
+                    default = None,
+                    help = "the most data (e.g., 20GB) each rank may hold in its staging directory before it waits for "
+                           "files to be copied out; a rank can exceed it by one triplet's output")
+parser.add_argument("--metrics-dir",
+                    default = None,
+                    help = "a directory in which each rank writes a JSON record of each triplet's stage timings, bytes "
+                           "read and written, peak RSS, and dask task count (summarize with `python triplet_metrics.py`)")
+args = parser.parse_args()
+if args.staging_quota is not None and args.staging_dir is None:
+    parser.error("--staging-quota needs --staging-dir")
+if args.pipeline and args.schedule == "dynamic":
+    parser.error("--pipeline needs each rank's triplets in advance; use --schedule static or cost")
+
+output_profile = args.output_profile
+if args.complevel is not None:
+    output_profile = dict(output_encoding_profiles[args.output_profile], zlib = True, shuffle = True, complevel = args.complevel)
 
 smpi = simpleMPI.simpleMPI()
 
+threads_per_rank = configure_threads(args.threads_per_rank)
 if smpi.rank == 0:
-    # get the file containing the list of files to run on
-    cmip6_list_file = "cmip6_artmip_files_to_process_20190917.csv"
-    if len(sys.argv) >= 2:
-        cmip6_list_file = sys.argv[1]
+    smpi.pprint("Using {} dask threads per rank on {} ranks".format(threads_per_rank, smpi.mpisize))
+
+inventory_file = None
+if args.inventory_file is not None:
+    inventory_file = args.inventory_file.format(rank = smpi.rank)
 
+metrics_log = None
+if args.metrics_dir is not None:
+    metrics_log = triplet_metrics.MetricsLog(args.metrics_dir, rank = smpi.rank)
+
+# write output files in a node-local staging directory, and copy them out in the background
+staging = None
+temp_dir = args.temp_dir
+if args.staging_dir is not None:
+    staging = StagingArea(os.path.join(args.staging_dir, "rank{:05d}".format(smpi.rank)), quota = args.staging_quota)
+    temp_dir = staging.staging_dir
+
+if smpi.rank == 0:
     # read the list of files
-    with open(cmip6_list_file) as fin:
+    with open(args.cmip6_list_file) as fin:
         triplet_list = fin.readlines()
+        
+    # split long triplets into time slices
+    if args.max_time_steps is not None:
+        triplet_list = [ line for triplet in triplet_list if triplet.strip() != "" \
+                              for line in split_triplet_line(triplet, args.max_time_steps) ]
+        
+    # keep the full list of triplets, to know which time slices need to be merged
+    all_triplet_list = list(triplet_list)
 else:
     triplet_list = None
 
-    
-my_triplet_list = smpi.scatterList(triplet_list)
+ledger = None
+if args.ledger_dir is not None:
+    ledger = task_ledger.TaskLedger(args.ledger_dir, rank = smpi.rank)
+    if smpi.rank == 0:
+        # skip triplets that are already done and clean up after ones that were interrupted
+        ledger_states = ledger.read_states()
+        num_triplets = len(triplet_list)
+        triplet_list = ledger.pending(triplet_list, ledger_states)
+        # (temp files are written to the staging directory, if there is one; the other ranks' staging directories
+        # are emptied when their StagingArea is created)
+        removed_files = ledger.clean_stale_temp_files(temp_dir, ledger_states, partial_files = get_partial_file_names)
+        smpi.pprint("Ledger: skipping {} finished triplets; removed {} stale temporary files".format(
+            num_triplets - len(triplet_list), len(removed_files)))
 
-output_file_lists = []
-for triplet in my_triplet_list:
+def run_triplet(triplet, prefetched = None, mover = None, metrics = None):
+    """ Calculate the ARTMIP integrals for one triplet, skipping ahead on failure
+    
+        prefetched is a future with the triplet's open input files (see open_triplet()), and mover is
+        an executor to which moving the output files into place is handed off (see run_pipelined());
+        it defaults to the staging area, if there is one.  metrics is the triplet's
+        triplet_metrics.TripletMetrics, if some of its stages were timed before this
+    """
+    output_files = None
+    if mover is None:
+        mover = staging
+    if metrics is None:
+        metrics = triplet_metrics.TripletMetrics(triplet)
+    if staging is not None:
+        # don't fill the staging directory past its quota
+        with metrics.stage('staging_wait'):
+            staging.wait_for_space()
+    metrics.start()
+    start_time = time.time()
+    if ledger is not None:
+        ledger.record(triplet, "running")
+        
+    def finished(output_files, error):
+        """ Record the triplet as done once its output files are in place """
+        if error is not None:
+            smpi.pprint("Calculation failed while moving the output of `{}`".format(triplet))
+        if ledger is not None:
+            ledger.record(triplet, "done" if error is None else "failed", elapsed = time.time() - start_time)
+        if metrics_log is not None:
+            metrics_log.write(metrics, status = "done" if error is None else "failed")
+            
+    input_datasets = None
     try:
-        output_files = calculate_artmip_vertical_integrals(triplet)
+        if prefetched is not None:
+            with metrics.stage('open_wait'):
+                input_datasets = prefetched.result()
+        output_files = calculate_artmip_vertical_integrals(triplet,
+                                                           temp_dir = temp_dir,
+                                                           temp_file_prefix = task_ledger.temp_file_prefix(triplet),
+                                                           inventory_file = inventory_file,
+                                                           output_profile = output_profile,
+                                                           output_format = args.output_format,
+                                                           memory_per_rank = args.mem_per_rank,
+                                                           engine = args.engine,
+                                                           input_datasets = input_datasets,
+                                                           background_executor = mover,
+                                                           on_finished = finished,
+                                                           # (only describe the triplet, which stats its files, if its record is kept)
+                                                           metrics = metrics if metrics_log is not None else None)
     except: 
         traceback.print_exc()
         smpi.pprint("Skipping ahead b/c calculation failed on `{}`".format(triplet))
-    output_file_lists.append(output_files)
+        # close the (possibly prefetched) input files, so that their handles don't pile up on long-running ranks
+        if input_datasets is not None:
+            for input_xr in input_datasets[:3]:
+                if input_xr is not None:
+                    input_xr.close()
+        if ledger is not None:
+            ledger.record(triplet, "failed", elapsed = time.time() - start_time)
+        if metrics_log is not None:
+            metrics.end_foreground()
+            metrics_log.write(metrics, status = "failed", error = repr(sys.exc_info()[1]))
+    return output_files
+
+def run_pipelined(triplets):
+    """ Calculate a list of triplets in order, overlapping the file system work of each with the calculation of its neighbours
+    
+        The next triplet's files are opened in a prefetching thread while the current triplet is calculated,
+        and finished output files are moved into place by a background thread while the next triplet is calculated
+        (the staging area's thread, if there is one).
+    """
+    results = []
+    with ThreadPoolExecutor(max_workers = 1) as prefetcher, \
+         ThreadPoolExecutor(max_workers = 1) if staging is None else staging as mover:
+        
+        def prefetch(triplet):
+            """ Start opening a triplet's files (the numpy engine opens its own files); returns the future and the triplet's metrics """
+            metrics = triplet_metrics.TripletMetrics(triplet)
+            if args.engine == "numpy":
+                return None, metrics
+            return prefetcher.submit(metrics.time_call, 'open', open_triplet, triplet, memory_per_rank = args.mem_per_rank), metrics
+        
+        prefetched = prefetch(triplets[0]) if len(triplets) > 0 else None
+        for i, triplet in enumerate(triplets):
+            current, metrics = prefetched
+            if i + 1 < len(triplets):
+                prefetched = prefetch(triplets[i + 1])
+            results.append(run_triplet(triplet, current, mover, metrics))
+            
+    # leaving the with block waits for the mover to put all the files in place
+    return results
+
+# estimate the cost of each triplet
+costs = None
+if smpi.rank == 0:
+    if args.predict_for_ranks is not None or args.schedule == "cost" or \
+       (args.schedule == "dynamic" and args.largest_first):
+        costs = [ triplet_cost_functions[args.cost](triplet) for triplet in triplet_list ]
+
+if args.predict_for_ranks is not None:
+    if smpi.rank == 0:
+        smpi.reportLoads(smpi.predictLoads(costs, args.predict_for_ranks))
+    sys.exit(0)
+
+def map_tasks(function, tasks, costs = None):
+    """ Run a function on a list of tasks (given on rank 0) using the requested schedule """
+    if args.schedule == "dynamic":
+        results = smpi.dynamicMap(function, tasks, costs = costs)
+    else:
+        my_tasks = smpi.scatterList(tasks, costs = costs)
+        results = [ function(task) for task in my_tasks ]
+    return results
+
+# create the Zarr stores before any rank writes into them
+if args.output_format == "zarr":
+    zarr_plan = None
+    if smpi.rank == 0:
+        zarr_plan = get_zarr_store_plan(all_triplet_list)
+        
+    def run_zarr_initialization(plan_entry):
+        """ Create one Zarr store (reading the time axes of its files from their headers), skipping ahead on failure """
+        try:
+            return initialize_zarr_store(*plan_entry)
+        except:
+            traceback.print_exc()
+            smpi.pprint("Skipping ahead b/c initialization failed on `{}`".format(plan_entry[0]))
+            
+    # spread the initialization of the stores across the ranks
+    map_tasks(run_zarr_initialization, zarr_plan)
+    smpi.doSyncBarrier()
+
+if args.pipeline:
+    output_file_lists = run_pipelined(smpi.scatterList(triplet_list, costs = costs))
+else:
+    output_file_lists = map_tasks(run_triplet, triplet_list, costs = costs)
+
+# wait for the staged output files to be copied out
+if staging is not None:
+    staging.shutdown()
+
+# consolidate the Zarr metadata, once all regions are written
+if args.output_format == "zarr":
+    smpi.doSyncBarrier()
+    if smpi.rank == 0:
+        consolidate_zarr_stores([ store for store, _, _ in zarr_plan ])
+
+# merge time slices into whole files, once all slices are done (Zarr time slices are written in place)
+if args.max_time_steps is not None and args.output_format == "netcdf":
+    smpi.doSyncBarrier()
+    
+    merge_tasks = None
+    if smpi.rank == 0:
+        merge_tasks = get_merge_tasks(all_triplet_list)
+        
+    def run_merge(merge_task):
+        """ Merge the time slices of one output file, skipping ahead on failure """
+        output_file, part_files = merge_task
+        try:
+            return merge_time_slices(output_file,
+                                     part_files,
+                                     temp_dir = temp_dir,
+                                     temp_file_prefix = task_ledger.temp_file_prefix(output_file),
+                                     inventory_file = inventory_file)
+        except:
+            traceback.print_exc()
+            smpi.pprint("Skipping ahead b/c merging failed on `{}`".format(output_file))
+        return False
+    
+    map_tasks(run_merge, merge_tasks)
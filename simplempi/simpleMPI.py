@@ -23,6 +23,9 @@ class simpleMPI:
 """
 
 
+    #The MPI tag used for messages in dynamicMap()
+    _workTag = 7
+
     def __init__(   self, \
                     useMPI = True):
         """A simple wrapper around mpi4py that offers simple scattering of a list of objects.
@@ -68,16 +71,32 @@ class simpleMPI:
 
         return
 
-    def scatterList(self,inlist):
-        """Scatter a list of objects to all participating processors."""
+    def scatterList(self,inlist,costs=None):
+        """Scatter a list of objects to all participating processors.
+
+            input:
+            ------
+
+            inlist      :   the list (or dict) to scatter (only needs to be given on the root processor)
+
+            costs       :   (optional) a list of the relative cost of each item in inlist
+                            (e.g., file sizes). If given, the list is divided so that
+                            the total cost on each processor is as even as possible, and
+                            the predicted cost on each processor is printed.
+
+        """
         if(self.useMPI):
             #If this is the root processor, divide the list as evenly as possible among processors
             # _divideListForScattering() returns a list of lists, with `mpisize` lists in the top level list
             if self.rank == 0:
-                try:
-                    scatterableList = self._divideListForScattering(inlist)
-                except:
-                    scatterableList = self._divideDictForScattering(inlist)
+                if costs is not None:
+                    scatterableList, loads = self._divideListByCost(inlist, costs)
+                    self.reportLoads(loads)
+                else:
+                    try:
+                        scatterableList = self._divideListForScattering(inlist)
+                    except:
+                        scatterableList = self._divideDictForScattering(inlist)
             else:
                 scatterableList = None
 
@@ -90,6 +109,85 @@ class simpleMPI:
         #Return this processor's list
         return myList
 
+    def dynamicMap(self, function, inlist, costs = None):
+        """Apply a function to each item of a list, handing out items to processors as they become free.
+
+            input:
+            ------
+
+            function    :   the function to apply to each item
+
+            inlist      :   the list of items (only needs to be given on the root processor)
+
+            costs       :   (optional) a list of the relative cost of each item
+                            (e.g., file sizes); if given, items are handed out
+                            largest-first. Only needs to be given on the root processor.
+
+            output:
+            -------
+
+            A list of the results of `function` for the items processed by this
+            processor.  On the root processor, this is instead the list of all
+            results, in the order of `inlist`.
+
+            The root processor only hands out work (unless it is the only
+            processor), so this is best used with more than two processors.
+
+        """
+
+        #Set the order in which to hand out items
+        if self.rank == 0:
+            order = list(range(len(inlist)))
+            if costs is not None:
+                order = sorted(order, key = lambda i: costs[i], reverse = True)
+
+        #If there is only one processor, simply do all the work here
+        if not self.useMPI or self.mpisize == 1:
+            results = [ None for i in range(len(inlist)) ]
+            for i in order:
+                results[i] = function(inlist[i])
+            return results
+
+        from mpi4py import MPI
+
+        if self.rank == 0:
+            results = [ None for i in range(len(inlist)) ]
+            status = MPI.Status()
+            num_active_workers = self.mpisize - 1
+            n = 0
+            #Wait for workers to ask for work; each request carries the result of the worker's previous item
+            while num_active_workers > 0:
+                message = self.comm.recv(source = MPI.ANY_SOURCE, tag = self._workTag, status = status)
+                worker = status.Get_source()
+                if message is not None:
+                    i, result = message
+                    results[i] = result
+
+                if n < len(order):
+                    #Hand out the next item
+                    i = order[n]
+                    self.comm.send((i, inlist[i]), dest = worker, tag = self._workTag)
+                    n = n + 1
+                else:
+                    #Tell the worker that there is nothing left to do
+                    self.comm.send(None, dest = worker, tag = self._workTag)
+                    num_active_workers = num_active_workers - 1
+        else:
+            results = []
+            message = None
+            while True:
+                #Ask for work (and pass along the previous result)
+                self.comm.send(message, dest = 0, tag = self._workTag)
+                task = self.comm.recv(source = 0, tag = self._workTag)
+                if task is None:
+                    break
+                i, item = task
+                result = function(item)
+                results.append(result)
+                message = (i, result)
+
+        return results
+
     def _divideListForScattering(self,inlist):
         """returns a list of lists, with `self.mpisize` lists in the top level list"""
 
@@ -109,6 +207,57 @@ class simpleMPI:
         #Return the list
         return outlist
 
+    def _divideListByCost(self,inlist,costs,nparts=None):
+        """returns a list of lists, with `self.mpisize` (or `nparts`) lists in the top level list, and the total cost of each list
+
+        Items are assigned largest-first to the list with the smallest total cost so far
+        (greedy longest-processing-time partitioning).
+        """
+        import heapq
+
+        if nparts is None:
+            nparts = self.mpisize
+
+        #Create a list that explicitly has the proper size
+        outlist = [ [] for i in range(nparts) ]
+        loads = [ 0 for i in range(nparts) ]
+
+        #Keep a heap of (total cost, processor) so that the least-loaded processor is always first
+        heap = [ (0, n) for n in range(nparts) ]
+
+        #Go through each item, from most to least costly
+        for i in sorted(range(len(inlist)), key = lambda i: costs[i], reverse = True):
+            load, n = heapq.heappop(heap)
+            outlist[n].append(inlist[i])
+            loads[n] = load + costs[i]
+            heapq.heappush(heap, (loads[n], n))
+
+        #Return the list and the cost on each processor
+        return outlist, loads
+
+    def predictLoads(self,costs,nparts=None):
+        """Returns the predicted cost on each of `nparts` processors (default: the current number) if scattered with `costs`"""
+        _, loads = self._divideListByCost(list(range(len(costs))), costs, nparts)
+        return loads
+
+    def reportLoads(self,loads,nworst=5):
+        """Prints a summary of the predicted cost on each processor: the min, max (the predicted makespan), and mean, and the `nworst` most loaded processors
+
+        The loads are all known on the root processor (see `_divideListByCost()`), so only
+        one summary is printed, rather than one line per processor.
+        """
+        if len(loads) == 0:
+            return
+
+        mean_load = sum(loads)/len(loads)
+        print("Predicted loads on {} processors: min {}, max {}, mean {:.6g}".format(len(loads),min(loads),max(loads),mean_load))
+        if mean_load > 0:
+            print("Predicted makespan: {} ({:.2f} times the mean load)".format(max(loads), max(loads)/mean_load))
+
+        #List the most loaded processors
+        worst = sorted(range(len(loads)), key = lambda n: loads[n], reverse = True)[:nworst]
+        print("Most loaded: " + ", ".join([ "rank {}/{} ({})".format(n+1,len(loads),loads[n]) for n in worst ]))
+
     def _divideDictForScattering(self,indict):
         """returns a list of dicts, with `self.mpisize` lists in the top level list"""
 
@@ -158,3 +307,10 @@ if __name__ == "__main__":
     #Print the dict contents and the rank
     smpi.pprint(myDict)
 
+
+    #Test handing out work dynamically, largest item first
+    results = smpi.dynamicMap(lambda x: x**2, list(range(20)), costs = list(range(20)))
+
+    #Print the results and the rank
+    smpi.pprint(results)
+
@@ -0,0 +1,142 @@
+""" An append-only ledger of the state of each task in a processing campaign.
+
+    Each rank appends one JSON record per state change (running, done, or failed)
+    to its own file in the ledger directory, so no locking is needed.  On restart,
+    the ledger is read to skip tasks that are already done and to remove temporary
+    files left behind by tasks that were interrupted.
+"""
+import os
+import glob
+import json
+import time
+import socket
+import hashlib
+
+# the states that a task can have in the ledger
+task_states = ["pending", "running", "done", "failed"]
+
+def task_key(task):
+    """ Returns a short, stable key for a task (e.g. a triplet line) """
+    return hashlib.sha1(task.strip().encode()).hexdigest()[:16]
+
+def temp_file_prefix(task):
+    """ Returns the prefix to use for temporary files written by a task, so that they can be found by `TaskLedger.clean_stale_temp_files()` """
+    return "artmip_{}_".format(task_key(task))
+
+
+class TaskLedger:
+    """ An append-only record of the state of each task in a campaign.
+    
+        example usage:
+        
+            ledger = TaskLedger("ledger", rank = smpi.rank)
+            
+            # on the root rank: skip finished tasks and clean up after interrupted ones
+            tasks = ledger.pending(tasks)
+            ledger.clean_stale_temp_files(temp_dir)
+            
+            # on each rank
+            ledger.record(task, "running")
+            ...
+            ledger.record(task, "done", elapsed = 12.3)
+    """
+    
+    def __init__(self, ledger_dir, rank = 0):
+        """ An append-only record of the state of each task in a campaign.
+        
+            input:
+            ------
+            
+                ledger_dir : the directory in which ledger files are kept; this should
+                             be on a filesystem visible to all ranks
+                             
+                rank       : the rank of this process; each rank writes its own ledger file
+        """
+        self.ledger_dir = ledger_dir
+        self.rank = rank
+        os.makedirs(ledger_dir, exist_ok = True)
+        self.ledger_file = os.path.join(ledger_dir, "ledger_rank{:05d}.jsonl".format(rank))
+        
+    def record(self, task, state, **info):
+        """ Appends a state change for a task to this rank's ledger file
+        
+            input:
+            ------
+            
+                task    : the task (e.g. a triplet line)
+                
+                state   : the new state of the task (one of `task_states`)
+                
+                **info  : any additional information (e.g. timings) to store in the record
+        """
+        if state not in task_states:
+            raise ValueError("`state` must be one of {}; got `{}`".format(task_states, state))
+            
+        entry = dict(key = task_key(task),
+                     task = task.strip(),
+                     state = state,
+                     time = time.time(),
+                     rank = self.rank,
+                     host = socket.gethostname(),
+                     **info)
+        
+        with open(self.ledger_file, 'a') as fout:
+            fout.write(json.dumps(entry) + "\n")
+            
+    def read_states(self):
+        """ Returns a dict mapping the key of each task in the ledger to its most recent record """
+        states = {}
+        for ledger_file in sorted(glob.glob(os.path.join(self.ledger_dir, "ledger_rank*.jsonl"))):
+            with open(ledger_file) as fin:
+                for line in fin:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # skip lines that were only partly written when a job was killed
+                        continue
+                    key = entry['key']
+                    if key not in states or entry['time'] >= states[key]['time']:
+                        states[key] = entry
+        return states
+    
+    def pending(self, tasks, states = None):
+        """ Returns the tasks that are not recorded as done in the ledger """
+        if states is None:
+            states = self.read_states()
+        return [ task for task in tasks if states.get(task_key(task), {}).get('state') != 'done' ]
+    
+    def clean_stale_temp_files(self, temp_dir, states = None, partial_files = None):
+        """ Removes temporary files left behind by tasks that were interrupted or that failed
+        
+            input:
+            ------
+            
+                temp_dir      : the directory in which tasks write temporary files
+                                (named with `temp_file_prefix()`)
+                           
+                states        : (optional) the ledger states from `read_states()`
+                
+                partial_files : (optional) a function that returns the other files a task may leave
+                                behind (e.g., partly copied output files next to their destinations)
+                
+            output:
+            -------
+            
+                a list of the removed files
+        """
+        if states is None:
+            states = self.read_states()
+            
+        removed_files = []
+        for key, entry in states.items():
+            if entry['state'] in ['running', 'failed']:
+                stale_files = glob.glob(os.path.join(temp_dir, "artmip_{}_*".format(key)))
+                if partial_files is not None:
+                    stale_files += [ stale_file for stale_file in partial_files(entry['task']) if os.path.exists(stale_file) ]
+                for stale_file in stale_files:
+                    try:
+                        os.remove(stale_file)
+                        removed_files.append(stale_file)
+                    except OSError:
+                        pass
+        return removed_files
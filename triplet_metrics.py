@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# coding: utf-8
+""" Structured per-triplet timing and memory records for a processing campaign, and a summary of them.
+
+    calculate_artmip_vertical_integrals() times its stages (opening, BCC coordinate repair,
+    integration, and each variable's write and move) in a `TripletMetrics`, and the MPI runners
+    append one JSON record per triplet to a per-rank file in a metrics directory (`MetricsLog`).
+    Run this module on a metrics directory to get per-model throughput, per-rank utilization, and
+    the total time spent in each stage:
+
+        python triplet_metrics.py $SCRATCH/artmip_metrics
+"""
+import os
+import glob
+import json
+import time
+import socket
+import argparse
+import resource
+import threading
+from contextlib import contextmanager
+import pandas as pd
+
+# the fields that the summaries need in every record (they may be missing, e.g., from triplets that failed early)
+summary_columns = ["triplet", "rank", "host", "status", "skipped", "model", "ntime", "bytes_read", "bytes_written",
+                   "start_time", "end_time", "elapsed", "foreground_elapsed", "peak_rss_bytes"]
+
+def reset_peak_rss():
+    """ Resets the peak resident set size of this process (Linux only; otherwise does nothing) """
+    try:
+        with open("/proc/self/clear_refs", "w") as fout:
+            fout.write("5")
+    except OSError:
+        pass
+
+def peak_rss():
+    """ Returns the peak resident set size [bytes] of this process since the last `reset_peak_rss()` """
+    try:
+        with open("/proc/self/status") as fin:
+            for line in fin:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    # ru_maxrss is in KiB on Linux; it is the peak over the life of the process
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+
+class TripletMetrics:
+    """ The timings and counters of one triplet.
+
+        example usage:
+
+            metrics = TripletMetrics(triplet)
+            metrics.start()
+
+            with metrics.stage("integrate"):
+                ...
+            metrics.add("bytes_written", os.path.getsize(output_file))
+            metrics.set(model = "CESM2")
+
+            metrics.end_foreground()
+            record = metrics.record(status = "done")
+
+        Stage times are added up, so a stage may be timed several times (e.g., once per block), and
+        stages may be timed from several threads (e.g., a file moved into place in the background).
+    """
+
+    def __init__(self, triplet):
+        """ The timings and counters of one triplet.
+
+            input:
+            ------
+
+                triplet : the triplet line
+        """
+        self.triplet = triplet.strip()
+        self.start_time = time.time()
+        self.foreground_end_time = None
+        self.peak_rss_bytes = None
+        self.timings = {}
+        self.info = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        """ Marks the start of the triplet's calculation (stages timed before this, e.g. a prefetched open, are kept) """
+        self.start_time = time.time()
+        reset_peak_rss()
+
+    def end_foreground(self):
+        """ Marks the point after which the rest of the triplet's work (e.g., moving files) is done in the background
+
+            The peak RSS is read here, since the next triplet's `start()` may reset it before the record is written.
+        """
+        self.foreground_end_time = time.time()
+        self.peak_rss_bytes = peak_rss()
+
+    def add_time(self, name, seconds):
+        """ Adds to the time [s] spent in a stage """
+        with self._lock:
+            self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name):
+        """ A context manager that adds the wall time spent in its block to a stage """
+        stage_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - stage_start)
+
+    def time_call(self, name, function, *args, **kwargs):
+        """ Calls function(*args, **kwargs), adding the time it takes to a stage; returns its result """
+        with self.stage(name):
+            return function(*args, **kwargs)
+
+    def add(self, name, value):
+        """ Adds to a counter (e.g., bytes_written) """
+        with self._lock:
+            self.info[name] = self.info.get(name, 0) + value
+
+    def set(self, **info):
+        """ Sets fields of the record (e.g., model, ntime) """
+        with self._lock:
+            self.info.update(info)
+
+    def record(self, **info):
+        """ Returns the triplet's record, as a flat dict; stage times are in `time_{stage}` fields
+
+            The record also has the wall time since `start()` (elapsed), the part of it spent before any
+            background work (foreground_elapsed), and the peak RSS of the process from `start()` to
+            `end_foreground()` (None if `end_foreground()` was not called).
+        """
+        end_time = time.time()
+        foreground_end_time = end_time if self.foreground_end_time is None else self.foreground_end_time
+        with self._lock:
+            entry = dict(triplet = self.triplet,
+                         host = socket.gethostname(),
+                         pid = os.getpid(),
+                         start_time = self.start_time,
+                         end_time = end_time,
+                         elapsed = end_time - self.start_time,
+                         foreground_elapsed = foreground_end_time - self.start_time,
+                         peak_rss_bytes = self.peak_rss_bytes)
+            entry.update({ "time_" + name : seconds for name, seconds in self.timings.items() })
+            entry.update(self.info)
+        entry.update(info)
+        return entry
+
+
+class MetricsLog:
+    """ An append-only file of triplet records, one per rank.
+
+        example usage:
+
+            metrics_log = MetricsLog("metrics", rank = smpi.rank)
+            ...
+            metrics_log.write(metrics, status = "done")
+
+            # later, on any node
+            metrics_table = load_metrics("metrics")
+    """
+
+    def __init__(self, metrics_dir, rank = 0):
+        """ An append-only file of triplet records, one per rank.
+
+            input:
+            ------
+
+                metrics_dir : the directory in which the metrics files are kept
+
+                rank        : the rank of this process; each rank writes its own metrics file
+        """
+        self.metrics_dir = metrics_dir
+        self.rank = rank
+        os.makedirs(metrics_dir, exist_ok = True)
+        self.metrics_file = os.path.join(metrics_dir, "metrics_rank{:05d}.jsonl".format(rank))
+        # records may be written from a background thread that moves files into place
+        self._lock = threading.Lock()
+
+    def write(self, metrics, **info):
+        """ Appends the record of a triplet (see `TripletMetrics.record()`), with any additional fields in info """
+        entry = metrics.record(rank = self.rank, **info)
+        with self._lock:
+            with open(self.metrics_file, 'a') as fout:
+                fout.write(json.dumps(entry, default = float) + "\n")
+
+
+def load_metrics(metrics_files):
+    """ Loads triplet records
+
+        input:
+        ------
+
+            metrics_files : a metrics directory (see `MetricsLog`), a glob pattern, or a list of files
+
+        output:
+        -------
+
+            metrics_table : a pandas dataframe with one row per record
+    """
+    if isinstance(metrics_files, str):
+        if os.path.isdir(metrics_files):
+            metrics_files = os.path.join(metrics_files, "metrics_rank*.jsonl")
+        metrics_files = sorted(glob.glob(metrics_files))
+
+    entries = []
+    for metrics_file in metrics_files:
+        with open(metrics_file) as fin:
+            for line in fin:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # skip lines that were only partly written when a job was killed
+                    continue
+    metrics_table = pd.DataFrame(entries)
+    for column in summary_columns:
+        if column not in metrics_table:
+            metrics_table[column] = None
+    return metrics_table
+
+def summarize_models(metrics_table):
+    """ Returns the throughput of each model: input GB/s and time steps/s per rank, from the triplets that were calculated """
+    done_table = metrics_table[(metrics_table['status'] == 'done') & (metrics_table['skipped'] != True)]
+    summary = done_table.groupby('model').agg(triplets = ('triplet', 'count'),
+                                              ntime = ('ntime', 'sum'),
+                                              bytes_read = ('bytes_read', 'sum'),
+                                              bytes_written = ('bytes_written', 'sum'),
+                                              elapsed = ('elapsed', 'sum'),
+                                              peak_rss_bytes = ('peak_rss_bytes', 'max'))
+    summary['read_GB_per_s'] = summary['bytes_read']/summary['elapsed']/1e9
+    summary['timesteps_per_s'] = summary['ntime']/summary['elapsed']
+    return summary.sort_values(by = 'elapsed', ascending = False)
+
+def summarize_ranks(metrics_table):
+    """ Returns the utilization of each rank: the fraction of the campaign's wall time spent in the foreground of a triplet """
+    campaign_start = metrics_table['start_time'].min()
+    campaign_end = metrics_table['end_time'].max()
+    summary = metrics_table.groupby('rank').agg(host = ('host', 'first'),
+                                                triplets = ('triplet', 'count'),
+                                                failed = ('status', lambda status: int((status != 'done').sum())),
+                                                busy = ('foreground_elapsed', 'sum'),
+                                                last_end_time = ('end_time', 'max'),
+                                                peak_rss_bytes = ('peak_rss_bytes', 'max'))
+    summary['utilization'] = summary['busy']/(campaign_end - campaign_start)
+    # the time each rank waited at the end for the slowest rank
+    summary['idle_at_end'] = campaign_end - summary['last_end_time']
+    return summary.drop(columns = ['last_end_time'])
+
+def summarize_stages(metrics_table):
+    """ Returns the total time in each stage, and its fraction of the total time in all stages """
+    stage_columns = [ column for column in metrics_table.columns if column.startswith('time_') ]
+    totals = metrics_table[stage_columns].sum().rename(lambda column: column[len('time_'):])
+    summary = pd.DataFrame(dict(seconds = totals, fraction = totals/totals.sum()))
+    return summary.sort_values(by = 'seconds', ascending = False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("metrics", help = "a metrics directory, or a glob pattern matching metrics files")
+    parser.add_argument("--csv-prefix", default = None, help = "also write the summaries to {prefix}_models.csv, {prefix}_ranks.csv, and {prefix}_stages.csv")
+    args = parser.parse_args()
+
+    metrics_table = load_metrics(args.metrics)
+    if len(metrics_table) == 0:
+        parser.exit(1, "No records found in {}\n".format(args.metrics))
+
+    campaign_seconds = metrics_table['end_time'].max() - metrics_table['start_time'].min()
+    print("{} records from {} ranks over {:.1f} minutes".format(len(metrics_table), metrics_table['rank'].nunique(), campaign_seconds/60))
+
+    summaries = dict(models = summarize_models(metrics_table),
+                     ranks = summarize_ranks(metrics_table),
+                     stages = summarize_stages(metrics_table))
+    with pd.option_context('display.max_rows', None, 'display.width', 200):
+        for name, summary in summaries.items():
+            print("\n" + name.capitalize())
+            print(summary)
+            if args.csv_prefix is not None:
+                summary.to_csv("{}_{}.csv".format(args.csv_prefix, name))
@@ -1,5 +1,9 @@
 import xarray as xr
 import numpy as np
+import hashlib
+import os
+import fcntl
+import tempfile
 
 neg_one_over_g = -1/9.806159973144531
 
@@ -341,6 +345,316 @@ dpressure_calculator['SAM0-UNICON'] = dpressure_from_SAM0_UNICON
 dpressure_calculator['IPSL-CM6A-LR'] = dpressure_from_IPSL_CM6A_LR
 
 
+
+def _level_bnds_values(xrv, level_dim, bnds_dim):
+    """ Returns the values of a (level, bnds) coefficient variable as a numpy array with the level axis first"""
+    return np.asarray(xrv.transpose(level_dim, bnds_dim).values, dtype = np.float64)
+
+def hybrid_coefficients_from_a_p0(xrd):
+    """ Calculates the vertical differences of the hybrid coefficients
+    
+        input:
+        ------
+        
+            xrd    : an xarray CMIP6 dataset
+            
+        output:
+        -------
+        
+            dap, db : numpy vectors such that dp = dap + db*ps
+                     
+    
+        Models: BCC-CSM2-MR, GISS-E2-1-G, MRI-ESM2-0, SAM0-UNICON
+        Formula: p = a*p0 + b*ps
+    """
+    a = _level_bnds_values(xrd['a_bnds'], 'lev', 'bnds')
+    b = _level_bnds_values(xrd['b_bnds'], 'lev', 'bnds')
+    p0 = float(xrd['p0'].values)
+    
+    dap = (a[:,1] - a[:,0])*p0
+    db = b[:,1] - b[:,0]
+    
+    return dap, db
+    
+def hybrid_coefficients_from_CESM2(xrd):
+    """ Calculates the vertical differences of the hybrid coefficients
+    
+        input:
+        ------
+        
+            xrd    : an xarray CMIP6 dataset
+            
+        output:
+        -------
+        
+            dap, db : numpy vectors such that dp = dap + db*ps
+                     
+    
+        Model: CESM2
+        Formula: p = a*p0 + b*ps
+    """
+    # CESM2 has its coefficient arrays upside down relative to the data
+    a = _level_bnds_values(xrd['a_bnds'], 'lev', 'nbnd')[::-1]
+    b = _level_bnds_values(xrd['b_bnds'], 'lev', 'nbnd')[::-1]
+    p0 = float(xrd['p0'].values)
+    
+    dap = (a[:,1] - a[:,0])*p0
+    db = b[:,1] - b[:,0]
+    
+    return dap, db
+    
+def hybrid_coefficients_from_ap(xrd):
+    """ Calculates the vertical differences of the hybrid coefficients
+    
+        input:
+        ------
+        
+            xrd    : an xarray CMIP6 dataset
+            
+        output:
+        -------
+        
+            dap, db : numpy vectors such that dp = dap + db*ps
+                     
+    
+        Model: GFDL-CM4
+        Formula: p = ap + b*ps
+    """
+    a = _level_bnds_values(xrd['ap_bnds'], 'lev', 'bnds')
+    b = _level_bnds_values(xrd['b_bnds'], 'lev', 'bnds')
+    
+    dap = a[:,1] - a[:,0]
+    db = b[:,1] - b[:,0]
+    
+    return dap, db
+    
+def hybrid_coefficients_from_CNRM(xrd):
+    """ Calculates the vertical differences of the hybrid coefficients
+    
+        input:
+        ------
+        
+            xrd    : an xarray CMIP6 dataset
+            
+        output:
+        -------
+        
+            dap, db : numpy vectors such that dp = dap + db*ps
+                     
+    
+        Models: CNRM-CM6-1, CNRM-ESM2-1
+        Formula: p = ap + b*ps
+    """
+    # the bounds in these files have bad values, so the bounds are
+    # calculated as the average of the mid-level values
+    ap = np.asarray(xrd['ap'].values, dtype = np.float64)
+    b = np.asarray(xrd['b'].values, dtype = np.float64)
+    
+    ap_mid = (ap[1:] + ap[:-1])/2
+    b_mid = (b[1:] + b[:-1])/2
+    
+    ap_upper = np.append(ap_mid, ap_mid[-1])
+    b_upper = np.append(b_mid, b_mid[-1])
+    ap_lower = np.insert(ap_mid, 0, 0)
+    b_lower = np.insert(b_mid, 0, 1)
+    
+    dap = ap_upper - ap_lower
+    db = b_upper - b_lower
+    
+    return dap, db
+    
+def hybrid_coefficients_from_IPSL_CM6A_LR(xrd):
+    """ Calculates the vertical differences of the hybrid coefficients
+    
+        input:
+        ------
+        
+            xrd    : an xarray CMIP6 dataset
+            
+        output:
+        -------
+        
+            dap, db : numpy vectors such that dp = dap + db*ps
+                     
+    
+        Model: IPSL-CM6A-LR
+        Formula: p = ap + b*ps (this is a guess based on the provided variables)
+    """
+    a = _level_bnds_values(xrd['ap_bnds'], 'klevp1', 'bnds')
+    b = _level_bnds_values(xrd['b_bnds'], 'klevp1', 'bnds')
+    
+    dap = np.diff(a[:,0])
+    db = np.diff(b[:,0])
+    
+    return dap, db
+    
+hybrid_coefficient_calculator = {}
+hybrid_coefficient_calculator['BCC-CSM2-MR'] = hybrid_coefficients_from_a_p0
+hybrid_coefficient_calculator['CESM2'] = hybrid_coefficients_from_CESM2
+hybrid_coefficient_calculator['CNRM-CM6-1'] = hybrid_coefficients_from_CNRM
+hybrid_coefficient_calculator['CNRM-ESM2-1'] = hybrid_coefficients_from_CNRM
+hybrid_coefficient_calculator['GFDL-CM4'] = hybrid_coefficients_from_ap
+hybrid_coefficient_calculator['GISS-E2-1-G'] = hybrid_coefficients_from_a_p0
+hybrid_coefficient_calculator['MRI-ESM2-0'] = hybrid_coefficients_from_a_p0
+hybrid_coefficient_calculator['SAM0-UNICON'] = hybrid_coefficients_from_a_p0
+hybrid_coefficient_calculator['IPSL-CM6A-LR'] = hybrid_coefficients_from_IPSL_CM6A_LR
+
+# the ways in which integrals can be calculated (see `integrate()`)
+integration_methods = ['multiply', 'einsum']
+
+# the variables that determine the hybrid coefficients of a dataset
+hybrid_coefficient_variables = ['a_bnds', 'ap_bnds', 'b_bnds', 'p0', 'ap', 'b']
+
+# cached hybrid coefficients, keyed by (model, coefficient hash)
+_hybrid_coefficient_cache = {}
+# coefficient files that have already been read into the cache
+_loaded_coefficient_files = set()
+
+
+def _hybrid_coefficient_key(xrd, model):
+    """ Returns the cache key, (model, digest of the hybrid coefficient variables), for a dataset
+    
+        The digest covers the name, shape, and all values of each coefficient variable (at most a few
+        hundred values), so models with the same levels at the ends but different interior levels
+        get different keys.
+    """
+    coefficient_hash = hashlib.sha1()
+    for var in hybrid_coefficient_variables:
+        if var in xrd.variables:
+            xrv = xrd[var]
+            coefficient_hash.update(var.encode())
+            coefficient_hash.update(str(xrv.shape).encode())
+            coefficient_hash.update(np.ascontiguousarray(xrv.values, dtype = np.float64).tobytes())
+    return (model, coefficient_hash.hexdigest())
+
+def load_hybrid_coefficients(coefficient_file):
+    """ Reads cached hybrid coefficients from a file written by `save_hybrid_coefficients()`
+    
+        input:
+        ------
+        
+            coefficient_file : the path to a .npz file of cached coefficients
+            
+        output:
+        -------
+        
+            None; the coefficients are added to the module's cache.  Nothing is done
+            if the file doesn't exist.
+    """
+    _loaded_coefficient_files.add(coefficient_file)
+    if not os.path.exists(coefficient_file):
+        return
+    
+    with np.load(coefficient_file) as fin:
+        for name in fin.files:
+            model, coefficient_hash, coefficient = name.split('__')
+            if coefficient != 'dap':
+                continue
+            _hybrid_coefficient_cache[(model, coefficient_hash)] = \
+                (fin[name], fin['__'.join([model, coefficient_hash, 'db'])])
+                
+def save_hybrid_coefficients(coefficient_file):
+    """ Writes the cached hybrid coefficients to a file
+    
+        input:
+        ------
+        
+            coefficient_file : the path to a .npz file of cached coefficients.
+                               Coefficients already in the file are kept.
+            
+        output:
+        -------
+        
+            None; the file is replaced atomically, so it is safe for multiple
+            processes to read it while it is being written.  Writers hold a lock
+            on {coefficient_file}.lock while merging, so that concurrent saves
+            don't drop each other's coefficients.
+    """
+    coefficient_dir = os.path.dirname(os.path.abspath(coefficient_file))
+    with open(coefficient_file + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            # merge with coefficients that other processes may have written
+            load_hybrid_coefficients(coefficient_file)
+            
+            arrays = {}
+            for (model, coefficient_hash), (dap, db) in _hybrid_coefficient_cache.items():
+                arrays['__'.join([model, coefficient_hash, 'dap'])] = dap
+                arrays['__'.join([model, coefficient_hash, 'db'])] = db
+                
+            with tempfile.NamedTemporaryFile(dir = coefficient_dir, suffix = '.npz', delete = False) as fout:
+                np.savez(fout, **arrays)
+            os.replace(fout.name, coefficient_file)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def hybrid_coefficients(xrd, model = None, coefficient_file = None):
+    """ Gets the vertical differences of the hybrid coefficients for a dataset, using a per-model cache
+    
+        input:
+        ------
+        
+            xrd              : an xarray CMIP6 dataset
+            
+            model            : (str) the name of the model from which 
+                               the data came. If not provided, this will be
+                               inferred from the source_id attribute of
+                               the input dataset
+                               
+            coefficient_file : (optional) a .npz file in which to persist the
+                               cache between runs
+            
+        output:
+        -------
+        
+            dap, db : numpy vectors such that dp = dap + db*ps
+    """
+    _, model = get_level_variable_name(xrd, model)
+    
+    if coefficient_file is not None and coefficient_file not in _loaded_coefficient_files:
+        load_hybrid_coefficients(coefficient_file)
+    
+    key = _hybrid_coefficient_key(xrd, model)
+    if key not in _hybrid_coefficient_cache:
+        _hybrid_coefficient_cache[key] = hybrid_coefficient_calculator[model](xrd)
+        if coefficient_file is not None:
+            save_hybrid_coefficients(coefficient_file)
+            
+    return _hybrid_coefficient_cache[key]
+
+def dpressure(xrd, model = None, coefficient_file = None):
+    """ Calculates the vertical pressure differential using cached hybrid coefficients
+    
+        input:
+        ------
+        
+            xrd              : an xarray CMIP6 dataset
+            
+            model            : (str) the name of the model from which 
+                               the data came. If not provided, this will be
+                               inferred from the source_id attribute of
+                               the input dataset
+                               
+            coefficient_file : (optional) a .npz file in which to persist the
+                               coefficient cache between runs
+            
+        output:
+        -------
+        
+            dp     : the vertical pressure differential, centered
+                     on the model mid-levels
+                     [Pa]
+    """
+    dim_name, model = get_level_variable_name(xrd, model)
+    
+    dap, db = hybrid_coefficients(xrd, model, coefficient_file)
+    
+    dap = xr.DataArray(dap, dims = [dim_name], coords = {dim_name : xrd[dim_name]})
+    db = xr.DataArray(db, dims = [dim_name], coords = {dim_name : xrd[dim_name]})
+    
+    return dap + db*xrd['ps']
+
+
 def get_level_variable_name(xr_dataset, model = None):
     """Gets the dimension name for an IPCC model file
     
@@ -390,7 +704,9 @@ def get_level_variable_name(xr_dataset, model = None):
 
 def integrate(xr_dataset,
               model = None,
-              variables = None):
+              variables = None,
+              coefficient_file = None,
+              method = 'multiply'):
     """ Calculates the vertical, mass-weighted integral of `xr_dataset`.
     
     
@@ -407,6 +723,20 @@ def integrate(xr_dataset,
                          
             variables  : a list of variables to integrate.  If None is given
                          all variables are integrated.
+                         
+            coefficient_file : (optional) a .npz file in which to persist the
+                               hybrid coefficient cache between runs
+                               
+            method     : (str) how the integral is calculated:
+            
+                            'multiply' : dp is multiplied by each variable and the
+                                         product is summed over levels
+                                         
+                            'einsum'   : each variable is contracted with the hybrid
+                                         coefficients blockwise, so neither dp nor the
+                                         weighted variable are held in memory.  If
+                                         `variables` is None, only variables with a
+                                         level dimension are integrated.
             
         output:
         -------
@@ -418,9 +748,24 @@ def integrate(xr_dataset,
     
     
     dim_name, model = get_level_variable_name(xr_dataset, model)
+    
+    if method not in integration_methods:
+        raise ValueError("`method` must be one of {}; got `{}`".format(integration_methods, method))
+    
+    if method == 'einsum':
+        dap, db = hybrid_coefficients(xr_dataset, model, coefficient_file)
+        
+        if variables is None:
+            variables = [ var for var in xr_dataset.data_vars if dim_name in xr_dataset[var].dims ]
+            
+        int_xr_dataset = xr_dataset.drop(variables)
+        for var in variables:
+            int_xr_dataset[var] = _apply_hybrid_contraction(xr_dataset['ps'], [xr_dataset[var]], dim_name, dap, db)[0]
+            
+        return int_xr_dataset
    
     # get the mass-weighting term
-    dp = neg_one_over_g*dpressure_calculator[model](xr_dataset)
+    dp = neg_one_over_g*dpressure(xr_dataset, model, coefficient_file)
     
    # ensure that dp has the correct ordering
     dp = dp.transpose('time', dim_name, 'lat', 'lon')
@@ -466,6 +811,268 @@ def safe_multiply(ds1, ds2, var1, var2):
     dim_name, model = get_level_variable_name(ds1)
     
     return ds1[var1].assign_coords(**{dim_name : ds2[dim_name]}) * ds2[var2]
+
+
+def _artmip_kernel(dp, hus, ua = None, va = None):
+    """ Calculates the mass-weighted vertical integrals of hus, ua*hus, and va*hus on numpy blocks.
+    
+        input:
+        ------
+        
+            dp, hus, ua, va : numpy arrays of the same shape, with the level dimension last
+                              (ua and va may be None)
+                              
+        output:
+        -------
+        
+            prw                                   : if ua or va is None
+            
+            prw, uhusavi, vhusavi, windhusavi     : otherwise
+    """
+    # weight humidity by the mass of each layer; this is shared by all integrals
+    hus_dp = hus * dp
+    
+    prw = hus_dp.sum(axis = -1)
+    
+    if ua is None or va is None:
+        return prw
+    
+    uhusavi = np.einsum('...k,...k->...', hus_dp, ua)
+    vhusavi = np.einsum('...k,...k->...', hus_dp, va)
+    windhusavi = np.sqrt(uhusavi**2 + vhusavi**2)
+    
+    return prw, uhusavi, vhusavi, windhusavi
+
+
+def _level_subscripts(level_axis):
+    """ Returns the einsum subscripts of a field whose level dimension is at level_axis, and of its integral """
+    if level_axis == -1:
+        return '...k', '...'
+    leading_subscripts = 'abcdefghij'[:level_axis]
+    return leading_subscripts + 'k...', leading_subscripts + '...'
+
+def _hybrid_contraction(ps, *fields, dap = None, db = None, level_axis = -1, out = None, work = None):
+    """ Calculates the mass-weighted vertical integral of the product of `fields` on numpy blocks.
+    
+        The integral, -1/g * sum_k (dap_k + db_k*ps)*fields_k, is calculated with
+        einsum contractions, so neither dp nor the product of the fields is formed.
+    
+        input:
+        ------
+        
+            ps         : a numpy array of surface pressure
+            
+            *fields    : numpy arrays with the same shape as ps, plus a level dimension
+            
+            dap, db    : numpy vectors of the hybrid coefficient differences (see `hybrid_coefficients()`)
+            
+            level_axis : the axis of the level dimension in `fields`: -1 (last) or a non-negative axis
+            
+            out, work  : (optional) preallocated arrays with the shape of ps, in which to put the
+                         integral and an intermediate term; if given, no arrays are allocated
+            
+        output:
+        -------
+        
+            integral : a numpy array with the same shape as ps (`out`, if given)
+    """
+    field_subscripts, integral_subscripts = _level_subscripts(level_axis)
+    subscripts = ','.join(['k'] + [field_subscripts]*len(fields)) + '->' + integral_subscripts
+    
+    integral = np.einsum(subscripts, dap, *fields, out = out)
+    ps_term = np.einsum(subscripts, db, *fields, out = work)
+    ps_term *= ps
+    integral += ps_term
+    integral *= neg_one_over_g
+    
+    return integral
+
+def _hybrid_weighted_field(ps, hus, dap = None, db = None, level_axis = -1, out = None):
+    """ Weights a field by the mass of each layer on numpy blocks: -1/g * (dap_k + db_k*ps)*hus_k
+    
+        input:
+        ------
+        
+            ps         : a numpy array of surface pressure
+            
+            hus        : a numpy array with the same shape as ps, plus a level dimension
+            
+            dap, db    : numpy vectors of the hybrid coefficient differences (see `hybrid_coefficients()`)
+            
+            level_axis : the axis of the level dimension in hus: -1 (last) or a non-negative axis
+            
+            out        : (optional) a preallocated float64 array with the shape of hus
+            
+        output:
+        -------
+        
+            hus_dp : the weighted field, whose sum over levels is the vertical integral of hus (`out`, if given)
+    """
+    level_axis = level_axis % hus.ndim
+    coefficient_shape = [ -1 if axis == level_axis else 1 for axis in range(hus.ndim) ]
+    
+    # form the weights in place, so that only one array with the shape of hus is allocated
+    hus_dp = np.multiply(np.expand_dims(ps, level_axis), db.reshape(coefficient_shape), out = out)
+    hus_dp += dap.reshape(coefficient_shape)
+    hus_dp *= hus
+    hus_dp *= neg_one_over_g
+    
+    return hus_dp
+
+def _level_contraction(hus_dp, field, level_axis = -1, out = None):
+    """ Returns sum_k hus_dp_k*field_k on numpy blocks (see `_hybrid_weighted_field()`), in `out` if given """
+    field_subscripts, integral_subscripts = _level_subscripts(level_axis)
+    return np.einsum(field_subscripts + ',' + field_subscripts + '->' + integral_subscripts, hus_dp, field, out = out)
+
+def _artmip_hybrid_kernel(ps, hus, ua = None, va = None, dap = None, db = None):
+    """ Calculates the same quantities as `_artmip_kernel()`, but from the hybrid coefficients instead of dp
+    
+        hus is weighted by the layer mass once (see `_hybrid_weighted_field()`), and the weighted
+        field is summed over levels and contracted with ua and va, so each field is read once.
     
+        input:
+        ------
+        
+            ps              : a numpy array of surface pressure
+        
+            hus, ua, va     : numpy arrays with the same shape as ps, plus a trailing level dimension
+                              (ua and va may be None)
+                              
+            dap, db         : numpy vectors of the hybrid coefficient differences
+                              
+        output:
+        -------
+        
+            prw                                   : if ua or va is None
+            
+            prw, uhusavi, vhusavi, windhusavi     : otherwise
+    """
+    hus_dp = _hybrid_weighted_field(ps, hus, dap = dap, db = db)
+    
+    prw = hus_dp.sum(axis = -1)
+    
+    if ua is None or va is None:
+        return prw
+    
+    uhusavi = _level_contraction(hus_dp, ua)
+    vhusavi = _level_contraction(hus_dp, va)
+    windhusavi = np.sqrt(uhusavi**2 + vhusavi**2)
+    
+    return prw, uhusavi, vhusavi, windhusavi
+
+def _apply_hybrid_contraction(ps, fields, dim_name, dap, db):
+    """ Applies `_hybrid_contraction()` blockwise to xarray inputs; returns a one-element list with the integral"""
+    output_dtype = np.result_type(ps.dtype, dap.dtype, *[ v.dtype for v in fields ])
+    
+    integral = xr.apply_ufunc(_hybrid_contraction,
+                              ps,
+                              *fields,
+                              input_core_dims = [[]] + [[dim_name]]*len(fields),
+                              kwargs = dict(dap = dap, db = db),
+                              dask = 'parallelized',
+                              output_dtypes = [output_dtype],
+                             )
+    return [integral]
+
+
+def integrate_artmip(hus_ds,
+                     ua_ds = None,
+                     va_ds = None,
+                     model = None,
+                     coefficient_file = None,
+                     method = 'einsum'):
+    """ Calculates IWV and IVT from hus, ua, and va in a single pass through the data.
     
-    
\ No newline at end of file
+        Each chunk of hus, ua, va, and ps is read once, and dp is only
+        calculated once, regardless of how many quantities are integrated.
+    
+        input:
+        ------
+        
+            hus_ds     : (xarray.DataSet) a dataset containing `hus`, `ps`, and the
+                         associated coordinate variables
+                         
+            ua_ds      : (xarray.DataSet) a dataset containing `ua` (optional)
+            
+            va_ds      : (xarray.DataSet) a dataset containing `va` (optional)
+            
+            model      : (str) the name of the model from which 
+                         the data came. If not provided, this will be
+                         inferred from the source_id attribute of
+                         the input dataset
+                         
+            coefficient_file : (optional) a .npz file in which to persist the
+                               hybrid coefficient cache between runs
+                               
+            method     : (str) how the integrals are calculated:
+            
+                            'multiply' : dp is calculated for each block, multiplied by
+                                         the fields, and summed over levels
+                                         
+                            'einsum'   : hus is weighted by the layer mass from the hybrid
+                                         coefficients blockwise (without forming dp), and
+                                         the weighted hus is summed over levels and
+                                         contracted with ua and va
+                         
+        output:
+        -------
+        
+            int_dataset : an xarray.DataSet containing the non-integrated variables of `hus_ds`
+                          along with `prw` and--if ua_ds and va_ds are both given--`uhusavi`,
+                          `vhusavi`, and `windhusavi`.
+    
+    """
+    
+    dim_name, model = get_level_variable_name(hus_ds, model)
+    
+    if method not in integration_methods:
+        raise ValueError("`method` must be one of {}; got `{}`".format(integration_methods, method))
+    
+    fields = [hus_ds['hus']]
+    output_names = ['prw']
+    if ua_ds is not None and va_ds is not None:
+        # ensure that the winds and hus have the same vertical coordinate 
+        fields.append(ua_ds['ua'].assign_coords(**{dim_name : hus_ds[dim_name]}))
+        fields.append(va_ds['va'].assign_coords(**{dim_name : hus_ds[dim_name]}))
+        output_names += ['uhusavi', 'vhusavi', 'windhusavi']
+        
+    if method == 'einsum':
+        dap, db = hybrid_coefficients(hus_ds, model, coefficient_file)
+        
+        inputs = [hus_ds['ps']] + fields
+        input_core_dims = [[]] + [[dim_name]]*len(fields)
+        kernel_kwargs = dict(dap = dap, db = db)
+        kernel = _artmip_hybrid_kernel
+        output_dtype = np.result_type(dap.dtype, *[ v.dtype for v in inputs ])
+    else:
+        # get the mass-weighting term
+        dp = neg_one_over_g*dpressure(hus_ds, model, coefficient_file)
+    
+        # ensure that dp and the input variables have the same vertical coordinate 
+        # this is a kludge to deal with the fact that level information changes for the CESM model
+        # for some years
+        dp = dp.assign_coords(**{dim_name : hus_ds[dim_name]})
+        
+        inputs = [dp] + fields
+        input_core_dims = [[dim_name]]*len(inputs)
+        kernel_kwargs = {}
+        kernel = _artmip_kernel
+        output_dtype = np.result_type(*[ v.dtype for v in inputs ])
+        
+    # do the integration blockwise, with the level dimension moved to the end of each block
+    results = xr.apply_ufunc(kernel,
+                             *inputs,
+                             input_core_dims = input_core_dims,
+                             output_core_dims = [[]]*len(output_names),
+                             kwargs = kernel_kwargs,
+                             dask = 'parallelized',
+                             output_dtypes = [output_dtype]*len(output_names),
+                            )
+    if len(output_names) == 1:
+        results = (results,)
+        
+    int_xr_dataset = hus_ds.drop(['hus'])
+    for name, result in zip(output_names, results):
+        int_xr_dataset[name] = result
+    
+    return int_xr_dataset